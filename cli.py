@@ -0,0 +1,242 @@
+'''
+Command line entry point.
+    python cli.py ingest AAPL MSFT
+    python cli.py train --symbol MSFT --episodes 3 --output output/MSFT
+    python cli.py train --symbols AAPL MSFT AMZN --episode-length 250 --episodes 30
+    python cli.py backtest output/MSFT/bot.h5 --symbols AAPL MSFT --seeds 100
+    python cli.py sweep --space space.json --symbol MSFT
+    python cli.py plot output/MSFT
+Every subcommand only imports what it runs: ingest needs requests/pymongo, backtest reads the h5
+files with np_inference (no TensorFlow unless --keras) and the scaler from its .npz sidecar (no
+sklearn after the first load), only plot touches matplotlib and only train/sweep load Keras.
+Options can also come from a JSON file (--config), top level keys apply to every subcommand
+and a section named after a subcommand only to that one, i.e.
+    {"scaler": "resources/tech_scaler.pkl", "train": {"episodes": 5}, "sweep": {"space": {"lr": [1e-4, 1e-3]}}}
+Command line arguments win over the file.
+'''
+
+import os
+import sys
+import json
+import argparse
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, 'src'))
+
+default_state_vars = ['change', 'close_vwap', 'high_low', 'open_close']
+
+def _common(args):
+    '''Settings every subcommand shares, applied before anything heavy is imported.'''
+    if args.log_level or args.metrics:
+        import instrument
+        instrument.configure(enabled=args.metrics or None, level=args.log_level)
+    if args.mongo_uri:
+        import db
+        db.configure(host=args.mongo_uri)
+
+def _write(frame, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    frame.to_csv(path, index=False)
+
+def ingest(args):
+    from iex import Ingestor
+    ingestor = Ingestor(base_url=args.base_url, max_workers=args.workers, rate=args.rate)
+    if args.full:
+        documents = ingestor.ingest(args.symbols, args.timeframe)
+        added = {symbol: len(doc['data']) if doc else None for symbol, doc in documents.items()}
+    else:
+        added = ingestor.update(args.symbols, args.timeframe)
+    print(json.dumps(added, indent=2, sort_keys=True))
+    return 0 if all(n is not None for n in added.values()) else 1
+
+def train(args):
+    import Bots
+    from main import Train, Test, Test_random
+    from mongo import sstt_cursors
+    from features import load_scaler
+    scaler = load_scaler(args.scaler)
+    bot = getattr(Bots, args.bot)((args.window, len(args.state_vars) + 3), weights_filename=args.weights, verbose=False)
+    os.makedirs(args.output, exist_ok=True)
+    sampler = None
+    if args.symbols:
+        from sampler import EpisodeSampler
+        strata = None
+        if args.strata:
+            with open(args.strata) as f:
+                strata = json.load(f)
+        sampler = EpisodeSampler(args.symbols, scaler, args.state_vars, episode_length=args.episode_length,
+                                 weights=args.weighting if args.weighting != 'uniform' else None,
+                                 strata=strata, seed=args.sample_seed, prefetch=args.prefetch,
+                                 process=args.prefetch_process)
+    try:
+        bot, train_log, action_log = Train(bot, scaler, sampler or args.symbol, args.state_vars, episode_count=args.episodes,
+                                           replay_size=args.replay_size, use_reward=not args.no_reward,
+                                           discount=args.discount, epsilon_decay=args.epsilon_decay,
+                                           metrics_path=os.path.join(args.output, 'metrics') if args.metrics else None,
+                                           checkpoint_path=args.checkpoint, checkpoint_every=args.checkpoint_every)
+    finally:
+        if sampler is not None:
+            sampler.close()
+    bot.save_weights(os.path.join(args.output, 'bot.h5'))
+    _write(train_log, os.path.join(args.output, 'train_log.csv'))
+    _write(action_log, os.path.join(args.output, 'actions.csv'))
+    if not args.no_test:
+        # Every symbol episodes were drawn from, each on its own test split
+        for symbol in args.symbols or [args.symbol]:
+            suffix = '_' + symbol if args.symbols else ''
+            _, test_cursor = sstt_cursors(symbol, state_vars=args.state_vars)
+            _write(Test(bot, scaler, test_cursor, args.state_vars), os.path.join(args.output, 'test_log{}.csv'.format(suffix)))
+            _, test_cursor = sstt_cursors(symbol, state_vars=args.state_vars)
+            _write(Test_random(bot, test_cursor), os.path.join(args.output, 'random_log{}.csv'.format(suffix)))
+    with open(os.path.join(args.output, 'config.json'), 'w') as f:
+        json.dump(vars(args), f, indent=2, sort_keys=True, default=str)
+    print('saved {}'.format(args.output))
+    return 0
+
+def backtest(args):
+    from runner import run_batch
+    table = run_batch(args.symbols, args.weights, seeds=range(args.seeds), bot_class=args.bot,
+                      NN_input_shape=(args.window, len(args.state_vars) + 3), scaler=args.scaler,
+                      state_vars=args.state_vars, processes=args.processes,
+                      match_reference=args.match_reference, numpy_inference=not args.keras)
+    if args.output:
+        _write(table, args.output)
+    print(table.groupby(['symbol', 'policy'])[['final_value', 'profits', 'return']].describe().to_string())
+    return 0
+
+def _space(space):
+    '''Space from a JSON file or dict. {"low": a, "high": b} means the (a, b) range of sample_random.'''
+    if isinstance(space, str):
+        with open(space) as f:
+            space = json.load(f)
+    return {name: (values['low'], values['high']) if isinstance(values, dict) else values
+            for name, values in space.items()}
+
+def sweep(args):
+    from sweep import run_sweep
+    if not args.space:
+        raise SystemExit('sweep: --space (or "space" in the config sweep section) is required')
+    frame = run_sweep(_space(args.space), args.symbol, store=args.store, search=args.search,
+                      n_trials=args.trials, seed=args.seed, halving=not args.no_halving,
+                      min_episodes=args.min_episodes, max_episodes=args.max_episodes, eta=args.eta,
+                      scaler=args.scaler, state_vars=args.state_vars, processes=args.processes,
+                      retry_failed=args.retry_failed)
+    print(frame.head(args.top).to_string())
+    return 0
+
+def plot(args):
+    from plots import plot_run
+    for filename in plot_run(args.run, args.directory, show=args.show):
+        print(filename)
+    return 0
+
+def build_parser():
+    shared = argparse.ArgumentParser(add_help=False)
+    shared.add_argument('--config', help='JSON file of option defaults, see the module docstring')
+    shared.add_argument('--log-level', help='DEBUG, INFO, WARNING, ... (default LOG_LEVEL or WARNING)')
+    shared.add_argument('--metrics', action='store_true', help='Turn on the phase timers (see instrument.py)')
+    shared.add_argument('--mongo-uri', help='Default MONGO_URI or mongodb://localhost:27017')
+    model = argparse.ArgumentParser(add_help=False)
+    model.add_argument('--bot', default='Bot_LSTM', help='Class in Bots.py')
+    model.add_argument('--window', type=int, default=14)
+    model.add_argument('--state-vars', nargs='+', default=default_state_vars, help='Alphabetical, like the scaler')
+    model.add_argument('--scaler', default=os.path.join(here, 'resources', 'tech_scaler.pkl'))
+
+    parser = argparse.ArgumentParser(prog='cli.py', description='tradeBot: ingest, train, backtest, sweep and plot')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    p = commands.add_parser('ingest', parents=[shared], help='Download IEX history into Mongo')
+    p.add_argument('symbols', nargs='+')
+    p.add_argument('--timeframe', default='5y', help='Range for symbols not in the DB yet')
+    p.add_argument('--full', action='store_true', help='Re-download everything instead of only new bars')
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--rate', type=float, default=2, help='Requests per second')
+    p.add_argument('--base-url', help='API root, default iex.api_url')
+    p.set_defaults(run=ingest)
+
+    p = commands.add_parser('train', parents=[shared, model], help='Train a bot on one symbol or a universe, then test it')
+    p.add_argument('--symbol', default='MSFT', help='Trained and tested on without --symbols')
+    p.add_argument('--symbols', nargs='+', help='Draw every episode from these instead (see sampler.py), each is tested on (test_log_<symbol>.csv)')
+    p.add_argument('--episode-length', type=int, help='Bars per drawn episode, default the whole train split')
+    p.add_argument('--weighting', choices=['uniform', 'bars'], default='uniform', help='How --symbols are drawn')
+    p.add_argument('--strata', help='JSON file of symbol -> group (i.e. sector), groups take turns')
+    p.add_argument('--prefetch', type=int, default=2, help='Episodes built ahead on a background thread')
+    p.add_argument('--prefetch-process', action='store_true', help='Build them in a separate process instead')
+    p.add_argument('--sample-seed', type=int)
+    p.add_argument('--episodes', type=int, default=3)
+    p.add_argument('--replay-size', type=int, default=32)
+    p.add_argument('--discount', type=float, default=0.01)
+    p.add_argument('--epsilon-decay', type=float, default=0.0005)
+    p.add_argument('--no-reward', action='store_true', help='Train with use_reward=False')
+    p.add_argument('--weights', help='Start from these weights')
+    p.add_argument('--no-test', action='store_true', help='Skip Test/Test_random on the test split')
+    p.add_argument('--checkpoint', help='Checkpoint directory, resumes from it if it has one (see checkpoint.py)')
+    p.add_argument('--checkpoint-every', type=int, default=1000, help='Bars between checkpoints')
+    p.add_argument('--output', default='output/run', help='Directory for bot.h5, the logs and config.json')
+    p.set_defaults(run=train)
+
+    p = commands.add_parser('backtest', parents=[shared, model], help='Score weights files against random choice')
+    p.add_argument('weights', nargs='+', help='h5 files saved by train or Bots.my_save')
+    p.add_argument('--symbols', nargs='+', default=['AAPL', 'MSFT', 'AMZN', 'INTC', 'AMD'])
+    p.add_argument('--seeds', type=int, default=100, help='Random choice runs per symbol')
+    p.add_argument('--processes', type=int)
+    p.add_argument('--keras', action='store_true', help='Score with Keras instead of np_inference')
+    p.add_argument('--match-reference', action='store_true')
+    p.add_argument('--output', help='CSV of the full table')
+    p.set_defaults(run=backtest)
+
+    p = commands.add_parser('sweep', parents=[shared, model], help='Hyperparameter sweep, see sweep.py')
+    p.add_argument('--space', help='JSON file of knob -> values')
+    p.add_argument('--symbol', default='MSFT')
+    p.add_argument('--store', default='output/sweep.sqlite')
+    p.add_argument('--search', choices=['grid', 'random'], default='grid')
+    p.add_argument('--trials', type=int, default=20, help='Random search size')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--no-halving', action='store_true')
+    p.add_argument('--min-episodes', type=int, default=1)
+    p.add_argument('--max-episodes', type=int, default=9)
+    p.add_argument('--eta', type=int, default=3)
+    p.add_argument('--processes', type=int)
+    p.add_argument('--retry-failed', action='store_true')
+    p.add_argument('--top', type=int, default=20, help='Rows of the results printed')
+    p.set_defaults(run=sweep)
+
+    p = commands.add_parser('plot', parents=[shared], help='Plot the logs of a train run')
+    p.add_argument('run', help='Directory written by train')
+    p.add_argument('--directory', default='plots', help='Where the pngs go')
+    p.add_argument('--show', action='store_true')
+    p.set_defaults(run=plot)
+    return parser, commands.choices
+
+def apply_config(subparsers, config):
+    '''Given the subparsers and a loaded config dict, sets the file's values as defaults.'''
+    shared = {key: value for key, value in config.items() if key not in subparsers}
+    for name, subparser in subparsers.items():
+        values = dict(shared)
+        values.update(config.get(name, {}))
+        dests = {action.dest for action in subparser._actions}
+        unknown = [key for key in config.get(name, {}) if key.replace('-', '_') not in dests]
+        if unknown:
+            raise SystemExit('config: unknown {} option(s) {}'.format(name, unknown))
+        subparser.set_defaults(**{key.replace('-', '_'): value for key, value in values.items()
+                                  if key.replace('-', '_') in dests})
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser, subparsers = build_parser()
+    # The config has to be read before the real parse so its values can become defaults
+    pre = argparse.ArgumentParser(add_help=False)
+    pre.add_argument('--config')
+    known, _ = pre.parse_known_args(argv)
+    if known.config:
+        with open(known.config) as f:
+            apply_config(subparsers, json.load(f))
+    args = parser.parse_args(argv)
+    _common(args)
+    return args.run(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
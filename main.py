@@ -1,10 +1,13 @@
 
 import sys 
+import os
 import random
-import pandas as pd
+import logging
 import numpy as np
 from collections import deque
 from time import localtime, strftime
+# src modules are imported flat (from features import ...), same as the __main__ block
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
 
 # Functions
 def relu(x, m1=0.01, m2=1):
@@ -41,62 +44,161 @@ def save_output(name, df):
     if os.path.isdir('./output') and type(name) == str:
         df.to_csv('output/{}{}.csv'.format(name, strftime("%Y-%m-%d{%H-%M}", localtime())))
 
-def save_bot(bot):
+def train_logs(log_path=None):
+    '''Given an optional directory, makes the training log and the Q value log (buy, sell, hold
+    per stepped bar) of a run, the latter in <log_path>/actions. Without one they go to
+    output/this_log<time> when ./output exists: flushing their segments saves them, instead of
+    rebuilding and writing the whole log as CSV every episode.
+    Returns: this_log, action_log (recorder.LogRecorder)
+    '''
+    from recorder import LogRecorder
+    if log_path is None and os.path.isdir('./output'):
+        log_path = 'output/this_log{}'.format(strftime("%Y-%m-%d{%H-%M}", localtime()))
+        taken = log_path
+        for i in range(2, 1000):
+            if not os.path.exists(log_path):
+                break
+            log_path = '{}_{}'.format(taken, i)
+    this_log = LogRecorder(['Loss', 'Reward', 'Epsilon', 'Cash', 'Shares'], log_path)
+    action_log = LogRecorder(['buy', 'sell', 'hold'], os.path.join(log_path, 'actions') if log_path else None)
+    return this_log, action_log
+
+def restore_log(recorder, rows):
+    '''Given a recorder and a checkpoint's (columns, rows) array of its log, leaves it holding
+    exactly those rows. Rows its directory already has are kept, not written again, rows
+    recorded after the checkpoint are dropped.
+    '''
+    kept = min(len(recorder), rows.shape[1])
+    recorder.truncate(kept)
+    recorder.append_many(dict(zip(recorder.columns, rows[:, kept:])))
+
+def save_bot(bot, episode=0, count=0, epsilon=1):
+    '''Saves the bot's weights and replay memory as a checkpoint (see checkpoint.py) instead of
+    pickling the whole model. Load with checkpoint.restore_bot(Bot_LSTM(...), load_checkpoint(path)).
+    Returns: Path of the checkpoint, None without ./output
+    '''
     from time import localtime, strftime
-    import pickle
-    import os  
+    import os
+    from checkpoint import save_checkpoint, snapshot
     if os.path.isdir('./output'):
-        filename = 'output/bot_{}.pickle'.format(strftime("%Y-%m-%d{%H-%M}", localtime()))
-        print('saving bot at {}\n'.format(filename))
-        with open(filename, 'wb') as f:
-            # Pickle the 'data' dictionary using the highest protocol available.
-            pickle.dump(bot, f, pickle.HIGHEST_PROTOCOL)
+        directory = 'output/bot_{}'.format(strftime("%Y-%m-%d{%H-%M}", localtime()))
+        print('saving bot at {}\n'.format(directory))
+        return save_checkpoint(directory, snapshot(bot, episode, count, epsilon, full=True))
 
-def Train(bot, scaler, symbol, state_vars, episode_count=3, shares=0, start_cash=20000, replay_size=32, use_reward=False):
+def Train(bot, scaler, symbol, state_vars, episode_count=3, shares=0, start_cash=20000, replay_size=32, use_reward=False, batched_replay=True, discount=0.01, epsilon_decay=0.0005, log_path=None, metrics_path=None, checkpoint_path=None, checkpoint_every=1000):
     '''Notes of interest: This training procedure takes a cursor to train data, uses HER to
     Learn from past rewards. To summarize DQN, we just predict as we step through data.
     Periodically (I chose every replay_size steps), we fit on a batchsize of memories.
     Parameters:
         bot: actual capable bot object
         scaler: some scaler object fit to data coming in
-        train_data: Cursor to specific db data (like output query of train data).
+        symbol: Symbol to train on, its scaled features are built once and cached (see features.py).
+            Or a sampler.EpisodeSampler, each episode is then its next draw, built ahead by a
+            loader.PrefetchLoader while the previous one trains
         window: Legth of timesteps for bot
         shares: Number of starting stock shares for little bot
         cash: amount of starting cash
         replay_size: Batch size for HER
+        batched_replay: One predict for Q(s), one for Q(s') and one fit per replay (see replayer.Replayer)
+            instead of two predicts and a fit per memory
+        discount: Weight of max(Q(s')) in the replay targets
+        epsilon_decay: Taken off epsilon every step, down to 0.01
+        log_path: Optional directory, the training and Q value logs are flushed there in .npy
+            segments (see train_logs() and recorder.py). It has to be new unless resuming
+        metrics_path: Optional directory, turns on instrument.py and writes each episode's phase
+            timings there as JSON and Prometheus text
+        checkpoint_path: Optional directory for checkpoints (see checkpoint.py), written in the
+            background every checkpoint_every bars and after every episode. If it already holds
+            one, training resumes from it mid-episode (the bot must be built the same way)
+    Returns: bot, training log DataFrame, action_log DataFrame (buy, sell, hold Q values)
     '''
+    import instrument
+    from instrument import timer, log
+    from features import market_features, FeatureWindows
+    from memory import ReplayMemory, PrioritizedReplayMemory
     window = bot.NN_input_shape[0]
     if window > replay_size:
         raise ValueError('Window cannot be larger than replay size.')
+    # A sampler hands out (symbol, slice) episodes, a plain symbol trains on its whole train split
+    sampler = symbol if hasattr(symbol, 'next_episode') else None
+    name = sampler.name if sampler is not None else symbol
+    # Frame memory stores each bar once and rebuilds windows on sampling (see memory.py)
+    frame_memory = isinstance(bot.memory, ReplayMemory)
+    prioritized = isinstance(bot.memory, PrioritizedReplayMemory)
+    if metrics_path:
+        instrument.configure(enabled=True)
     # Create Log
-    this_log = pd.DataFrame(columns = ['Loss', 'Reward', 'Epsilon', 'Cash', 'Shares'])
-    action_log = []
+    this_log, action_log = train_logs(log_path)
     # Routine Setup
     epsilon = 1
-    discount = 0.01 #0.95
     options = ['buy', 'sell', 'hold']
-    for episode in range(episode_count):
-        state = np.zeros((1, window, len(state_vars) + 3)) # Allocate memory. This is of (1, #, #) for single fitting
+    start_episode = 0
+    resume = None
+    checkpoints = None
+    if checkpoint_path:
+        from checkpoint import CheckpointWriter, load_checkpoint, restore_bot
+        resume = load_checkpoint(checkpoint_path)
+        if resume is not None:
+            if resume['meta'].get('symbol') != name:
+                raise ValueError('Checkpoint in {} is for {}, not {}.'.format(checkpoint_path, resume['meta'].get('symbol'), name))
+            restore_bot(bot, resume)
+            epsilon = resume['meta']['epsilon']
+            start_episode = resume['meta']['episode']
+            restore_log(this_log, resume['arrays']['log'])
+            restore_log(action_log, resume['arrays']['actions'])
+            if hasattr(sampler, 'set_state') and 'sampler' in resume['meta']['loop']:
+                # Draws go on after the checkpoint's episode, not from the seed
+                sampler.set_state(resume['meta']['loop']['sampler'])
+            log('resuming', logging.INFO, checkpoint=resume['path'])
+        checkpoints = CheckpointWriter(checkpoint_path)
+    if resume is None and (len(this_log) or len(action_log)):
+        raise ValueError('{} already holds a training log.'.format(log_path))
+    for episode in range(start_episode, episode_count):
+        # Scaled once per symbol and cached, each episode only gets a fresh portfolio buffer
+        episode_symbol, episode_start = name, 0
+        if sampler is None:
+            features, closes = market_features(symbol, scaler, state_vars, split='train')
+        elif resume is not None and resume['meta']['count'] > 0:
+            # The interrupted episode, not a new draw
+            loop = resume['meta']['loop']
+            _, episode_start, features, closes = sampler.episode(loop['episode_symbol'], loop['episode_start'])
+            episode_symbol = loop['episode_symbol']
+        else:
+            # Built on the sampler's thread while the last episode trained, this only waits if it is
+            # behind (timed as episode_wait by the sampler)
+            episode_symbol, episode_start, features, closes = sampler.next_episode()
+        log('episode', logging.INFO, episode=episode, symbol=episode_symbol, start=episode_start, bars=len(closes))
+        windows = FeatureWindows(features, window)
+        state = None
         share_prices = deque([]) # Time Com. of O(1) for left popping...
-        train_cursor, _ = sstt_cursors(symbol)
         cash = start_cash
         profit = 0
         profits = 0
         count = 0
         done = False
         hold_penalty = 0
-        for item in train_cursor:
-            #print(item['data']['date'])
-            curr_price = item['data']['close']
-            curr_change = item['data']['change']
+        if resume is not None and resume['meta']['count'] > 0:
+            # Pick the episode up where the checkpoint left it
+            loop = resume['meta']['loop']
+            cash, shares, profit, profits = loop['cash'], loop['shares'], loop['profit'], loop['profits']
+            hold_penalty, share_prices = loop['hold_penalty'], deque(loop['share_prices'])
+            if loop['choice'] is not None:
+                choice = loop['choice']
+            # Only the rows the next windows still reach back to were saved
+            portfolio_start = resume['meta'].get('portfolio_start', 0)
+            windows.buffer[portfolio_start:portfolio_start + len(resume['arrays']['portfolio']), windows.n_market:] = resume['arrays']['portfolio']
+            count = resume['meta']['count']
+            state = windows.state(count - 1)
+        elif frame_memory:
+            bot.memory.reset()
+        resume = None
+        for curr_price in closes[count:]:
             value = len(share_prices)*curr_price + cash
             # End Conditions (can't buy & can't sell)
             if cash < curr_price and len(share_prices) == 0:
                 done = True
-            # Simple window: Have state going back in time, save that, shift down, ammend this step
+            # Window ending at the last bar. States are views into windows, nothing gets shifted
             previous_state = state
-            #print(previous_state)
-            state[0][1:,:] = state[0][:-1, :]
             # Generating State Vars
             if cash > curr_price:
                 can_buy = 1
@@ -107,14 +209,13 @@ def Train(bot, scaler, symbol, state_vars, episode_count=3, shares=0, start_cash
             else:
                 can_sell = 0
             cash_state = sigmoid(cash/start_cash)
-            # NOTE: Scaler Transform requires alphabetical columns for proper prediction
-            temp_state = [scaler.transform([[item['data'][j] for j in state_vars]])[0]]
-            temp_state = np.array([np.append(temp_state[0], can_buy)])
-            temp_state = np.array([np.append(temp_state[0], can_sell)])
-            temp_state = np.array([np.append(temp_state[0], cash_state)])
-            state[0][0,:] = temp_state
+            windows.set_portfolio(count, can_buy, can_sell, cash_state)
+            state = windows.state(count)
+            if frame_memory:
+                bot.memory.push_frame(windows.buffer[count])
             if count >= window: # Start Bot once state is full enough
-                actions = bot.predict(previous_state)
+                with timer('predict'):
+                    actions = bot.predict(previous_state)
                 # Exploration
                 if count > window:
                     previous_choice = choice
@@ -127,8 +228,8 @@ def Train(bot, scaler, symbol, state_vars, episode_count=3, shares=0, start_cash
                     choice = options[action]
                 # Exploration Decay
                 if epsilon > 0.01:
-                    epsilon -= 0.0005
-                    print('Epsilon: ', round(epsilon, 5))
+                    epsilon -= epsilon_decay
+                    log('epsilon', epsilon=round(epsilon, 5), count=count)
                 else:
                     epsilon = 0.01
                 # Reward Engineering [Buy, Sell, Hold] (0, 1, 2)
@@ -168,46 +269,175 @@ def Train(bot, scaler, symbol, state_vars, episode_count=3, shares=0, start_cash
                                 reward = hold_penalty
                             else:
                                 hold_penalty = 0
-                # It is important to note the memory deque is 1000 long. So stuff lost...
-                bot.memory.append((previous_state, action, reward, state, done))
-                action_log.append(actions[0])
+                if frame_memory:
+                    bot.memory.remember(action, reward, done)
+                else:
+                    # It is important to note the memory deque is 1000 long. So stuff lost...
+                    bot.memory.append((previous_state, action, reward, state, done))
+                action_log.append_many(dict(zip(action_log.columns, actions[0])))
                 # Hindsight Experience Replay
                 if (count - window + 1) % replay_size == 0:
-                    print('Replaying...')
-                    batch = random.sample(bot.memory, replay_size)
-                    for batch_state, batch_action, batch_reward, batch_new_state, batch_done in batch:
-                        # Current buy, sell, hold predictions, Q(s, a)
-                        targets = bot.predict(batch_state)
-                        # Expected buy, sell, hold predictions
-                        action_value = bot.predict(batch_new_state)
-                        if use_reward:
-                            # Adjusting target by return and discounted future return
-                            # Must += instead of reassigning rewards because reward could be zero or negative
-                            if not batch_done:
-                                targets[0][batch_action] += batch_reward + discount*np.max(action_value)
-                            else:
-                                targets[0][batch_action] += batch_reward
-                        history = bot.fit(batch_state, targets, batch_size=1, epochs=1, shuffle=False)
-                        this_log = this_log.append({'Loss':history.history['loss'][0], 
-                                                    'Reward':batch_reward, 
-                                                    'Epsilon':epsilon, 
-                                                    'Cash':cash,
-                                                    'Shares':len(share_prices)},
-                                                    ignore_index = True)
+                    log('replaying', count=count, memories=len(bot.memory))
+                    instrument.count('replays')
+                    replayed_rewards = []
+                    if frame_memory:
+                        with timer('replay_sample'):
+                            indices = bot.memory.sample_indices(replay_size)
+                            batch = bot.memory.gather(indices)
+                            # Prioritized memories correct their sampling bias through sample_weight
+                            weights = bot.memory.importance_weights(indices) if prioritized else None
+                        with timer('fit'):
+                            history, td_errors = bot.fit_batch(*batch, discount, use_reward, sample_weight=weights)
+                        if prioritized:
+                            bot.memory.update_priorities(indices, td_errors)
+                        replayed_rewards = batch[2]
+                    elif batched_replay:
+                        with timer('replay_sample'):
+                            batch = random.sample(bot.memory, replay_size)
+                        with timer('fit'):
+                            history, _ = bot.replay_batch(batch, discount, use_reward)
+                        replayed_rewards = [memory[2] for memory in batch]
+                    else:
+                        with timer('replay_sample'):
+                            batch = random.sample(bot.memory, replay_size)
+                        for batch_state, batch_action, batch_reward, batch_new_state, batch_done in batch:
+                            # Current buy, sell, hold predictions, Q(s, a)
+                            targets = bot.predict(batch_state)
+                            # Expected buy, sell, hold predictions
+                            action_value = bot.predict(batch_new_state)
+                            if use_reward:
+                                # Adjusting target by return and discounted future return
+                                # Must += instead of reassigning rewards because reward could be zero or negative
+                                if not batch_done:
+                                    targets[0][batch_action] += batch_reward + discount*np.max(action_value)
+                                else:
+                                    targets[0][batch_action] += batch_reward
+                            with timer('fit'):
+                                history = bot.fit(batch_state, targets, batch_size=1, epochs=1, shuffle=False)
+                            this_log.append({'Loss':history.history['loss'][0], 
+                                             'Reward':batch_reward, 
+                                             'Epsilon':epsilon, 
+                                             'Cash':cash,
+                                             'Shares':len(share_prices)})
+                    if len(replayed_rewards):
+                        with timer('log_append'):
+                            this_log.append_many({'Loss':history.history['loss'][0], 
+                                                  'Reward':replayed_rewards, 
+                                                  'Epsilon':epsilon, 
+                                                  'Cash':cash,
+                                                  'Shares':len(share_prices)})
             if done:
-                save_output('this_log', this_log)
+                log('died', logging.INFO, episode=episode, count=count)
                 break
             else:
-                print('Count: ', count, '\n')
+                log('count', count=count)
                 count += 1
+                if checkpoints is not None and count % checkpoint_every == 0:
+                    with timer('checkpoint'):
+                        loop = {'cash': cash, 'shares': shares, 'profit': profit, 'profits': profits,
+                                'hold_penalty': hold_penalty, 'share_prices': list(share_prices),
+                                'choice': choice if count > window else None,
+                                'episode_symbol': episode_symbol, 'episode_start': episode_start}
+                        if hasattr(sampler, 'get_state'):
+                            loop['sampler'] = sampler.get_state()
+                        portfolio_start = max(count - window, 0)
+                        checkpoints.save(checkpoints.snapshot(bot, episode, count, epsilon, loop,
+                                                              windows.buffer[portfolio_start:count, windows.n_market:],
+                                                              this_log, action_log, portfolio_start=portfolio_start, symbol=name))
         else:
             '''Wow! It Made it!'''
-            print('The Bot Survived.')
-            print('Episode: ', episode)
-        save_output('this_log_episodes', this_log)
-    return bot, this_log, action_log
+            log('survived', logging.INFO, episode=episode, count=count)
+        # Saved as their segments (see train_logs())
+        this_log.flush()
+        action_log.flush()
+        if checkpoints is not None:
+            # Next episode from its first bar
+            loop = {'sampler': sampler.get_state()} if hasattr(sampler, 'get_state') else None
+            checkpoints.save(checkpoints.snapshot(bot, episode + 1, 0, epsilon, loop, log=this_log, action_log=action_log, symbol=name))
+        if sampler is not None and hasattr(sampler, 'stats'):
+            # Consumer stall is training waiting on data, producer stall is data waiting on training
+            log('prefetch', logging.INFO, episode=episode, **sampler.stats())
+        if metrics_path:
+            instrument.export_episode(metrics_path, episode, symbol=episode_symbol)
+    if checkpoints is not None:
+        checkpoints.close()
+    return bot, this_log.to_frame(), action_log.to_frame()
+
+def Train_vec(bot, scaler, symbols, state_vars, episode_count=3, offsets=(0,), shares=0, start_cash=20000, replay_size=32, use_reward=False, capacity=100000, discount=0.01, epsilon_decay=0.0005, log_path=None):
+    '''Train with N environments stepped side by side (see vec_env.py), one per (symbol, offset).
+    Every bar is one predict on an (N, window, features) batch, and every replay_size bars one fit
+    on replay_size*N transitions from a shared memory.ReplayMemory(streams=N), so experience per
+    predict/fit call grows with N. Exploration, decay and rewards are the same as Train.
+    Parameters:
+        bot: actual capable bot object, its memory is replaced unless it already is a
+            ReplayMemory with streams=N
+        scaler, state_vars: like Train
+        symbols, offsets: One environment per symbol and offset (bars skipped at the start)
+        capacity: Bars kept per environment when a new memory is made
+        discount, epsilon_decay: Like Train
+        log_path: Optional new directory for the training and Q value logs, like Train
+    Returns: bot, training log DataFrame, action_log DataFrame (Q values of every stepped environment)
+    '''
+    import instrument
+    from instrument import timer, log
+    from memory import ReplayMemory, PrioritizedReplayMemory
+    from vec_env import VecTradingEnv
+    window = bot.NN_input_shape[0]
+    if window > replay_size:
+        raise ValueError('Window cannot be larger than replay size.')
+    n = len(symbols)*len(offsets)
+    if not (isinstance(bot.memory, ReplayMemory) and bot.memory.streams == n):
+        bot.memory = ReplayMemory(window, bot.NN_input_shape[1], capacity, streams=n)
+    prioritized = isinstance(bot.memory, PrioritizedReplayMemory)
+    env = VecTradingEnv.from_symbols(symbols, scaler, state_vars, window, offsets, shares=shares,
+                                     start_cash=start_cash, use_reward=use_reward, memory=bot.memory)
+    # Create Log
+    this_log, action_log = train_logs(log_path)
+    if len(this_log) or len(action_log):
+        raise ValueError('{} already holds a training log.'.format(log_path))
+    # Routine Setup
+    epsilon = 1
+    for episode in range(episode_count):
+        states = env.reset()
+        steps = 0
+        while env.active.any():
+            active = env.active.copy()
+            # One predict for every environment
+            with timer('predict'):
+                actions = bot.predict(states)
+            # Exploration, drawn per environment
+            explore = np.random.random_sample(n) < epsilon
+            chosen = np.where(explore, np.random.randint(0, actions.shape[1], size=n), np.argmax(actions, axis=1))
+            # Exploration Decay
+            epsilon = max(epsilon - epsilon_decay, 0.01)
+            env.step(chosen)
+            action_log.append_many(dict(zip(action_log.columns, actions[active].T)))
+            steps += 1
+            # Hindsight Experience Replay, same cadence as Train with N times the batch
+            if steps % replay_size == 0:
+                log('replaying', steps=steps, memories=len(bot.memory))
+                instrument.count('replays')
+                with timer('replay_sample'):
+                    indices = bot.memory.sample_indices(replay_size*n)
+                    batch = bot.memory.gather(indices)
+                    weights = bot.memory.importance_weights(indices) if prioritized else None
+                with timer('fit'):
+                    history, td_errors = bot.fit_batch(*batch, discount, use_reward, sample_weight=weights)
+                if prioritized:
+                    bot.memory.update_priorities(indices, td_errors)
+                with timer('log_append'):
+                    this_log.append_many({'Loss':history.history['loss'][0],
+                                          'Reward':batch[2],
+                                          'Epsilon':epsilon,
+                                          'Cash':env.cash[active].mean(),
+                                          'Shares':env.held()[active].mean()})
+            states = env.states()
+        log('episode', logging.INFO, episode=episode, survived=int((~env.done).sum()), envs=n)
+        this_log.flush()
+        action_log.flush()
+    return bot, this_log.to_frame(), action_log.to_frame()
 
-def Test(bot, scaler, test_data, state_vars, shares=0, start_cash=20000):
+def Test(bot, scaler, test_data, state_vars, shares=0, start_cash=20000, log_path=None):
     '''Notes of interest: This training procedure takes a cursor to train data, uses HER to
     Learn from past rewards. To summarize DQN, we just predict as we step through data.
     Periodically (I chose every replay_size steps), we fit on a batchsize of memories.
@@ -219,28 +449,33 @@ def Test(bot, scaler, test_data, state_vars, shares=0, start_cash=20000):
         shares: Number of starting stock shares for little bot
         cash: amount of starting cash
         replay_size: Batch size for HER
+        log_path: Optional directory, the log is flushed there in .npy segments (see recorder.py)
     '''
+    from instrument import timer, log
+    from features import cursor_features, FeatureWindows
+    from recorder import LogRecorder
     window = bot.NN_input_shape[0]
     # Create Log
-    portfolio_log = pd.DataFrame(columns = ['Value', 'Action', 'Shares', 'Cash', 'Profits', 'Close'])
+    portfolio_log = LogRecorder(['Value', 'Action', 'Shares', 'Cash', 'Profits', 'Close'], log_path)
     # Routine Setup
     options = ['buy', 'sell', 'hold']
-    state = np.zeros((1, window, len(state_vars) + 3))
+    # One pass over the cursor and one scaler call for the whole test period
+    with timer('db_fetch'):
+        features, closes = cursor_features(test_data, scaler, state_vars)
+    windows = FeatureWindows(features, window)
+    state = None
     share_prices = deque([]) # Time Com. of O(1) for left popping...
     cash = start_cash
     profits = 0
     count = 0
     done = False
-    for item in test_data:
-        curr_price = item['data']['close']
-        curr_change = item['data']['change']
+    for curr_price in closes:
         value = len(share_prices)*curr_price + cash
         # End Conditions (can't buy & can't sell)
         if cash < curr_price and len(share_prices) == 0:
             done = True
-        # Simple window: Have state going back in time, save that, shift down, ammend this step
+        # Window ending at the last bar. States are views into windows, nothing gets shifted
         previous_state = state
-        state[0][1:,:] = state[0][:-1, :]
         # Generating State Vars
         if cash > curr_price:
             can_buy = 1
@@ -251,15 +486,12 @@ def Test(bot, scaler, test_data, state_vars, shares=0, start_cash=20000):
         else:
             can_sell = 0
         cash_state = sigmoid(cash/start_cash)
-        # NOTE: Scaler Transform requires alphabetical columns for proper prediction
-        temp_state = [scaler.transform([[item['data'][j] for j in state_vars]])[0]]
-        temp_state = np.array([np.append(temp_state[0], can_buy)])
-        temp_state = np.array([np.append(temp_state[0], can_sell)])
-        temp_state = np.array([np.append(temp_state[0], cash_state)])
-        state[0][0,:] = temp_state
+        windows.set_portfolio(count, can_buy, can_sell, cash_state)
+        state = windows.state(count)
         if count >= window and not done: # Start Bot once state is full enough
-            actions = bot.predict(previous_state)
-            print('Actions: ', actions, '  ', np.argmax(actions), '\n')
+            with timer('predict'):
+                actions = bot.predict(previous_state)
+            log('actions', count=count, actions=actions.tolist(), action=int(np.argmax(actions)))
             action = np.argmax(actions)
             choice = options[action]
             # No Exploration
@@ -275,17 +507,19 @@ def Test(bot, scaler, test_data, state_vars, shares=0, start_cash=20000):
                     profits += curr_price - share_prices.popleft()
                 except IndexError:
                     done = True
-            portfolio_log = portfolio_log.append({'Value':value, 'Action':action, 'Shares':shares, 'Cash':cash, 'Profits':profits, 'Close':curr_price}, ignore_index = True)
+            with timer('log_append'):
+                portfolio_log.append({'Value':value, 'Action':action, 'Shares':shares, 'Cash':cash, 'Profits':profits, 'Close':curr_price})
         elif done:
-            print('Bot Died...')
+            log('died', logging.INFO, count=count)
             break
         count += 1
     else:
         '''Wow! It Made it!'''
-        print('The Bot Survived.')
-    return portfolio_log
+        log('survived', logging.INFO, count=count)
+    portfolio_log.flush()
+    return portfolio_log.to_frame()
 
-def Test_random(bot, test_data, shares=0, start_cash=20000):
+def Test_random(bot, test_data, shares=0, start_cash=20000, log_path=None):
     '''Notes of interest: This training procedure takes a cursor to train data, uses HER to
     Learn from past rewards. To summarize DQN, we just predict as we step through data.
     Periodically (I chose every replay_size steps), we fit on a batchsize of memories.
@@ -297,10 +531,13 @@ def Test_random(bot, test_data, shares=0, start_cash=20000):
         shares: Number of starting stock shares for little bot
         cash: amount of starting cash
         replay_size: Batch size for HER
+        log_path: Optional directory, the log is flushed there in .npy segments (see recorder.py)
     '''
+    from instrument import log
+    from recorder import LogRecorder
     window = bot.NN_input_shape[0]
     # Create Log
-    portfolio_log = pd.DataFrame(columns = ['Value', 'Action', 'Shares', 'Cash', 'Profits', 'Close'])
+    portfolio_log = LogRecorder(['Value', 'Action', 'Shares', 'Cash', 'Profits', 'Close'], log_path)
     # Routine Setup
     options = ['buy', 'sell', 'hold']
     share_prices = deque([]) # Time Com. of O(1) for left popping...
@@ -330,83 +567,21 @@ def Test_random(bot, test_data, shares=0, start_cash=20000):
                     profits += curr_price - share_prices.popleft()
                 except IndexError:
                     done = True
-            portfolio_log = portfolio_log.append({'Value':value, 'Action':action, 'Shares':shares, 'Cash':cash, 'Profits':profits, 'Close':curr_price}, ignore_index = True)
+            portfolio_log.append({'Value':value, 'Action':action, 'Shares':shares, 'Cash':cash, 'Profits':profits, 'Close':curr_price})
         elif done:
-            print('Bot Died...')
+            log('died', logging.INFO, count=count)
             break
         count += 1
     else:
         '''Wow! It Made it!'''
-        print('The Bot Survived.')
-    return portfolio_log
+        log('survived', logging.INFO, count=count)
+    portfolio_log.flush()
+    return portfolio_log.to_frame()
 
 if __name__ == "__main__":
-    import pandas as pd
-    from time import localtime, strftime
-    from keras.callbacks import TensorBoard
-    from sklearn.externals import joblib 
-    import matplotlib.pyplot as plt 
-    import seaborn as sns
-    import pickle
-    sys.path.append("./src")
-    from Bots import Bot_LSTM
-    from mongo import sstt_cursors
-    # Specifics (Note alphabetic...for scaler)
-    state_vars = ['change', 'close_vwap', 'high_low', 'open_close'] #, 'volume']
-    bot = Bot_LSTM((14, len(state_vars)+3))
-    scaler = joblib.load("resources/tech_scaler.pkl")
-    # The flow of train is to train a bot on a stock and get back the bot, with a PD.DataFrame log
-    # Ideally this would continue for numerous stocks for one bot.
-    
-    # Train
-    episodes = 3
-    symbol = 'MSFT'
-    bot, train_log, action_log = Train(bot, scaler, symbol, state_vars, episode_count=episodes, use_reward=True)
-    action_df = pd.DataFrame(action_log, columns = ['buy', 'sell', 'hold'])
-    # Test and Random Choice Test
-    _, test_cursor = sstt_cursors(symbol)
-    portfolio_log = Test(bot, scaler, test_cursor, state_vars)
-    _, test_cursor = sstt_cursors(symbol)
-    random_log = Test_random(bot, test_cursor)
-    #train_log.drop(columns = 'Unnamed: 0', inplace=True)
-    #bot.my_save('./output')
-    #save_output('train_{symbol}_LSTM_Softmax', train_log)
-    #save_output('test_{symbol}_LSTM_Softmax', portfolio_log)
-
-    # Plotting (Note: Softmax in title. If Activ. changed, change that)
-    plt.rcParams.update({'font.size': 12, 'figure.subplot.hspace':0.1})
-    fig, (ax1, ax2) = plt.subplots(2, 1, figsize = (11, 7), sharex=True)
-    sns.lineplot(data = train_log[['Reward', 'Loss', 'Epsilon']].astype('float'), ax=ax1, style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=3))
-    sns.lineplot(data = train_log['Shares'].astype('float'), ax=ax2, style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=3))
-    ax1.set_title('Training Model', fontsize=15)
-    ax2.set_xlabel('Timesteps', fontsize=15)
-    ax2.text(700, 9, 'Shares',
-        verticalalignment='top', horizontalalignment='right',
-        bbox={'facecolor':'blue', 'alpha':0.2, 'pad':10}, fontsize=15)
-    plt.savefig('plots/training_log_mse_c{}.png'.format(strftime("%Y-%m-%d{%H:%M}", localtime())))
-
-    plt.rcParams.update({'font.size': 12, 'figure.subplot.hspace':0.3})
-    fig, ax1 = plt.subplots(1, 1, figsize = (6, 6))
-    sns.lineplot(data = action_df.astype('float'), ax=ax1, style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=3))
-    ax1.set_title('Training Model', fontsize=15)
-    ax1.set_xlabel('Timesteps', fontsize=15)
-    fig.suptitle('Action Probabilities Through Time (Linear)', fontsize=22)
-    plt.savefig('plots/action_log_mse_c{}.png'.format(strftime("%Y-%m-%d{%H:%M}", localtime())), bbox_inches = 'tight')
-
-    plt.rcParams.update({'font.size': 12, 'figure.subplot.hspace':0.8})
-    fig, ax = plt.subplots(2, 1, figsize = (11, 8))
-    sns.lineplot(data = portfolio_log[['Shares', 'Profits']].astype('float'), ax=ax[0], style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=2))
-    sns.lineplot(data = random_log[['Shares', 'Profits']].astype('float'), ax=ax[1], style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=2))
-    ax[0].set_title('Trained Model', fontsize=15)
-    ax[1].set_title('Random Choice', fontsize=15)
-    ax[1].set_xlabel('Timesteps', fontsize=13)
-    plt.savefig('plots/shares_profits_mse_c{}.png'.format(strftime("%Y-%m-%d{%H:%M}", localtime())))
-
-    fig, ax = plt.subplots(2, 1, figsize = (11, 8))
-    sns.lineplot(data = portfolio_log[['Cash', 'Value']].astype('float'), ax=ax[0], style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=2))
-    sns.lineplot(data = random_log[['Cash', 'Value']].astype('float'), ax=ax[1], style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=2))
-    ax[0].set_title('Trained Model', fontsize=15)
-    ax[1].set_title('Random Choice', fontsize=15)
-    ax[1].set_xlabel('Timesteps', fontsize=13)
-    plt.savefig('plots/cash_value_mse_c{}.png'.format(strftime("%Y-%m-%d{%H:%M}", localtime())))
-    plt.show()
\ No newline at end of file
+    # The old all in one run (train MSFT, test, plot), now through the subcommands in cli.py
+    from cli import main
+    if len(sys.argv) > 1:
+        sys.exit(main())
+    main(['train', '--symbol', 'MSFT', '--episodes', '3', '--output', 'output/MSFT'])
+    main(['plot', 'output/MSFT', '--directory', 'plots', '--show'])
@@ -13,17 +13,23 @@ from time import localtime, strftime
 # remember()
 from collections import deque
 import random
+# Batched replay, kept out of this file so it imports without Keras (see bench.py)
+from replayer import Replayer
+
+
 
 '''Class Bot
 A Basic ANN that inherits from Keras Sequential and extends for reinforcement learning and
 hindsight experience replay support. 
 '''
-class Bot(Sequential):
+class Bot(Sequential, Replayer):
     '''See help(Sequential). Inheritance here from Keras Sequential()
     Notes: The ANN wants unwound data. For windowed state, it unwraps into a single instance.
     Parameters:
         NN_input_shape()
             This tuple must be compatible with the Sequential() input layer input_shape. 
+        memory
+            Optional replay memory (see memory.ReplayMemory), defaults to deque(maxlen=1000)
     Extra Methods: 
         remember() 
             The act of remembering one "event" for hindsight experience replay. See SARSA
@@ -32,15 +38,18 @@ class Bot(Sequential):
             autogenerated name including the current date
         replay()
             Using a batch_size, returns a collection of memories
+        replay_batch(), fit_batch()
+            Batched replay, see Replayer
     Returns: Instance of Sequential() with additional methods 
     '''
 
-    def __init__(self, NN_input_shape, action_space=3, weights_filename=None, verbose=True):
+    def __init__(self, NN_input_shape, action_space=3, weights_filename=None, verbose=True, memory=None):
         # Params
         self.NN_input_shape = NN_input_shape
         self.action_space = action_space
         self.verbose = verbose
-        self.memory = deque(maxlen=1000)
+        # memory.ReplayMemory for big, deduplicated memories. Default is the old deque
+        self.memory = memory if memory is not None else deque(maxlen=1000)
         # Init
         self.make()
         if weights_filename:
@@ -97,7 +106,7 @@ A basic recurrent neural network bot that inherits from Keras Sequential and ext
 for reinforcement learning and
 hindsight experience replay support. 
 '''
-class Bot_LSTM(Sequential):
+class Bot_LSTM(Sequential, Replayer):
     '''See help(Sequential). Inheritance here from Keras Sequential()
     Notes: Linear, MSE, Adam(lr=very low) would be used for RL
     Parameters:
@@ -105,6 +114,8 @@ class Bot_LSTM(Sequential):
             This tuple must be compatible with the Sequential() input layer input_shape. For LSTMs 
             this is always 3D data, you are responsible for the last two. Given (samples, timesteps, features)
             you should enter a tuple of (timesteps, features)
+        memory
+            Optional replay memory (see memory.ReplayMemory), defaults to deque(maxlen=1000)
     Extra Methods: 
         remember() 
             The act of remembering one "event" for hindsight experience replay. See SARSA
@@ -113,18 +124,21 @@ class Bot_LSTM(Sequential):
             autogenerated name including the current date
         replay()
             Using a batch_size, returns a collection of memories
+        replay_batch(), fit_batch()
+            Batched replay, see Replayer
     Returns: Instance of Sequential() with additional methods 
     '''
 
     from keras.layers import LSTM
     
-    def __init__(self, NN_input_shape, action_space=3, weights_filename=None, verbose=True):
+    def __init__(self, NN_input_shape, action_space=3, weights_filename=None, verbose=True, memory=None):
         # Params
         self.NN_input_shape = NN_input_shape
         self.action_space = action_space
         self.weights_filename = weights_filename
         self.verbose = verbose
-        self.memory = deque(maxlen=1000)
+        # memory.ReplayMemory for big, deduplicated memories. Default is the old deque
+        self.memory = memory if memory is not None else deque(maxlen=1000)
         # Init
         self.make()
         if weights_filename:
@@ -178,7 +192,7 @@ class Bot_LSTM(Sequential):
 A basic CNN to RNN with LSTM bot that inherits from Keras Sequential and extends 
 for reinforcement learning and hindsight experience replay support. 
 '''
-class Bot_CNN_LSTM(Sequential): # Didn't get there yet
+class Bot_CNN_LSTM(Sequential, Replayer): # Didn't get there yet
     '''See help(Sequential). Inheritance here from Keras Sequential()
     Notes: The CNNs want 2D data. Being in TD wrapper, need "features" wide by single tall input shape. 
     Parameters:
@@ -186,6 +200,8 @@ class Bot_CNN_LSTM(Sequential): # Didn't get there yet
             This tuple must be compatible with the Sequential() input layer input_shape. For LSTMs 
             this is always 3D data, you are responsible for the last two. Given (samples, timesteps, features)
             you should enter a tuple of (timesteps, features)
+        memory
+            Optional replay memory (see memory.ReplayMemory), defaults to deque(maxlen=1000)
     Extra Methods: 
         remember() 
             The act of remembering one "event" for hindsight experience replay. See SARSA
@@ -194,16 +210,19 @@ class Bot_CNN_LSTM(Sequential): # Didn't get there yet
             autogenerated name including the current date
         replay()
             Using a batch_size, returns a collection of memories
+        replay_batch(), fit_batch()
+            Batched replay, see Replayer
     Returns: Instance of Sequential() with additional methods 
     '''
     from keras.layers import LSTM, Conv2D, MaxPooling2D, TimeDistributed
-    def __init__(self, NN_input_shape, action_space=3, weights_filename=None, verbose=True):
+    def __init__(self, NN_input_shape, action_space=3, weights_filename=None, verbose=True, memory=None):
         # Params
         self.NN_input_shape = NN_input_shape
         self.action_space = action_space
         self.weights_filename = weights_filename
         self.verbose = verbose
-        self.memory = deque(maxlen=1000)
+        # memory.ReplayMemory for big, deduplicated memories. Default is the old deque
+        self.memory = memory if memory is not None else deque(maxlen=1000)
         # Init
         self.make()
         if weights_filename:
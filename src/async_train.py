@@ -0,0 +1,212 @@
+'''
+Asynchronous DQN training. In main.Train acting stops every replay_size bars while the fit runs,
+and Q(s') comes from the network being fit. Here an actor loop steps a vec_env.VecTradingEnv and
+pushes transitions while a Learner thread samples the bot's memory and fits without pause.
+A frozen target network, copied from the bot every sync_every fits, gives Q(s') for the updates
+and also serves the actor's predicts, so the actor never waits on a fit.
+Locking: one lock around the replay memory (the actor's env.step/reset vs the learner's
+sample/gather/update_priorities) and one around the target network (predicts vs the weight swap).
+The online bot is only ever touched by the learner thread.
+'''
+
+import time
+import logging
+import threading
+import numpy as np
+
+def make_target(bot):
+    '''Given a bot, a same-architecture copy of it with the same weights (no memory, not compiled).'''
+    from keras.models import clone_model
+    target = clone_model(bot)
+    target.set_weights(bot.get_weights())
+    return target
+
+'''Class LockedModel
+Wraps a model shared between threads, predict() and set_weights() take the same lock.
+'''
+class LockedModel():
+    def __init__(self, model, lock=None):
+        self.model = model
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def predict(self, states):
+        with self.lock:
+            return self.model.predict(states)
+
+    def set_weights(self, weights):
+        with self.lock:
+            self.model.set_weights(weights)
+'''End LockedModel Class'''
+
+'''Class Learner
+Background thread that keeps fitting the bot on batches from its memory, against the target
+network. It never gets more than replay_ratio sampled transitions ahead of what the actor added,
+so a slow actor can't make it overfit a stale memory.
+'''
+class Learner(threading.Thread):
+    '''Parameters:
+        bot
+            Bot with fit_batch() (see replayer.Replayer) and a memory.ReplayMemory as bot.memory
+        target
+            LockedModel around make_target(bot)
+        memory_lock
+            Lock the actor holds while it writes bot.memory
+        batch_size, discount, use_reward
+            Like replay_size, discount, use_reward in main.Train
+        sync_every
+            Fits between copies of the bot's weights into the target
+        replay_ratio
+            Sampled transitions allowed per transition added
+        log
+            Optional recorder.LogRecorder with Train's columns, one row per replayed transition
+    Methods:
+        added()
+            Actor side, n new transitions are in the memory
+        stop()
+            Finish the current fit and end the thread
+    '''
+
+    def __init__(self, bot, target, memory_lock, batch_size=32, discount=0.01, use_reward=True,
+                 sync_every=100, replay_ratio=1.0, log=None):
+        super().__init__(daemon=True)
+        from memory import PrioritizedReplayMemory
+        self.bot = bot
+        self.memory = bot.memory
+        self.prioritized = isinstance(bot.memory, PrioritizedReplayMemory)
+        self.target = target
+        self.memory_lock = memory_lock
+        self.batch_size = batch_size
+        self.discount = discount
+        self.use_reward = use_reward
+        self.sync_every = sync_every
+        self.replay_ratio = replay_ratio
+        self.log = log
+        # Actor's latest epsilon/cash/shares for the log, plain floats so reads need no lock
+        self.status = {'Epsilon': 1.0, 'Cash': 0.0, 'Shares': 0.0}
+        self.fits = 0
+        self.syncs = 0
+        self.transitions = 0
+        self.error = None
+        self._wake = threading.Condition()
+        self._stopped = False
+
+    def added(self, n):
+        with self._wake:
+            self.transitions += n
+            self._wake.notify()
+
+    def stop(self):
+        with self._wake:
+            self._stopped = True
+            self._wake.notify()
+
+    def _ready(self):
+        return len(self.memory) >= self.batch_size and \
+            (self.fits + 1)*self.batch_size <= self.replay_ratio*self.transitions
+
+    def run(self):
+        try:
+            while True:
+                with self._wake:
+                    while not (self._stopped or self._ready()):
+                        self._wake.wait()
+                    if self._stopped:
+                        return
+                self.fit_once()
+        except Exception as error:
+            # Surfaced on the actor side, see check()
+            self.error = error
+
+    def check(self):
+        '''Re-raises a learner failure in the calling (actor) thread.'''
+        if self.error is not None:
+            raise self.error
+
+    def fit_once(self):
+        import instrument
+        from instrument import timer
+        instrument.count('replays')
+        with self.memory_lock, timer('replay_sample'):
+            indices = self.memory.sample_indices(self.batch_size)
+            batch = self.memory.gather(indices)
+            weights = self.memory.importance_weights(indices) if self.prioritized else None
+        with timer('fit'):
+            history, td_errors = self.bot.fit_batch(*batch, self.discount, self.use_reward,
+                                                    sample_weight=weights, target=self.target)
+        if self.prioritized:
+            with self.memory_lock:
+                self.memory.update_priorities(indices, td_errors)
+        self.fits += 1
+        if self.log is not None:
+            row = {'Loss': history.history['loss'][0], 'Reward': batch[2]}
+            row.update(self.status)
+            self.log.append_many(row)
+        if self.fits % self.sync_every == 0:
+            self.sync()
+
+    def sync(self):
+        '''Copies the bot's weights into the target network.'''
+        self.target.set_weights(self.bot.get_weights())
+        self.syncs += 1
+'''End Learner Class'''
+
+def Train_async(bot, scaler, symbols, state_vars, episode_count=3, offsets=(0,), shares=0, start_cash=20000,
+                replay_size=32, use_reward=False, sync_every=100, replay_ratio=1.0, capacity=100000,
+                discount=0.01, epsilon_decay=0.0005, log_path=None):
+    '''Like main.Train_vec, with the fits moved to a Learner thread and the actor acting on the
+    target network.
+    Parameters:
+        bot, scaler, symbols, state_vars, episode_count, offsets, shares, start_cash, use_reward,
+            capacity, discount, epsilon_decay, log_path: See main.Train_vec
+        replay_size: Batch size of every fit
+        sync_every: Fits between target network syncs
+        replay_ratio: Sampled transitions per new transition, Train replays 1 (one batch every replay_size bars)
+    Returns: bot, training log DataFrame, stats dict (steps, transitions, fits, syncs, seconds, steps_per_sec)
+    '''
+    from instrument import timer, log
+    from memory import ReplayMemory
+    from recorder import LogRecorder
+    from vec_env import VecTradingEnv
+    window = bot.NN_input_shape[0]
+    n = len(symbols)*len(offsets)
+    if not (isinstance(bot.memory, ReplayMemory) and bot.memory.streams == n):
+        bot.memory = ReplayMemory(window, bot.NN_input_shape[1], capacity, streams=n)
+    memory_lock = threading.Lock()
+    target = LockedModel(make_target(bot))
+    env = VecTradingEnv.from_symbols(symbols, scaler, state_vars, window, offsets, shares=shares,
+                                     start_cash=start_cash, use_reward=use_reward, memory=bot.memory)
+    this_log = LogRecorder(['Loss', 'Reward', 'Epsilon', 'Cash', 'Shares'], log_path)
+    learner = Learner(bot, target, memory_lock, replay_size, discount=discount, use_reward=use_reward,
+                      sync_every=sync_every, replay_ratio=replay_ratio, log=this_log)
+    # Routine Setup
+    epsilon = 1
+    steps = 0
+    start = time.time()
+    learner.start()
+    try:
+        for episode in range(episode_count):
+            with memory_lock:
+                states = env.reset()
+            while env.active.any():
+                learner.check()
+                with timer('predict'):
+                    actions = target.predict(states)
+                explore = np.random.random_sample(n) < epsilon
+                chosen = np.where(explore, np.random.randint(0, actions.shape[1], size=n), np.argmax(actions, axis=1))
+                epsilon = max(epsilon - epsilon_decay, 0.01)
+                with memory_lock:
+                    _, _, stepped = env.step(chosen)
+                learner.status = {'Epsilon': epsilon, 'Cash': env.cash[stepped].mean(), 'Shares': env.held()[stepped].mean()}
+                learner.added(int(stepped.sum()))
+                steps += 1
+                states = env.states()
+            log('episode', logging.INFO, episode=episode, survived=int((~env.done).sum()), envs=n, fits=learner.fits)
+    finally:
+        learner.stop()
+        learner.join()
+    learner.check()
+    seconds = time.time() - start
+    this_log.flush()
+    stats = {'steps': steps, 'transitions': learner.transitions, 'fits': learner.fits, 'syncs': learner.syncs,
+             'seconds': seconds, 'steps_per_sec': steps/seconds if seconds else 0.0}
+    return bot, this_log.to_frame(), stats
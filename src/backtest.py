@@ -0,0 +1,238 @@
+'''
+Vectorized backtests. main.Test calls bot.predict once per bar and main.Test_random steps a cursor
+in Python, they stay as the slow reference implementations. Here every window of the test period
+is scored in batched predict calls and only the cash/shares/FIFO accounting is a sequential pass.
+Random choice runs handle thousands of seeds at once as (seeds, bars) arrays.
+
+Why batching is exact: the decision at bar t reads the window ending at t-1, whose portfolio
+columns only depend on trades up to t-2. So assuming "no trade from here on" gives the right
+inputs for every bar up to one past the next trade. Each speculative batch is used until a trade
+actually happens and is then re-scored from there, so a bot that mostly holds costs a handful of
+predicts for years of data, and the result is identical to main.Test.
+'''
+
+import numpy as np
+
+log_columns = ['Value', 'Action', 'Shares', 'Cash', 'Profits', 'Close']
+options = ['buy', 'sell', 'hold']
+
+def sigmoid(x):
+    return 1/(1+np.exp(-x))
+
+def backtest(bot, features, closes, shares=0, start_cash=20000, horizon=256):
+    '''Same rules as main.Test (no exploration, buy/sell one share, FIFO profits), with
+    speculative batched scoring (see module notes).
+    Parameters: bot (anything with predict() and NN_input_shape), features (scaled, see features.py),
+        closes, shares, start_cash, horizon (max bars scored per predict call)
+    Returns: dict with the main.Test log columns as arrays, plus 'predicts' (predict calls made)
+        and 'survived'
+    '''
+    from collections import deque
+    from features import FeatureWindows
+    window = bot.NN_input_shape[0]
+    windows = FeatureWindows(features, window)
+    all_windows = windows.windows()
+    market = windows.n_market
+    log = {name: [] for name in log_columns}
+    share_prices = deque([])
+    cash = start_cash
+    profits = 0
+    done = False
+    survived = True
+    predicts = 0
+    # Scored bars [q_start, q_stop) are valid as long as no trade happened in between
+    q = None
+    q_start = q_stop = 0
+    for count in range(len(closes)):
+        curr_price = closes[count]
+        value = len(share_prices)*curr_price + cash
+        # End Conditions (can't buy & can't sell)
+        if cash < curr_price and len(share_prices) == 0:
+            done = True
+        windows.set_portfolio(count, cash > curr_price, len(share_prices) >= 1, sigmoid(cash/start_cash))
+        if count >= window and not done:
+            if not q_start <= count < q_stop:
+                q_start, q_stop = count, min(len(closes), count + horizon)
+                # Portfolio rows ahead as if nothing is traded from here on
+                ahead = closes[count + 1:q_stop]
+                windows.buffer[count + 1:q_stop, market] = cash > ahead
+                windows.buffer[count + 1:q_stop, market + 1] = len(share_prices) >= 1
+                windows.buffer[count + 1:q_stop, market + 2] = sigmoid(cash/start_cash)
+                # Decision at bar k reads the window ending at k - 1, which is all_windows[k - window]
+                q = bot.predict(all_windows[q_start - window:q_stop - window])
+                predicts += 1
+            action = int(np.argmax(q[count - q_start]))
+            choice = options[action]
+            traded = False
+            if choice == 'buy' and cash > curr_price:
+                cash -= curr_price
+                shares += 1
+                share_prices.append(curr_price)
+                traded = True
+            elif choice == 'sell' and shares > 0:
+                cash += curr_price
+                shares -= 1
+                traded = True
+                try:
+                    profits += curr_price - share_prices.popleft()
+                except IndexError:
+                    done = True
+            if traded:
+                # The next bar's decision is still exact, anything after needs rescoring
+                q_stop = min(q_stop, count + 2)
+            for name, item in zip(log_columns, [value, action, shares, cash, profits, curr_price]):
+                log[name].append(item)
+        elif done:
+            survived = False
+            break
+    result = {name: np.array(values, dtype=np.float64) for name, values in log.items()}
+    result['predicts'] = predicts
+    result['survived'] = survived
+    return result
+
+def summarize(result, closes, start_cash=20000):
+    '''Given a backtest() result and the closes it ran on, the numbers a run is judged by.
+    Returns: dict of bars, trades, final_value, profits, return, survived
+    '''
+    actions = result['Action']
+    if len(actions):
+        # Value is logged before the bar's trade, mark the last position to the last close instead
+        final_value = float(result['Shares'][-1]*closes[-1] + result['Cash'][-1])
+        profits = float(result['Profits'][-1])
+    else:
+        final_value, profits = float(start_cash), 0.0
+    return _summary(actions, final_value, profits, result['survived'], start_cash)
+
+def summarize_random(result, i, start_cash=20000):
+    '''Given a random_backtest() result and a seed row, summarize() of that seed's run.
+    Returns: dict of bars, trades, final_value, profits, return, survived
+    '''
+    actions = result['Action'][i][result['logged'][i]]
+    return _summary(actions, float(result['final_value'][i]), float(result['final_profits'][i]),
+                    result['survived'][i], start_cash)
+
+def _summary(actions, final_value, profits, survived, start_cash):
+    return {'bars': int(len(actions)), 'trades': int(np.count_nonzero(actions != 2)),
+            'final_value': final_value, 'profits': profits, 'return': final_value/start_cash - 1,
+            'survived': bool(survived)}
+
+def random_actions(seeds, bars, window, match_reference=False):
+    '''Action matrix for random choice runs, one row per seed.
+    With match_reference, row s is what random.seed(s) followed by main.Test_random would draw
+    (slow, Python's random). Otherwise each seed gets its own np.random.RandomState.
+    Returns: int array of shape (len(seeds), bars), meaningless before the window
+    '''
+    actions = np.full((len(seeds), bars), 2, dtype=np.int64)
+    for i, seed in enumerate(seeds):
+        if match_reference:
+            import random
+            state = random.Random(seed)
+            actions[i, window:] = [state.randrange(len(options)) for _ in range(bars - window)]
+        else:
+            actions[i, window:] = np.random.RandomState(seed).randint(0, len(options), size=max(bars - window, 0))
+    return actions
+
+def random_backtest(closes, window, seeds=(0,), shares=0, start_cash=20000, actions=None, match_reference=False):
+    '''main.Test_random for many seeds at once. Every seed is a row, the loop is over bars only.
+    Parameters: closes, window, seeds, shares, start_cash, actions (preset (seeds, bars) matrix,
+        otherwise random_actions()), match_reference (see random_actions)
+    Returns: dict of (seeds, bars) arrays for the log columns (NaN where nothing was logged),
+        'logged' mask, and per seed 'final_value', 'final_profits', 'survived'
+    '''
+    closes = np.asarray(closes, dtype=np.float64)
+    bars = len(closes)
+    if actions is None:
+        actions = random_actions(seeds, bars, window, match_reference)
+    runs = len(actions)
+    cash = np.full(runs, float(start_cash))
+    held = np.full(runs, float(shares))
+    # FIFO of buy prices per seed: buys are appended at n_bought, sells pop at n_sold
+    buy_prices = np.zeros((runs, bars))
+    n_bought = np.zeros(runs, dtype=np.int64)
+    n_sold = np.zeros(runs, dtype=np.int64)
+    profits = np.zeros(runs)
+    done = np.zeros(runs, dtype=bool)
+    alive = np.ones(runs, dtype=bool)
+    out = {name: np.full((runs, bars), np.nan) for name in log_columns}
+    logged = np.zeros((runs, bars), dtype=bool)
+    rows = np.arange(runs)
+    for count in range(bars):
+        curr_price = closes[count]
+        fifo = n_bought - n_sold
+        value = fifo*curr_price + cash
+        # End Conditions (can't buy & can't sell), a run that is done stops here
+        done |= alive & (cash < curr_price) & (fifo == 0)
+        alive &= ~done
+        if count < window:
+            continue
+        action = actions[:, count]
+        buy = alive & (action == 0) & (cash > curr_price)
+        sell = alive & (action == 1) & (held > 0)
+        cash[buy] -= curr_price
+        held[buy] += 1
+        buy_prices[rows[buy], n_bought[buy]] = curr_price
+        n_bought[buy] += 1
+        cash[sell] += curr_price
+        held[sell] -= 1
+        popped = sell & (fifo > 0)
+        profits[popped] += curr_price - buy_prices[rows[popped], n_sold[popped]]
+        n_sold[popped] += 1
+        done |= sell & (fifo == 0)
+        for name, item in zip(log_columns, [value, action, held, cash, profits, curr_price]):
+            out[name][alive, count] = item[alive] if np.ndim(item) else item
+        logged[alive, count] = True
+    out['logged'] = logged
+    out['final_value'] = (n_bought - n_sold)*closes[-1] + cash if bars else cash
+    out['final_profits'] = profits
+    out['survived'] = alive
+    return out
+
+def run_backtest(bot, scaler, test_data, state_vars, shares=0, start_cash=20000, horizon=256):
+    '''Drop in for main.Test, same arguments and the same DataFrame back.'''
+    import pandas as pd
+    from features import cursor_features
+    features, closes = cursor_features(test_data, scaler, state_vars)
+    result = backtest(bot, features, closes, shares, start_cash, horizon)
+    return pd.DataFrame({name: result[name] for name in log_columns}, columns=log_columns)
+
+def seed_frame(result, i):
+    '''Given a random_backtest result and a seed row, returns it like main.Test_random does.'''
+    import pandas as pd
+    mask = result['logged'][i]
+    return pd.DataFrame({name: result[name][i][mask] for name in log_columns}, columns=log_columns)
+
+def check_against_reference(bot, scaler, test_data, state_vars, seeds=(0, 1, 2)):
+    '''Runs the slow main.Test/main.Test_random next to the vectorized versions.
+    Returns: dict of name -> bool (logs equal)
+    '''
+    import os
+    import sys
+    import random
+    # main.py sits one level up from src
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from main import Test, Test_random
+    test_data = list(test_data)
+    checks = {'Test': Test(bot, scaler, test_data, state_vars).equals(run_backtest(bot, scaler, test_data, state_vars))}
+    closes = [item['data']['close'] for item in test_data]
+    result = random_backtest(closes, bot.NN_input_shape[0], seeds, match_reference=True)
+    for i, seed in enumerate(seeds):
+        random.seed(seed)
+        reference = Test_random(bot, test_data)
+        checks['Test_random seed {}'.format(seed)] = np.allclose(reference.values.astype(float), seed_frame(result, i).values)
+    return checks
+
+if __name__ == "__main__":
+    '''NOTE: Compares against the reference loops on a synthetic random walk, no DB needed'''
+    class LinearBot():
+        NN_input_shape = (14, 7)
+        def __init__(self):
+            self.weights = np.random.RandomState(0).normal(size=(7, 3))
+        def predict(self, states):
+            return np.asarray(states)[:, 0, :] @ self.weights
+    class IdentityScaler():
+        def transform(self, raw):
+            return np.asarray(raw, dtype=np.float64)
+    walk = 100 + np.cumsum(np.random.RandomState(1).normal(size=1000))
+    test_data = [{'data': {'change': c, 'close_vwap': 0.1, 'high_low': 1.0, 'open_close': -0.2, 'close': p}}
+                 for c, p in zip(np.r_[0, np.diff(walk)], walk)]
+    print(check_against_reference(LinearBot(), IdentityScaler(), test_data, ['change', 'close_vwap', 'high_low', 'open_close']))
@@ -0,0 +1,442 @@
+'''
+Offline benchmarks. Builds a synthetic market of documents in the shape iex.make_doc_from_API
+stores (random walk bars fed through iex.build_document), serves them through db.configure and a
+throwaway column cache, and times the hot paths: queries, Train, Test, Test_random (and their
+vectorized versions) and replay. No MongoDB server and no IEX key, only numpy and pandas.
+Keras is only needed with --bot keras, mongomock only with --store mongomock.
+NOTE: MemoryClient is a small in-memory stand-in for the aggregation stages this repo uses.
+mongomock copies the whole document for every $unwind row, which would swamp the query timings.
+Results are one JSON document, so runs from different versions can be diffed.
+'''
+
+import os
+import io
+import sys
+import copy
+import json
+import time
+import platform
+import tempfile
+import contextlib
+import tracemalloc
+import numpy as np
+from replayer import Replayer
+
+state_vars = ['change', 'close_vwap', 'high_low', 'open_close']
+
+def synthetic_chart(bars, seed=0, start_price=100.0, start_date='2014-01-02'):
+    '''Random walk daily bars like the IEX /chart response (date, open, high, low, close, volume,
+    change, vwap), business days only.
+    Returns: list of dicts
+    '''
+    rng = np.random.RandomState(seed)
+    closes = start_price*np.exp(np.cumsum(rng.normal(0.0003, 0.015, size=bars)))
+    opens = np.r_[start_price, closes[:-1]]*np.exp(rng.normal(0, 0.004, size=bars))
+    highs = np.maximum(opens, closes)*(1 + np.abs(rng.normal(0, 0.006, size=bars)))
+    lows = np.minimum(opens, closes)*(1 - np.abs(rng.normal(0, 0.006, size=bars)))
+    vwaps = (highs + lows + closes)/3
+    volumes = rng.lognormal(16, 0.4, size=bars).astype(np.int64)
+    dates = np.busday_offset(np.datetime64(start_date, 'D'), np.arange(bars), roll='forward')
+    changes = np.diff(np.r_[start_price, closes])
+    return [{'date': str(d), 'open': float(o), 'high': float(h), 'low': float(l), 'close': float(c),
+             'volume': int(v), 'change': float(ch), 'vwap': float(w)}
+            for d, o, h, l, c, v, ch, w in zip(dates, opens, highs, lows, closes, volumes, changes, vwaps)]
+
+def synthetic_document(symbol, bars, seed=0):
+    '''One stock document exactly like make_doc_from_API builds it, from synthetic_chart().'''
+    from iex import build_document
+    summary = {'symbol': symbol, 'companyName': 'Synthetic {}'.format(symbol), 'description': '',
+               'CEO': '', 'sector': 'Synthetic', 'tags': []}
+    with contextlib.redirect_stdout(io.StringIO()):
+        return build_document(summary, synthetic_chart(bars, seed), '{}y'.format(max(1, round(bars/251))))
+
+def _get(document, path):
+    '''Dotted path lookup, a list along the way gives the list of values under it.'''
+    value = document
+    for key in path.split('.'):
+        if isinstance(value, list):
+            value = [item.get(key) for item in value]
+        elif isinstance(value, dict):
+            value = value.get(key)
+        else:
+            return None
+    return value
+
+def _matches(document, query):
+    for path, condition in query.items():
+        value = _get(document, path)
+        if isinstance(condition, dict) and '$in' in condition:
+            if value not in condition['$in']:
+                return False
+        elif isinstance(condition, dict) and '$gt' in condition:
+            if value is None or not value > condition['$gt']:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+def _expression(document, expression):
+    '''Evaluates the handful of aggregation expressions mongo.py and db.py use.'''
+    if isinstance(expression, str) and expression.startswith('$'):
+        return _get(document, expression[1:])
+    if not isinstance(expression, dict):
+        return expression
+    (op, argument), = expression.items()
+    if op in ('$size', '$max', '$min', '$toInt', '$isNumber'):
+        value = _expression(document, argument)
+        if op == '$size':
+            return len(value)
+        if op == '$toInt':
+            return int(value)
+        if op == '$isNumber':
+            return isinstance(value, (int, float)) and not isinstance(value, bool)
+        values = [item for item in value if item is not None]
+        if not values:
+            return None
+        return max(values) if op == '$max' else min(values)
+    values = [_expression(document, item) for item in argument]
+    if op == '$multiply':
+        return float(np.prod(values))
+    if op == '$round':
+        return float(round(values[0], values[1] if len(values) > 1 else 0))
+    if op == '$slice':
+        return values[0][:values[1]] if values[1] >= 0 else values[0][values[1]:]
+    if op == '$cond':
+        return values[1] if values[0] else values[2]
+    raise NotImplementedError(op)
+
+def _project(document, projection):
+    out = {}
+    nested = {}
+    for path, spec in projection.items():
+        if isinstance(spec, dict):
+            out[path] = _expression(document, spec)
+        elif spec and path != '_id':
+            top, _, rest = path.partition('.')
+            nested.setdefault(top, []).append(rest)
+    for top, rests in nested.items():
+        value = document.get(top)
+        if all(rests) and isinstance(value, list):
+            value = [{key: item[key] for key in rests if key in item} for item in value]
+        elif all(rests) and isinstance(value, dict):
+            value = {key: value[key] for key in rests if key in value}
+        out[top] = value
+    return out
+
+def _group(items, spec):
+    groups = {}
+    for item in items:
+        key = _expression(item, spec['_id'])
+        group = groups.setdefault(key, {'_id': key})
+        for name, accumulator in spec.items():
+            if name == '_id':
+                continue
+            (op, argument), = accumulator.items()
+            value = _expression(item, argument)
+            if op == '$sum':
+                group[name] = group.get(name, 0) + value
+            elif op in ('$avg', '$stdDevPop'):
+                # Raw values for now, reduced once every item is in
+                group.setdefault(name, []).append(value)
+            elif value is not None:
+                if op == '$max':
+                    group[name] = value if group.get(name) is None else max(group[name], value)
+                elif op == '$min':
+                    group[name] = value if group.get(name) is None else min(group[name], value)
+                else:
+                    raise NotImplementedError(op)
+            else:
+                group.setdefault(name, None)
+    for group in groups.values():
+        for name, accumulator in spec.items():
+            op = next(iter(accumulator)) if isinstance(accumulator, dict) else None
+            if op in ('$avg', '$stdDevPop'):
+                values = [value for value in group[name] if isinstance(value, (int, float))]
+                if not values:
+                    group[name] = None
+                else:
+                    group[name] = float(np.mean(values) if op == '$avg' else np.std(values))
+    return list(groups.values())
+
+'''Class MemoryCollection
+Plain list of documents with the collection methods db.py calls ($match, $project, $unwind,
+$sort and a $group with $max/$min/$sum/$avg/$stdDevPop in aggregate).
+'''
+class MemoryCollection():
+    def __init__(self):
+        self.documents = []
+
+    def insert_many(self, documents, ordered=False):
+        self.documents.extend(copy.deepcopy(list(documents)))
+
+    def find(self, query=None):
+        return [document for document in self.documents if _matches(document, query or {})]
+
+    def create_index(self, *args, **kwargs):
+        return None
+
+    def aggregate(self, pipeline, **kwargs):
+        items = self.documents
+        for stage in pipeline:
+            (op, argument), = stage.items()
+            if op == '$match':
+                items = [item for item in items if _matches(item, argument)]
+            elif op == '$project':
+                items = [_project(item, argument) for item in items]
+            elif op == '$unwind':
+                field = argument.lstrip('$')
+                # Shallow copies, the unwound rows share the nested dicts
+                items = [dict(item, **{field: value}) for item in items for value in item[field]]
+            elif op == '$sort':
+                for path, direction in reversed(list(argument.items())):
+                    items = sorted(items, key=lambda item: _get(item, path), reverse=direction < 0)
+            elif op == '$group':
+                items = _group(items, argument)
+            else:
+                raise NotImplementedError(op)
+        return iter(items)
+'''End MemoryCollection Class'''
+
+class MemoryClient():
+    '''client[database][collection] -> MemoryCollection, enough for db.configure(client=...)'''
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, database):
+        client = self
+        class Database():
+            def __getitem__(self, collection):
+                return client.collections.setdefault((database, collection), MemoryCollection())
+        return Database()
+
+    def close(self):
+        pass
+
+class MeanStdScaler():
+    '''Stand in for the StandardScaler in tech_scaler.pkl, fit on the synthetic market.'''
+    def fit(self, raw):
+        self.mean_ = raw.mean(axis=0)
+        self.scale_ = raw.std(axis=0) + 1e-12
+        return self
+
+    def transform(self, raw):
+        return (np.asarray(raw, dtype=np.float64) - self.mean_)/self.scale_
+
+class _History():
+    def __init__(self, loss):
+        self.history = {'loss': [loss]}
+
+class BenchBot(Replayer):
+    '''Linear Q function in NumPy with the bot interface Train/Test use (predict, fit, fit_batch,
+    NN_input_shape, memory). Keeps Keras out of the timings of the loops themselves, replay is
+    the bots' own Replayer.
+    '''
+    def __init__(self, NN_input_shape, action_space=3, memory=None, seed=0):
+        from collections import deque
+        self.NN_input_shape = NN_input_shape
+        self.action_space = action_space
+        self.memory = memory if memory is not None else deque(maxlen=1000)
+        self.weights = np.random.RandomState(seed).normal(0, 0.1, size=(int(np.prod(NN_input_shape)), action_space))
+
+    def predict(self, states):
+        states = np.asarray(states)
+        return states.reshape(len(states), -1) @ self.weights
+
+    def get_weights(self):
+        return [self.weights]
+
+    def set_weights(self, weights):
+        self.weights = np.array(weights[0])
+
+    def fit(self, states, targets, batch_size=None, epochs=1, shuffle=False, sample_weight=None, lr=1e-3):
+        x = np.asarray(states).reshape(len(states), -1)
+        error = x @ self.weights - targets
+        if sample_weight is not None:
+            error = error*np.asarray(sample_weight)[:, np.newaxis]
+        self.weights -= lr*x.T @ error/len(x)
+        return _History(float(np.mean(error**2)))
+
+def make_bot(kind, window, memory=None):
+    if kind == 'keras':
+        from Bots import Bot_LSTM
+        return Bot_LSTM((window, len(state_vars) + 3), verbose=False, memory=memory)
+    return BenchBot((window, len(state_vars) + 3), memory=memory)
+
+@contextlib.contextmanager
+def quiet():
+    '''Whatever still prints (Bots.py building a model, save_bot, a caller's print()) stays out of the timings.'''
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def measure(function, *args, trace=True, **kwargs):
+    '''Times one run of function, then (with trace) runs it again under tracemalloc for the
+    peak, tracing slows Python down too much to time the same run.
+    Returns: result, {'seconds'} plus 'peak_mb' with trace
+    '''
+    start = time.perf_counter()
+    with quiet():
+        result = function(*args, **kwargs)
+    stats = {'seconds': time.perf_counter() - start}
+    if trace:
+        tracemalloc.start()
+        try:
+            with quiet():
+                function(*args, **kwargs)
+            stats['peak_mb'] = tracemalloc.get_traced_memory()[1]/2**20
+        finally:
+            tracemalloc.stop()
+    return result, stats
+
+def setup_market(symbols, bars, seed=0, directory=None, store='memory'):
+    '''Fresh in-memory DB (MemoryClient, or mongomock with store='mongomock') holding one
+    synthetic document per symbol, an empty column cache in directory and every per-process
+    memo cleared.
+    Returns: fitted MeanStdScaler
+    '''
+    import db
+    import cache
+    import mongo
+    import features
+    if store == 'mongomock':
+        import mongomock
+        db.configure(client=mongomock.MongoClient())
+    else:
+        db.configure(client=MemoryClient())
+    db.insert_many([synthetic_document(symbol, bars, seed + i) for i, symbol in enumerate(symbols)])
+    db.ensure_indexes()
+    cache.cache_dir = directory or tempfile.mkdtemp(prefix='bench_cache_')
+    cache._CHECKED.clear()
+    mongo.clear_sstt_memo()
+    features.clear_feature_cache()
+    raw = np.array([[bar[name] for name in state_vars] for doc in db.stocks_collection().find() for bar in doc['data']])
+    return MeanStdScaler().fit(raw)
+
+def bench_queries(symbols, repeats=3):
+    import cache
+    import mongo
+    results = {}
+    symbol = symbols[0]
+    times = []
+    for _ in range(repeats):
+        mongo.clear_sstt_memo()
+        _, stats = measure(lambda: [list(cursor) for cursor in mongo.sstt_cursors(symbol, use_cache=False, state_vars=state_vars)], trace=False)
+        times.append(stats['seconds'])
+    results['sstt_cursors_mongo_seconds'] = min(times)
+    cache._CHECKED.clear()
+    _, stats = measure(cache.warm_cache, symbols, trace=False)
+    results['warm_cache_seconds'] = stats['seconds']
+    times = []
+    for _ in range(repeats):
+        mongo.clear_sstt_memo()
+        _, stats = measure(mongo.sstt_arrays, symbol, 0.40, state_vars + ['close'], trace=False)
+        times.append(stats['seconds'])
+    results['sstt_arrays_cache_seconds'] = min(times)
+    return results
+
+def bench_loops(symbol, scaler, bot_kind='numpy', window=14, episodes=1, seeds=64):
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from main import Train, Test, Test_random
+    from memory import ReplayMemory
+    from mongo import sstt_cursors
+    from backtest import run_backtest, random_backtest
+    from features import market_features
+    results = {}
+    train_bars = len(market_features(symbol, scaler, state_vars, split='train')[1])
+    test_bars = len(market_features(symbol, scaler, state_vars, split='test')[1])
+    train_steps = max(train_bars - window, 0)*episodes
+    test_steps = max(test_bars - window, 0)
+    variants = [('train_deque', dict(batched_replay=False), None),
+                ('train_deque_batched', dict(batched_replay=True), None),
+                ('train_replay_memory', dict(), ReplayMemory(window, len(state_vars) + 3, 100000))]
+    for name, kwargs, memory in variants:
+        bot = make_bot(bot_kind, window, memory)
+        _, stats = measure(Train, bot, scaler, symbol, state_vars, episode_count=episodes, use_reward=True, **kwargs)
+        stats['steps_per_sec'] = train_steps/stats['seconds']
+        results[name] = stats
+    bot = make_bot(bot_kind, window)
+    _, test_cursor = sstt_cursors(symbol)
+    _, stats = measure(Test, bot, scaler, test_cursor, state_vars)
+    stats['steps_per_sec'] = test_steps/stats['seconds']
+    results['test'] = stats
+    _, stats = measure(run_backtest, bot, scaler, test_cursor, state_vars)
+    stats['steps_per_sec'] = test_steps/stats['seconds']
+    results['test_vectorized'] = stats
+    _, stats = measure(Test_random, bot, test_cursor)
+    stats['steps_per_sec'] = test_steps/stats['seconds']
+    results['test_random'] = stats
+    closes = market_features(symbol, scaler, state_vars, split='test')[1]
+    _, stats = measure(random_backtest, closes, window, range(seeds))
+    stats['steps_per_sec'] = test_steps*seeds/stats['seconds']
+    stats['seeds'] = seeds
+    results['test_random_vectorized'] = stats
+    return results
+
+def bench_replay(bot_kind='numpy', window=14, batch_size=32, transitions=50000, repeats=200, seed=0):
+    '''Sample + gather + fit_batch latency on a full ReplayMemory, in milliseconds.'''
+    from memory import ReplayMemory, PrioritizedReplayMemory
+    features = len(state_vars) + 3
+    rng = np.random.RandomState(seed)
+    results = {}
+    for name, memory_class in [('replay_memory', ReplayMemory), ('prioritized', PrioritizedReplayMemory)]:
+        memory = memory_class(window, features, transitions + window + 1)
+        for _ in range(transitions + window + 1):
+            memory.push_frame(rng.normal(size=features))
+            memory.remember(rng.randint(3), rng.normal(), False)
+        bot = make_bot(bot_kind, window, memory)
+        sample_ms, fit_ms = [], []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            indices = memory.sample_indices(batch_size, rng)
+            batch = memory.gather(indices)
+            weights = memory.importance_weights(indices) if name == 'prioritized' else None
+            middle = time.perf_counter()
+            with quiet():
+                _, td_errors = bot.fit_batch(*batch, sample_weight=weights)
+            if name == 'prioritized':
+                memory.update_priorities(indices, td_errors)
+            fit_ms.append((time.perf_counter() - middle)*1000)
+            sample_ms.append((middle - start)*1000)
+        results[name] = {'sample_ms_p50': float(np.percentile(sample_ms, 50)),
+                         'sample_ms_p95': float(np.percentile(sample_ms, 95)),
+                         'fit_ms_p50': float(np.percentile(fit_ms, 50)),
+                         'fit_ms_p95': float(np.percentile(fit_ms, 95)),
+                         'frames_mb': memory.frames.nbytes/2**20}
+    return results
+
+def run(symbols=('SYNA', 'SYNB'), bars=1260, seed=0, bot_kind='numpy', window=14, episodes=1, seeds=64, store='memory'):
+    '''Every benchmark on a fresh synthetic market.
+    Returns: JSON serializable dict
+    '''
+    import resource
+    symbols = list(symbols)
+    directory = tempfile.mkdtemp(prefix='bench_cache_')
+    start = time.perf_counter()
+    scaler = setup_market(symbols, bars, seed, directory, store)
+    report = {'meta': {'python': platform.python_version(), 'numpy': np.__version__,
+                       'platform': platform.platform(), 'symbols': symbols, 'bars': bars, 'seed': seed,
+                       'bot': bot_kind, 'store': store, 'window': window, 'episodes': episodes,
+                       'setup_seconds': time.perf_counter() - start, 'time': time.time()}}
+    report['queries'] = bench_queries(symbols)
+    report['loops'] = bench_loops(symbols[0], scaler, bot_kind, window, episodes, seeds)
+    report['replay'] = bench_replay(bot_kind, window)
+    # ru_maxrss is KB on Linux
+    report['meta']['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    return report
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Offline benchmarks on a synthetic market')
+    parser.add_argument('--symbols', nargs='+', default=['SYNA', 'SYNB'])
+    parser.add_argument('--bars', type=int, default=1260)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bot', choices=['numpy', 'keras'], default='numpy')
+    parser.add_argument('--episodes', type=int, default=1)
+    parser.add_argument('--store', choices=['memory', 'mongomock'], default='memory')
+    parser.add_argument('--output', default=None, help='JSON file, default prints to stdout')
+    args = parser.parse_args()
+    report = run(args.symbols, args.bars, args.seed, args.bot, episodes=args.episodes, store=args.store)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print(text)
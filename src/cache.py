@@ -0,0 +1,157 @@
+'''
+Local columnar cache of the price history in Mongo. Each symbol's nested "data" array is exported
+once into one .npy file per column under cache/<SYMBOL>/, with a meta.json holding the last date
+and the bar count. Columns come back through numpy.memmap (np.load with mmap_mode), so repeated
+episodes cost neither a DB round trip nor BSON decoding.
+'''
+
+import os
+import json
+import logging
+import numpy as np
+
+cache_dir = 'cache'
+# Symbols already compared against the DB in this process
+_CHECKED = set()
+
+def fetch_history(symbol):
+    '''Pulls one symbol's full, date sorted history out of Mongo into columns.
+    Parameters: symbol
+    Returns: dict of column name -> np.array ('date' is datetime64[ms], the rest float64)
+    '''
+    import db
+    from mongo import history_pipeline
+    bars = [item['data'] for item in db.aggregate(history_pipeline(symbol))]
+    return bars_to_columns(bars)
+
+def bars_to_columns(bars):
+    '''Given a list of "data" dicts (see iex.make_doc_from_API), returns them as columns.
+    NOTE: iex.py zero fills bad bars, anything missing from a bar is zero filled here too.
+    '''
+    names = sorted({name for bar in bars for name in bar.keys()} - {'date'})
+    columns = {name: np.array([bar.get(name, 0) for bar in bars], dtype=np.float64) for name in names}
+    columns['date'] = np.array([bar['date'] for bar in bars], dtype='datetime64[ms]')
+    return columns
+
+def db_last_date(symbol):
+    '''One small aggregation for the newest date and bar count of symbol in Mongo.
+    Returns: (last date as datetime64[ms] or None, count)
+    '''
+    import db
+    for item in db.aggregate([{"$match":{"symbol":symbol}},
+                                  {"$project": {"_id": 0, "last": {"$max": "$data.date"}, "count": {"$size": "$data"}}}]):
+        return np.datetime64(item['last'], 'ms'), item['count']
+    return None, 0
+
+def symbol_dir(symbol, directory=None):
+    return os.path.join(directory or cache_dir, symbol.upper())
+
+def read_meta(symbol, directory=None):
+    path = os.path.join(symbol_dir(symbol, directory), 'meta.json')
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_symbol(symbol, columns, directory=None):
+    '''Writes every column to <directory>/<SYMBOL>/<column>.npy and then meta.json. Each file goes
+    through a temporary name and os.replace, and meta.json is last, so a crash never leaves
+    a cache that looks complete but isn't.
+    Returns: meta dict
+    '''
+    path = symbol_dir(symbol, directory)
+    os.makedirs(path, exist_ok=True)
+    for name, values in columns.items():
+        tmp = os.path.join(path, '.{}.npy.tmp'.format(name))
+        with open(tmp, 'wb') as f:
+            np.save(f, values)
+        os.replace(tmp, os.path.join(path, '{}.npy'.format(name)))
+    dates = columns['date']
+    meta = {'symbol': symbol,
+            'count': int(len(dates)),
+            'last_date': str(dates[-1]) if len(dates) else None,
+            'columns': sorted(columns.keys())}
+    tmp = os.path.join(path, '.meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(path, 'meta.json'))
+    return meta
+
+def read_symbol(symbol, columns=None, directory=None):
+    '''Memory maps the cached columns of symbol (all of them by default).
+    Returns: dict of column name -> read only np.memmap
+    '''
+    meta = read_meta(symbol, directory)
+    path = symbol_dir(symbol, directory)
+    names = columns if columns is not None else meta['columns']
+    return {name: np.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode='r') for name in names}
+
+def is_stale(symbol, directory=None):
+    '''Cache is stale if it is missing or the DB has a newer last date or more bars.'''
+    meta = read_meta(symbol, directory)
+    if meta is None or meta['last_date'] is None:
+        return True
+    last, count = db_last_date(symbol)
+    return last is None or last > np.datetime64(meta['last_date'], 'ms') or count != meta['count']
+
+def symbol_history(symbol, columns=None, directory=None, refresh=False, check_db=True):
+    '''Columns of symbol's history, from the cache when it is fresh, otherwise exported from Mongo
+    first. The DB is only asked for freshness once per symbol per process.
+    Parameters: symbol, columns (default all stored ones, indicator names like rsi_14 are
+        computed/updated by indicators.py), directory (default cache_dir), refresh (force a
+        re-export), check_db (False trusts whatever is on disk)
+    Returns: dict of column name -> np.memmap, time increasing
+    '''
+    key = (symbol, directory or cache_dir)
+    if refresh or (check_db and key not in _CHECKED and is_stale(symbol, directory)) \
+            or read_meta(symbol, directory) is None:
+        from instrument import log
+        log('caching', logging.INFO, symbol=symbol)
+        write_symbol(symbol, fetch_history(symbol), directory)
+    _CHECKED.add(key)
+    if columns is None:
+        return read_symbol(symbol, None, directory)
+    from indicators import is_indicator, load
+    wanted = [name for name in columns if is_indicator(name)]
+    history = read_symbol(symbol, [name for name in columns if name not in wanted], directory)
+    if wanted:
+        history.update(load(symbol, wanted, directory))
+    return history
+
+def warm_cache(symbols, directory=None):
+    '''Exports every stale symbol in one multi-symbol fetch (see db.fetch_histories)
+    instead of one query each.
+    Returns: list of symbols that were (re)exported
+    '''
+    import db
+    stale = [symbol for symbol in symbols if is_stale(symbol, directory)]
+    if stale:
+        for symbol, bars in db.fetch_histories(stale).items():
+            write_symbol(symbol, bars_to_columns(bars), directory)
+    _CHECKED.update((symbol, directory or cache_dir) for symbol in symbols)
+    return stale
+
+'''Class ColumnCursor
+Stands in for a Mongo cursor over unwound stock documents, backed by cached columns. Iterating
+gives the same {'symbol':..., 'data': {...}} items the aggregations did.
+'''
+class ColumnCursor():
+    '''Parameters:
+        columns
+            dict of column name -> array, all the same length (i.e. a slice of symbol_history())
+        symbol
+            Put on every item like the real documents
+    '''
+
+    def __init__(self, columns, symbol=None):
+        self.columns = columns
+        self.symbol = symbol
+
+    def __len__(self):
+        return len(self.columns['date'])
+
+    def __iter__(self):
+        names = list(self.columns.keys())
+        for i in range(len(self)):
+            yield {'symbol': self.symbol, 'data': {name: self.columns[name][i] for name in names}}
+'''End ColumnCursor Class'''
@@ -0,0 +1,423 @@
+'''
+Resumable training checkpoints. Pickling the whole bot (main.save_bot) was slow, big and breaks
+on most Keras versions, and my_save() only keeps the weights, so a killed run lost its replay
+memory, epsilon and where it was in the episode. A checkpoint is a directory of plain files:
+    meta.json       episode, count, epsilon, loop variables (cash, shares, ...), RNG states and
+                    the journal files below it is made of
+    weights.npz     bot.get_weights(), in order
+    memory/*.npy    the old deque memory (maxlen items, small enough to copy whole)
+    portfolio.npy   the last window rows of the episode's FeatureWindows portfolio columns
+Everything that grows with the run goes into journal/, shared by the checkpoints of a directory
+and only ever appended to:
+    memory_<n>.npz  memory.ReplayMemory.delta_state(), the slots changed since the save before
+    base_<n>/       memory deltas compacted into memory-mapped full size arrays, once they add up
+                    to a whole capacity (on the writer thread, never the training one)
+    log_<n>.npy, actions_<n>.npy  training log and action log rows added since the save before
+So the training thread only copies what changed since the last checkpoint. Writes happen on a
+background thread into temporary files that are renamed into place, and LATEST (the name of the
+newest complete checkpoint) is replaced last, so a node dying mid write leaves the previous
+checkpoint intact. Journal files no kept checkpoint refers to are removed after each save.
+NOTE: Optimizer moments (Adam) are not saved, they start over on resume.
+'''
+
+import os
+import json
+import queue
+import random
+import shutil
+import threading
+from collections import deque
+import numpy as np
+
+latest_name = 'LATEST'
+journal_name = 'journal'
+
+def rng_state():
+    '''random and numpy.random global states as JSON friendly lists.'''
+    version, internal, gauss = random.getstate()
+    name, keys, pos, has_gauss, cached = np.random.get_state()
+    return {'random': [version, list(internal), gauss],
+            'numpy': [name, keys.tolist(), int(pos), int(has_gauss), float(cached)]}
+
+def set_rng_state(state):
+    version, internal, gauss = state['random']
+    random.setstate((version, tuple(internal), gauss))
+    name, keys, pos, has_gauss, cached = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached))
+
+def memory_state(memory):
+    '''Given a bot's memory, returns (kind, arrays, scalars). The old deque of
+    (state, action, reward, new_state, done) tuples is stacked into arrays.
+    '''
+    if hasattr(memory, 'state_dict'):
+        state = memory.state_dict()
+        arrays = {name: value for name, value in state.items() if isinstance(value, np.ndarray)}
+        scalars = {name: value for name, value in state.items() if not isinstance(value, np.ndarray)}
+        return type(memory).__name__, arrays, scalars
+    items = list(memory)
+    if not items:
+        return 'deque', {}, {'maxlen': memory.maxlen}
+    arrays = {'states': np.concatenate([item[0] for item in items]),
+              'actions': np.array([item[1] for item in items]),
+              'rewards': np.array([item[2] for item in items], dtype=np.float64),
+              'new_states': np.concatenate([item[3] for item in items]),
+              'dones': np.array([item[4] for item in items], dtype=bool)}
+    return 'deque', arrays, {'maxlen': memory.maxlen}
+
+def restore_memory(memory, kind, arrays, scalars):
+    '''Given a bot's (fresh) memory and what memory_state() saved, fills it back in.
+    Returns: The memory, a new deque for the old style memory
+    '''
+    if kind == 'deque':
+        if hasattr(memory, 'state_dict'):
+            raise ValueError('Checkpoint has a deque memory, the bot has a {}.'.format(type(memory).__name__))
+        restored = deque(maxlen=scalars['maxlen'])
+        if arrays:
+            for i in range(len(arrays['actions'])):
+                restored.append((arrays['states'][i:i + 1], int(arrays['actions'][i]), float(arrays['rewards'][i]),
+                                 arrays['new_states'][i:i + 1], bool(arrays['dones'][i])))
+        return restored
+    if type(memory).__name__ != kind:
+        raise ValueError('Checkpoint has a {}, the bot has a {}.'.format(kind, type(memory).__name__))
+    state = dict(scalars)
+    state.update(arrays)
+    memory.load_state_dict(state)
+    return memory
+
+def snapshot(bot, episode, count, epsilon, loop=None, portfolio=None, log=None, action_log=None,
+             portfolio_start=0, log_start=0, action_start=0, full=False, **meta):
+    '''Copies what a checkpoint needs, on the calling (training) thread, so training can go on
+    while CheckpointWriter writes it. Only what changed since the last snapshot is copied: the
+    replay memory's delta_state(), log rows from log_start and actions from action_start.
+    Parameters: bot, episode and count (where training continues), epsilon, loop (dict of the
+        Train loop variables), portfolio (FeatureWindows portfolio rows from portfolio_start on),
+        log and action_log (LogRecorder of the training log and Q values), full (whole memory, for a new
+        directory, without moving the memory's delta mark), meta (anything JSON, i.e. symbol)
+    Returns: dict for CheckpointWriter.save()/save_checkpoint()
+    '''
+    deltas = {'memory': [], 'log': [], 'actions': []}
+    if hasattr(bot.memory, 'delta_state'):
+        kind, memory_arrays, memory_scalars = type(bot.memory).__name__, {}, {}
+        deltas['memory'].append(bot.memory.delta_state(full))
+    else:
+        kind, memory_arrays, memory_scalars = memory_state(bot.memory)
+    arrays = {}
+    if portfolio is not None:
+        arrays['portfolio'] = np.array(portfolio)
+    info = {'episode': episode, 'count': count, 'epsilon': float(epsilon), 'loop': loop or {},
+            'rng': rng_state(), 'memory': {'kind': kind, 'scalars': memory_scalars},
+            'portfolio_start': portfolio_start}
+    if log is not None:
+        if len(log) > log_start:
+            deltas['log'].append(log.rows(log_start))
+        info['log_columns'] = log.columns
+        info['log_rows'] = len(log)
+    if action_log is not None:
+        if len(action_log) > action_start:
+            deltas['actions'].append(action_log.rows(action_start))
+        info['action_columns'] = action_log.columns
+        info['action_rows'] = len(action_log)
+    info.update(meta)
+    return {'meta': info, 'weights': [np.array(w) for w in bot.get_weights()],
+            'memory': memory_arrays, 'arrays': arrays, 'deltas': deltas}
+
+def merge_snapshots(older, newer):
+    '''Given two snapshots of one run, returns newer carrying older's deltas too (for a
+    snapshot that was never written).
+    '''
+    merged = dict(newer)
+    merged['deltas'] = {key: older['deltas'][key] + newer['deltas'][key] for key in newer['deltas']}
+    return merged
+
+def _name(meta):
+    return 'ckpt_{:05d}_{:09d}'.format(meta['episode'], meta['count'])
+
+def _empty_journal():
+    return {'seq': 0, 'memory_base': None, 'memory_segments': [], 'memory_rows': 0, 'capacity': None,
+            'log': [], 'actions': []}
+
+def _latest_meta(directory):
+    pointer = os.path.join(directory, latest_name)
+    if not os.path.exists(pointer):
+        return {}
+    with open(pointer) as f:
+        path = os.path.join(directory, f.read().strip())
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+def read_journal(directory):
+    '''Given a checkpoint directory, returns the journal LATEST's checkpoint is made of (what
+    the next save appends to), an empty one without checkpoints.
+    '''
+    return _latest_meta(directory).get('journal', _empty_journal())
+
+def _save_file(path, save, value):
+    with open(path + '.tmp', 'wb') as f:
+        save(f, value)
+    os.replace(path + '.tmp', path)
+
+def _compact(journal_dir, journal):
+    '''Applies the memory deltas since the last base onto a copy of it, as memory-mapped full
+    size arrays, and makes that the base.
+    '''
+    from numpy.lib.format import open_memmap
+    name = 'base_{:06d}'.format(journal['seq'])
+    journal['seq'] += 1
+    final = os.path.join(journal_dir, name)
+    tmp = final + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    if journal['memory_base'] is None:
+        os.makedirs(tmp)
+        scalars = {}
+    else:
+        shutil.copytree(os.path.join(journal_dir, journal['memory_base']), tmp)
+        with open(os.path.join(tmp, 'scalars.json')) as f:
+            scalars = json.load(f)
+    capacity = journal['capacity']
+    for segment in journal['memory_segments']:
+        with np.load(os.path.join(journal_dir, segment)) as delta:
+            streams = delta['frames'].shape[1]
+            for key in delta.files:
+                value = delta[key]
+                if key in ('slots', 'priority_indices'):
+                    continue
+                if value.ndim == 0 or key == 'runs':
+                    scalars[key] = value.tolist()
+                    continue
+                # Priorities are per (slot, stream), everything else per slot
+                index = delta['priority_indices'] if key == 'priorities' else delta['slots']
+                filename = os.path.join(tmp, key + '.npy')
+                if os.path.exists(filename):
+                    array = open_memmap(filename, mode='r+')
+                else:
+                    length = capacity*streams if key == 'priorities' else capacity
+                    array = open_memmap(filename, mode='w+', dtype=value.dtype, shape=(length,) + value.shape[1:])
+                array[index] = value
+                array.flush()
+                del array
+    with open(os.path.join(tmp, 'scalars.json'), 'w') as f:
+        json.dump(scalars, f)
+    os.replace(tmp, final)
+    journal.update({'memory_base': name, 'memory_segments': [], 'memory_rows': 0})
+
+def _append_journal(directory, journal, deltas):
+    '''Writes a snapshot's deltas as the next journal files and records them in journal.'''
+    journal_dir = os.path.join(directory, journal_name)
+    os.makedirs(journal_dir, exist_ok=True)
+    for delta in deltas['memory']:
+        name = 'memory_{:06d}.npz'.format(journal['seq'])
+        journal['seq'] += 1
+        _save_file(os.path.join(journal_dir, name), lambda f, value: np.savez(f, **value), delta)
+        journal['memory_segments'].append(name)
+        journal['memory_rows'] += len(delta['slots'])
+        journal['capacity'] = int(delta['capacity'])
+    for key in ['log', 'actions']:
+        if deltas[key]:
+            name = '{}_{:06d}.npy'.format(key, journal['seq'])
+            journal['seq'] += 1
+            _save_file(os.path.join(journal_dir, name), np.save, np.concatenate(deltas[key], axis=1))
+            journal[key].append(name)
+    # Deltas adding up to a whole ring rewrote all of it, past that a base is cheaper to restore
+    if len(journal['memory_segments']) > 1 and journal['memory_rows'] >= journal['capacity']:
+        _compact(journal_dir, journal)
+
+def _collect_journal(directory):
+    '''Removes journal files (and leftovers of interrupted writes) no checkpoint refers to.'''
+    journal_dir = os.path.join(directory, journal_name)
+    if not os.path.isdir(journal_dir):
+        return
+    used = set()
+    for entry in os.listdir(directory):
+        if entry.startswith('ckpt_'):
+            try:
+                with open(os.path.join(directory, entry, 'meta.json')) as f:
+                    journal = json.load(f).get('journal', _empty_journal())
+            except (OSError, ValueError):
+                continue
+            used.update(journal['memory_segments'] + journal['log'] + journal['actions'])
+            used.add(journal['memory_base'])
+    for entry in os.listdir(journal_dir):
+        if entry not in used:
+            path = os.path.join(journal_dir, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+def save_checkpoint(directory, snap, keep=2, journal=None):
+    '''Given a snapshot(), appends its deltas to the journal, writes the rest as
+    directory/ckpt_<episode>_<count> and points LATEST at it. Older checkpoints beyond keep and
+    journal files only they used are removed.
+    Parameters: journal (what the last save left, updated in place), read from LATEST if None
+    Returns: Path of the checkpoint
+    '''
+    os.makedirs(directory, exist_ok=True)
+    if journal is None:
+        journal = read_journal(directory)
+    _append_journal(directory, journal, snap['deltas'])
+    meta = dict(snap['meta'])
+    meta['journal'] = json.loads(json.dumps(journal))
+    name = _name(meta)
+    final = os.path.join(directory, name)
+    tmp = os.path.join(directory, '.{}.tmp-{}'.format(name, os.getpid()))
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(os.path.join(tmp, 'memory'))
+    np.savez(os.path.join(tmp, 'weights.npz'), *snap['weights'])
+    for key, value in snap['memory'].items():
+        np.save(os.path.join(tmp, 'memory', key + '.npy'), value)
+    for key, value in snap['arrays'].items():
+        np.save(os.path.join(tmp, key + '.npy'), value)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(final):
+        shutil.rmtree(final)
+    os.replace(tmp, final)
+    # LATEST last, readers never see a name that is not completely written
+    pointer = os.path.join(directory, latest_name)
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(name)
+    os.replace(pointer + '.tmp', pointer)
+    old = sorted(entry for entry in os.listdir(directory) if entry.startswith('ckpt_') and entry != name)
+    for entry in old[:max(len(old) - keep + 1, 0)]:
+        shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+    _collect_journal(directory)
+    return final
+
+def load_checkpoint(directory):
+    '''Given a checkpoint directory (as passed to save_checkpoint), reads the one LATEST points at.
+    The log and actions are put back together from the journal, the replay memory is left to
+    restore_bot(). Deque memory arrays are memory-mapped, restore_memory() copies them into place.
+    Returns: dict like snapshot() returns, or None if there is no checkpoint yet
+    '''
+    pointer = os.path.join(directory, latest_name)
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        path = os.path.join(directory, f.read().strip())
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    with np.load(os.path.join(path, 'weights.npz')) as f:
+        weights = [f['arr_{}'.format(i)] for i in range(len(f.files))]
+    memory = {name[:-4]: np.load(os.path.join(path, 'memory', name), mmap_mode='r')
+              for name in os.listdir(os.path.join(path, 'memory')) if name.endswith('.npy')}
+    arrays = {name[:-4]: np.load(os.path.join(path, name)) for name in os.listdir(path) if name.endswith('.npy')}
+    journal_dir = os.path.join(directory, journal_name)
+    if 'journal' in meta:
+        log = [np.load(os.path.join(journal_dir, name)) for name in meta['journal']['log']]
+        arrays['log'] = np.concatenate(log, axis=1) if log else np.empty((len(meta.get('log_columns', [])), 0))
+        actions = [np.load(os.path.join(journal_dir, name)) for name in meta['journal']['actions']]
+        arrays['actions'] = np.concatenate(actions, axis=1) if actions else np.empty((len(meta.get('action_columns', [])), 0))
+    return {'meta': meta, 'weights': weights, 'memory': memory, 'arrays': arrays, 'path': path,
+            'journal_dir': journal_dir}
+
+def restore_journal(memory, kind, journal_dir, journal):
+    '''Given a bot's (fresh) memory and a checkpoint's journal, loads the base and applies the
+    memory deltas after it in order.
+    Returns: memory
+    '''
+    if type(memory).__name__ != kind:
+        raise ValueError('Checkpoint has a {}, the bot has a {}.'.format(kind, type(memory).__name__))
+    if journal['memory_base'] is not None:
+        base = os.path.join(journal_dir, journal['memory_base'])
+        with open(os.path.join(base, 'scalars.json')) as f:
+            state = json.load(f)
+        n = state['filled']
+        for name in os.listdir(base):
+            if name.endswith('.npy'):
+                array = np.load(os.path.join(base, name), mmap_mode='r')
+                state[name[:-4]] = array[:n*array.shape[0]//state['capacity']]
+        memory.load_state_dict(state)
+    for segment in journal['memory_segments']:
+        with np.load(os.path.join(journal_dir, segment)) as delta:
+            memory.apply_delta({key: delta[key] for key in delta.files})
+    return memory
+
+def restore_bot(bot, checkpoint):
+    '''Given a freshly built bot and load_checkpoint()'s output, sets its weights and replay
+    memory and the global RNG states.
+    Returns: bot
+    '''
+    bot.set_weights(checkpoint['weights'])
+    meta = checkpoint['meta']
+    kind = meta['memory']['kind']
+    if kind == 'deque' or 'journal' not in meta:
+        bot.memory = restore_memory(bot.memory, kind, checkpoint['memory'], meta['memory']['scalars'])
+    else:
+        bot.memory = restore_journal(bot.memory, kind, checkpoint['journal_dir'], meta['journal'])
+    set_rng_state(meta['rng'])
+    return bot
+
+'''Class CheckpointWriter
+Background thread that writes snapshots with save_checkpoint(). At most one snapshot waits
+behind the one being written, a newer one replaces it and takes over its deltas (only the latest
+matters on resume, but every delta has to reach the journal).
+'''
+class CheckpointWriter():
+    '''Parameters:
+        directory
+            Where checkpoints, the journal and LATEST go. Saves continue the journal of the
+            checkpoint already there (the one a run resumed from)
+        keep
+            Number of complete checkpoints kept on disk
+    Methods:
+        snapshot()
+            checkpoint.snapshot() of what changed since this writer's last one
+        save()
+            Queue a snapshot() for writing, returns right away
+        close()
+            Write whatever is queued and stop the thread. Raises if a write failed
+    '''
+
+    def __init__(self, directory, keep=2):
+        self.directory = directory
+        self.keep = keep
+        self.written = []
+        self.error = None
+        meta = _latest_meta(directory)
+        self.journal = meta.get('journal', _empty_journal())
+        # Rows the journal already has, snapshots start from there
+        self._log_rows = meta.get('log_rows', 0)
+        self._action_rows = meta.get('action_rows', 0)
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            snap = self._queue.get()
+            if snap is None:
+                return
+            try:
+                self.written.append(save_checkpoint(self.directory, snap, self.keep, self.journal))
+            except Exception as error:
+                self.error = error
+
+    def snapshot(self, bot, episode, count, epsilon, loop=None, portfolio=None, log=None, action_log=None, **meta):
+        snap = snapshot(bot, episode, count, epsilon, loop, portfolio, log, action_log,
+                        log_start=self._log_rows, action_start=self._action_rows, **meta)
+        self._log_rows = snap['meta'].get('log_rows', self._log_rows)
+        self._action_rows = snap['meta'].get('action_rows', self._action_rows)
+        return snap
+
+    def save(self, snap):
+        if self.error is not None:
+            raise self.error
+        while True:
+            try:
+                self._queue.put_nowait(snap)
+                return
+            except queue.Full:
+                # The waiting one is stale, but its deltas are not written anywhere else
+                try:
+                    snap = merge_snapshots(self._queue.get_nowait(), snap)
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+'''End CheckpointWriter Class - Usage: writer = CheckpointWriter('output/ckpt'); writer.save(writer.snapshot(bot, 0, 500, 0.7))'''
@@ -0,0 +1,111 @@
+'''
+Data access for the equities DB. One lazily created, pooled MongoClient per process that mongo.py,
+cache.py and iex.py all go through, plus bulk helpers so nothing loops insert_one or runs one
+aggregation per symbol.
+NOTE: For offline runs/benchmarks set MONGO_URI=mongomock:// (needs mongomock) or hand any
+client to configure(client=...), i.e. one pointed at a local mongod.
+'''
+
+import os
+import threading
+
+database = 'equities'
+collection = 'stocks'
+# Keyword arguments for pymongo.MongoClient, change with configure()
+settings = {'host': os.environ.get('MONGO_URI', 'mongodb://localhost:27017'),
+            'maxPoolSize': int(os.environ.get('MONGO_POOL_SIZE', 50)),
+            'serverSelectionTimeoutMS': 5000,
+            'connectTimeoutMS': 5000,
+            'socketTimeoutMS': 30000}
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+def configure(client=None, **kwargs):
+    '''Given a ready made client (i.e. mongomock.MongoClient()) and/or MongoClient keywords
+    (host, maxPoolSize, serverSelectionTimeoutMS, ...), swaps the shared connection.
+    Returns: None
+    '''
+    global _client, _client_pid
+    close()
+    settings.update(kwargs)
+    if client is not None:
+        with _lock:
+            _client = client
+            _client_pid = None
+
+def get_client():
+    '''The shared client, created on first use. A forked worker (i.e. a process pool) gets its
+    own, pymongo clients are not fork safe.
+    '''
+    global _client, _client_pid
+    with _lock:
+        if _client is None or (_client_pid is not None and _client_pid != os.getpid()):
+            if settings['host'].startswith('mongomock://'):
+                import mongomock
+                _client = mongomock.MongoClient()
+            else:
+                import pymongo
+                _client = pymongo.MongoClient(**settings)
+            _client_pid = os.getpid()
+        return _client
+
+def close():
+    global _client, _client_pid
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+def stocks_collection():
+    return get_client()[database][collection]
+
+def aggregate(pipeline):
+    return stocks_collection().aggregate(pipeline, allowDiskUse=True)
+
+def insert_many(documents, ordered=False):
+    '''Given a list of stock documents, inserts them in one round trip.
+    Returns: InsertManyResult (None if there was nothing to insert)
+    '''
+    documents = list(documents)
+    if not documents:
+        return None
+    return stocks_collection().insert_many(documents, ordered=ordered)
+
+def bulk_write(requests, ordered=False):
+    '''Given pymongo write models (UpdateOne, ReplaceOne, ...), sends them in one batch.
+    Returns: BulkWriteResult (None if there was nothing to write)
+    '''
+    requests = list(requests)
+    if not requests:
+        return None
+    return stocks_collection().bulk_write(requests, ordered=ordered)
+
+def fetch_histories(symbols, fields=None):
+    '''Every symbol's history in one $in aggregation instead of one query per symbol.
+    Parameters: symbols, fields (names inside "data" to keep, None keeps all)
+    Returns: dict of symbol -> list of "data" dicts, date sorted
+    '''
+    from mongo import history_pipeline
+    pipeline = history_pipeline({"$in": list(symbols)}, fields)
+    # history_pipeline sorts on date alone, group by symbol as well
+    pipeline[-1] = {"$sort": {"symbol": 1, "data.date": 1}}
+    histories = {symbol: [] for symbol in symbols}
+    for item in aggregate(pipeline):
+        histories[item['symbol']].append(item['data'])
+    return histories
+
+def ensure_indexes():
+    '''Index on symbol, every query and update here matches on it.'''
+    stocks_collection().create_index('symbol')
+
+def last_dates(symbols):
+    '''Newest stored data.date of each symbol in one aggregation.
+    Returns: dict of symbol -> datetime (symbols with no document are left out)
+    '''
+    pipeline = [{"$match": {"symbol": {"$in": list(symbols)}}},
+                {"$project": {"_id": 0, "symbol": 1, "last": {"$max": "$data.date"}}},
+                {"$group": {"_id": "$symbol", "last": {"$max": "$last"}}}]
+    return {item['_id']: item['last'] for item in aggregate(pipeline) if item['last'] is not None}
@@ -0,0 +1,176 @@
+'''
+Feature stage for the bots. Instead of scaling one bar at a time and shifting the state down
+every step, this pulls a symbol's state_vars into one matrix, scales the whole thing in one
+call and hands out (window, features) states as views into a single per-episode buffer.
+NOTE: Row 0 of a state is the newest bar, same as the shift-down window Train always used.
+'''
+
+import os
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Portfolio columns appended after the scaled state_vars, filled in per step
+portfolio_vars = ['can_buy', 'can_sell', 'cash_state']
+
+# (symbol, state_vars, test_fraction, scaler moments) -> {'train': (features, closes), 'test': (...), 'scaler': scaler}
+_FEATURE_CACHE = {}
+
+def cursor_features(items, scaler, state_vars):
+    '''Given a cursor (or list) of unwound stock documents, this walks it once and returns
+    the scaled state_vars matrix and the close prices.
+    NOTE: Scaler Transform requires alphabetical columns for proper prediction
+    Parameters: items (like output of sstt_cursors), scaler, state_vars
+    Returns: features (bars, len(state_vars)), closes (bars,)
+    '''
+    if hasattr(items, 'columns'):
+        # cache.ColumnCursor, already columnar so there is nothing to walk
+        return column_features(items.columns, scaler, state_vars)
+    names = list(state_vars) + ['close']
+    raw = np.array([[item['data'][j] for j in names] for item in items], dtype=np.float64)
+    raw = raw.reshape(-1, len(names))
+    return scale_features(raw[:, :-1], scaler), raw[:, -1]
+
+def column_features(columns, scaler, state_vars):
+    '''Same as cursor_features for a dict of column arrays (i.e. from mongo.sstt_arrays).
+    Returns: features (bars, len(state_vars)), closes (bars,)
+    '''
+    raw = np.column_stack([np.asarray(columns[j], dtype=np.float64) for j in state_vars])
+    return scale_features(raw, scaler), np.array(columns['close'], dtype=np.float64)
+
+def scale_features(raw, scaler):
+    '''Scales every bar at once. For the StandardScaler in tech_scaler.pkl this is just the
+    affine (x - mean)/std over the whole matrix.
+    Parameters: raw (bars, features) matrix in state_vars order, scaler
+    Returns: Scaled float64 matrix of the same shape
+    '''
+    if len(raw) == 0:
+        return raw.copy()
+    from instrument import timer
+    with timer('transform'):
+        return np.asarray(scaler.transform(raw), dtype=np.float64)
+
+def market_features(symbol, scaler, state_vars, split='train', test_fraction=0.40):
+    '''Scaled features and closes for one split of a symbol. Both splits are built on the
+    first call and cached for the life of the process, so later episodes skip the DB.
+    Parameters: symbol, scaler, state_vars, split ('train' or 'test'), test_fraction
+    Returns: features (bars, len(state_vars)), closes (bars,)
+    '''
+    key = (symbol, tuple(state_vars), test_fraction, _scaler_key(scaler))
+    if key not in _FEATURE_CACHE:
+        from mongo import sstt_arrays
+        from instrument import timer
+        with timer('db_fetch'):
+            train_data, test_data = sstt_arrays(symbol, test_fraction, list(state_vars) + ['close'])
+        # The scaler is held so an id() key cannot be reused by a new scaler while cached
+        _FEATURE_CACHE[key] = {'train': column_features(train_data, scaler, state_vars),
+                               'test': column_features(test_data, scaler, state_vars), 'scaler': scaler}
+    return _FEATURE_CACHE[key][split]
+
+def _scaler_key(scaler):
+    '''What the scaler computes: mean_ and scale_ for StandardScaler/AffineScaler, so a refit
+    scaler (or a new one at a recycled address) never hits features scaled by another.
+    Anything else is keyed on identity.
+    '''
+    mean, scale = getattr(scaler, 'mean_', None), getattr(scaler, 'scale_', None)
+    if mean is None and scale is None:
+        return ('id', id(scaler))
+    return tuple(None if value is None else np.asarray(value, dtype=np.float64).tobytes() for value in (mean, scale))
+
+def clear_feature_cache():
+    '''Drops every cached symbol, i.e. after the DB or the scaler changed.'''
+    _FEATURE_CACHE.clear()
+
+class AffineScaler():
+    '''(x - mean_)/scale_, all a fitted StandardScaler does in transform() without importing sklearn.'''
+    def __init__(self, mean, scale):
+        self.mean_ = np.asarray(mean, dtype=np.float64)
+        self.scale_ = np.asarray(scale, dtype=np.float64)
+
+    def transform(self, raw):
+        return (np.asarray(raw, dtype=np.float64) - self.mean_)/self.scale_
+
+# path -> scaler, so a path is only read once per process
+_SCALERS = {}
+
+def load_scaler(path):
+    '''Given a joblib pickled StandardScaler (i.e. resources/tech_scaler.pkl), returns it as an
+    AffineScaler. The first load unpickles it (which pulls in sklearn, over a second) and writes
+    path.npz next to it, later processes only read the .npz. Anything that is not a plain
+    StandardScaler is returned unpickled as is.
+    '''
+    if path in _SCALERS:
+        return _SCALERS[path]
+    sidecar = path + '.npz'
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+        with np.load(sidecar) as f:
+            scaler = AffineScaler(f['mean'], f['scale'])
+    else:
+        try:
+            from sklearn.externals import joblib
+        except ImportError:
+            # Newer sklearn dropped its joblib copy
+            import joblib
+        scaler = joblib.load(path)
+        if type(scaler).__name__ == 'StandardScaler':
+            n = scaler.n_features_in_ if hasattr(scaler, 'n_features_in_') else len(scaler.scale_)
+            mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(n)
+            scale = scaler.scale_ if scaler.scale_ is not None else np.ones(n)
+            scaler = AffineScaler(mean, scale)
+            try:
+                np.savez(sidecar, mean=scaler.mean_, scale=scaler.scale_)
+            except OSError:
+                pass
+    _SCALERS[path] = scaler
+    return scaler
+
+'''Class FeatureWindows
+One episode's worth of state. Holds the scaled features plus the three portfolio columns in
+a single buffer, and every state is a slice of a reversed view of it (no copies, no shifting).
+'''
+class FeatureWindows():
+    '''Parameters:
+        features
+            Scaled (bars, len(state_vars)) matrix, i.e. from market_features()
+        window
+            Length of timesteps for bot, bot.NN_input_shape[0]
+    Methods:
+        set_portfolio()
+            Fill in can_buy, can_sell, cash_state for bar t. Must happen before state(t).
+        state()
+            (1, window, features) state ending at bar t, newest bar first
+        windows()
+            Every full window as one (bars - window + 1, window, features) view
+    '''
+
+    def __init__(self, features, window):
+        self.window = window
+        self.n_market = features.shape[1]
+        self.buffer = np.zeros((len(features), self.n_market + len(portfolio_vars)))
+        self.buffer[:, :self.n_market] = features
+        # Newest first. The state ending at bar t starts at row len - 1 - t of this view
+        self._reversed = self.buffer[::-1]
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def set_portfolio(self, t, can_buy, can_sell, cash_state):
+        self.buffer[t, self.n_market:] = (can_buy, can_sell, cash_state)
+
+    def state(self, t):
+        '''Given a bar index, returns the (1, window, features) state ending there.
+        Early bars are zero padded like the old preallocated state (that one is a copy).
+        '''
+        start = len(self.buffer) - 1 - t
+        if t < self.window - 1:
+            padded = np.zeros((1, self.window, self.buffer.shape[1]))
+            padded[0, :t + 1] = self._reversed[start:]
+            return padded
+        return self._reversed[start:start + self.window][np.newaxis]
+
+    def windows(self):
+        '''Zero-copy view of every full window. Index i is the state ending at bar i + window - 1.
+        Returns: Read-only array of shape (bars - window + 1, window, features)
+        '''
+        view = sliding_window_view(self._reversed, self.window, axis=0)
+        return view.swapaxes(1, 2)[::-1]
+'''End FeatureWindows Class - Usage: windows = FeatureWindows(features, 14)'''
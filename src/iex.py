@@ -8,99 +8,275 @@ this might be scrambled...
 # Pipeline
 import requests
 import re
+import threading
+import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def make_doc_from_API(symbol, timeframe, summ_wanted = ['symbol', 'companyName', 'description', 'CEO', 'sector', 'tags']):
+# Point this at a local stub server for offline runs
+api_url = 'https://api.iextrading.com/1.0'
+valid_times = ['5y', '2y', '1y', 'ytd', '6m', '3m', '1m']
+# Smallest chart range first, with the calendar days it safely covers
+timeframe_days = [('1m', 28), ('3m', 88), ('6m', 180), ('1y', 362), ('2y', 727), ('5y', 1822)]
+
+def timeframe_for_gap(last_date, today=None):
+    '''Given the last stored bar date, returns the smallest IEX chart range that reaches back to it.'''
+    gap = ((today or datetime.now()) - last_date).days
+    for timeframe, days in timeframe_days:
+        if gap <= days:
+            return timeframe
+    return '5y'
+
+def make_doc_from_API(symbol, timeframe, summ_wanted = ['symbol', 'companyName', 'description', 'CEO', 'sector', 'tags'], symbols = None):
     '''NOTE: API May have already been sunsetted
     Using the symbol, and timeframe ['5y', '2y', '1y', 'ytd', '6m', '3m', '1m'] this function
     creates a document for insertion in to MongoDB. It utilizes the document oriented, schema-less ideas
     and typically allows for quicker read/write speeds as well as scalability and easy item changing. 
-    Inputs: Symbol ('AAPL', 'aapl'), Timeframe (From Valid Choices)
+    Inputs: Symbol ('AAPL', 'aapl'), Timeframe (From Valid Choices), symbols (already fetched
+        /ref-data/symbols list, otherwise it is downloaded. See Ingestor for many symbols)
     Returns: Document (Dictionary in JSON with Nested Dictionaries in 'data')
     '''
-    valid_times = ['5y', '2y', '1y', 'ytd', '6m', '3m', '1m']
-    r_symbols = requests.get('https://api.iextrading.com/1.0/ref-data/symbols')
-    json_symbols = r_symbols.json()
-    symbols = [item['symbol'] for item in json_symbols if item['isEnabled']]
+    if symbols is None:
+        r_symbols = requests.get('{}/ref-data/symbols'.format(api_url))
+        json_symbols = r_symbols.json()
+        symbols = [item['symbol'] for item in json_symbols if item['isEnabled']]
     if timeframe in valid_times and symbol in symbols:
-        r_summ = requests.get('https://api.iextrading.com/1.0/stock/{}/company'.format(symbol.lower()))
+        r_summ = requests.get('{}/stock/{}/company'.format(api_url, symbol.lower()))
         json_summ = r_summ.json()
-        r_time = requests.get('https://api.iextrading.com/1.0/stock/{}/chart/{}'.format(symbol.lower(), timeframe))
+        r_time = requests.get('{}/stock/{}/chart/{}'.format(api_url, symbol.lower(), timeframe))
         json_time = r_time.json()
-        if 'y' in timeframe:
-            if timeframe != 'ytd':
-                # 251 short work year
-                coherence = (len(json_time)/251)/(int(re.findall('\d*', timeframe)[0]))
-                difference = (len(json_time)/251)-(int(re.findall('\d*', timeframe)[0]))
-            else:
-                coherence = (len(json_time)/251)
-                difference = (len(json_time)/251)-1
-        else:
-            coherence = (len(json_time)/22)/(int(re.findall('\d*', timeframe)[0]))
-            difference = (len(json_time)/22)-(int(re.findall('\d*', timeframe)[0]))
-        print('Coherence: {}, Difference: {}'.format(round(coherence, 5), round(difference, 5)))
-        if coherence < 0.95:
-            print('Warning: Appears some is missing...')
-        # Summary Vars Wanted
-        stock_document = {i:json_summ[i] for i in summ_wanted}
-        stock_document['timeframe'] = timeframe
-        print('retrieving {} data for {}.\n'.format(stock_document['companyName'], timeframe))
-        # Time Vars Wanted
-        time_wanted = ['date', 'open', 'high', 'low', 'close', 'volume', 'change', 'vwap']
-        # Nested Document Structure under 'data'
-        documents = []
-        nan_count = 0
-        for item in json_time:
-            document = {}
-            if all([True for i in time_wanted if i in item.keys()]):
-                # Instead of the traditional close-close, open-open differencing, 
-                # lets make a daily "profile" to streamline data gathering
-                document['date'] = datetime.fromisoformat(item['date'])
-                document['open_close'] = item['open'] - item['close']
-                document['high_low'] = item['high'] - item['low']
-                # This will be correlated with vwap slightly...
-                document['volume'] = item['volume']
-                document['close'] = item['close']
-                # Assuming close to close from previous day
-                document['change'] = item['change']
-                # Since we trade at night, lets give the bot some info on "trend"
-                document['close_vwap'] = item['close'] - item['vwap']
-            else:
-                document['date'] = datetime.fromisoformat(item['date'])
-                inserts = ['date', 'open_close', 'high_low', 'volume', 'close', 'change', 'close-vwap']
-                document.update({i:0 for i in inserts})
-                nan_count += 1
-                print('NaN Item... \n', item)
-            documents.append(document)
-        stock_document['data'] = documents
-        return stock_document
+        return build_document(json_summ, json_time, timeframe, summ_wanted)
     else:
         print('Something wrong...')
+
+def build_document(json_summ, json_time, timeframe, summ_wanted = ['symbol', 'companyName', 'description', 'CEO', 'sector', 'tags']):
+    '''Given the /company and /chart/<timeframe> responses, builds the stock document.
+    Returns: Document (Dictionary in JSON with Nested Dictionaries in 'data')
+    '''
+    if 'y' in timeframe:
+        if timeframe != 'ytd':
+            # 251 short work year
+            coherence = (len(json_time)/251)/(int(re.findall('\d*', timeframe)[0]))
+            difference = (len(json_time)/251)-(int(re.findall('\d*', timeframe)[0]))
+        else:
+            coherence = (len(json_time)/251)
+            difference = (len(json_time)/251)-1
+    else:
+        coherence = (len(json_time)/22)/(int(re.findall('\d*', timeframe)[0]))
+        difference = (len(json_time)/22)-(int(re.findall('\d*', timeframe)[0]))
+    print('Coherence: {}, Difference: {}'.format(round(coherence, 5), round(difference, 5)))
+    if coherence < 0.95:
+        print('Warning: Appears some is missing...')
+    # Summary Vars Wanted
+    stock_document = {i:json_summ[i] for i in summ_wanted}
+    stock_document['timeframe'] = timeframe
+    print('retrieving {} data for {}.\n'.format(stock_document['companyName'], timeframe))
+    stock_document['data'] = build_bars(json_time)
+    return stock_document
+
+def build_bars(json_time):
+    '''Given a /chart response, builds the nested 'data' documents (one daily "profile" per bar).
+    Returns: List of dictionaries
+    '''
+    # Time Vars Wanted
+    time_wanted = ['date', 'open', 'high', 'low', 'close', 'volume', 'change', 'vwap']
+    # Nested Document Structure under 'data'
+    documents = []
+    nan_count = 0
+    for item in json_time:
+        document = {}
+        if all([True for i in time_wanted if i in item.keys()]):
+            # Instead of the traditional close-close, open-open differencing, 
+            # lets make a daily "profile" to streamline data gathering
+            document['date'] = datetime.fromisoformat(item['date'])
+            document['open_close'] = item['open'] - item['close']
+            document['high_low'] = item['high'] - item['low']
+            # This will be correlated with vwap slightly...
+            document['volume'] = item['volume']
+            document['close'] = item['close']
+            # Assuming close to close from previous day
+            document['change'] = item['change']
+            # Since we trade at night, lets give the bot some info on "trend"
+            document['close_vwap'] = item['close'] - item['vwap']
+        else:
+            document['date'] = datetime.fromisoformat(item['date'])
+            inserts = ['date', 'open_close', 'high_low', 'volume', 'close', 'change', 'close-vwap']
+            document.update({i:0 for i in inserts})
+            nan_count += 1
+            print('NaN Item... \n', item)
+        documents.append(document)
+    return documents
+
+'''Class TokenBucket
+Thread safe rate limiter. Holds up to "capacity" tokens, refilled at "rate" per second, and every
+request takes one. Replaces the flat sleep(10) between symbols.
+'''
+class TokenBucket():
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Blocks until a token is free, then takes it.'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+'''End TokenBucket Class'''
+
+'''Class Ingestor
+Concurrent IEX ingestion. One pooled requests.Session, the symbol list fetched once per run, a
+thread pool fetching company/chart for many symbols at once under a TokenBucket, and documents
+written to Mongo in bulk (see db.py).
+'''
+class Ingestor():
+    '''Parameters:
+        base_url
+            API root, defaults to api_url (use a local stub server for testing)
+        max_workers
+            Symbols fetched at once, also the HTTP connection pool size
+        rate, burst
+            Requests per second allowed and how many may go at once
+        timeout
+            Seconds per request
+    Methods:
+        symbol_universe()
+            Enabled symbols, downloaded on first use only
+        fetch_document()
+            Company + chart for one symbol as a stock document (None if not valid)
+        ingest()
+            Fetch many symbols concurrently and bulk upsert them
+        update()
+            Incremental refresh, only the bars after each symbol's last stored date
+    '''
+
+    def __init__(self, base_url=None, max_workers=8, rate=5, burst=None, timeout=30):
+        from requests.adapters import HTTPAdapter
+        self.base_url = (base_url or api_url).rstrip('/')
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=3)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._symbols = None
+
+    def get(self, path):
+        self.bucket.acquire()
+        response = self.session.get('{}/{}'.format(self.base_url, path), timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def symbol_universe(self):
+        if self._symbols is None:
+            self._symbols = {item['symbol'] for item in self.get('ref-data/symbols') if item['isEnabled']}
+        return self._symbols
+
+    def fetch_document(self, symbol, timeframe='5y', summ_wanted=['symbol', 'companyName', 'description', 'CEO', 'sector', 'tags']):
+        if timeframe not in valid_times or symbol not in self.symbol_universe():
+            print('Something wrong... {} {}'.format(symbol, timeframe))
+            return None
+        json_summ = self.get('stock/{}/company'.format(symbol.lower()))
+        json_time = self.get('stock/{}/chart/{}'.format(symbol.lower(), timeframe))
+        return build_document(json_summ, json_time, timeframe, summ_wanted)
+
+    def ingest(self, symbols, timeframe='5y', write=True, batch_size=50):
+        '''Given symbols, fetches them concurrently and inserts finished documents in batches.
+        Parameters: symbols, timeframe, write (False just returns the documents), batch_size
+        Returns: dict of symbol -> document (None where it failed)
+        '''
+        import db
+        from pymongo import ReplaceOne
+        db.ensure_indexes()
+        self.symbol_universe()
+        documents = {}
+        pending = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(self.fetch_document, symbol, timeframe): symbol for symbol in symbols}
+            for future in as_completed(futures):
+                symbol = futures[future]
+                try:
+                    documents[symbol] = future.result()
+                except Exception as e:
+                    print('Failed {}: {}'.format(symbol, e))
+                    documents[symbol] = None
+                if documents[symbol] is not None:
+                    pending.append(documents[symbol])
+                if write and len(pending) >= batch_size:
+                    db.bulk_write(ReplaceOne({'symbol': doc['symbol']}, doc, upsert=True) for doc in pending)
+                    pending = []
+        if write:
+            # Upsert on symbol, re-ingesting replaces the document instead of duplicating it
+            db.bulk_write(ReplaceOne({'symbol': doc['symbol']}, doc, upsert=True) for doc in pending)
+        return documents
+
+    def fetch_new_bars(self, symbol, last_date, today=None):
+        '''Given a symbol and its last stored date, downloads the smallest chart range covering the gap.
+        Returns: List of 'data' documents newer than last_date
+        '''
+        timeframe = timeframe_for_gap(last_date, today)
+        json_time = self.get('stock/{}/chart/{}'.format(symbol.lower(), timeframe))
+        return [bar for bar in build_bars(json_time) if bar['date'] > last_date]
+
+    def update(self, symbols, timeframe='5y', today=None, write=True):
+        '''Incremental refresh. Symbols already in Mongo only get the bars after their last stored
+        date $push-ed onto the existing document, new symbols get a full ingest() with timeframe.
+        Parameters: symbols, timeframe (for new symbols), today (default now), write
+        Returns: dict of symbol -> number of bars added (None where it failed)
+        '''
+        import db
+        from pymongo import UpdateOne
+        db.ensure_indexes()
+        last = db.last_dates(symbols)
+        added = {}
+        updates = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(self.fetch_new_bars, symbol, last[symbol], today): symbol
+                       for symbol in symbols if symbol in last}
+            for future in as_completed(futures):
+                symbol = futures[future]
+                try:
+                    bars = future.result()
+                except Exception as e:
+                    print('Failed {}: {}'.format(symbol, e))
+                    added[symbol] = None
+                    continue
+                added[symbol] = len(bars)
+                if bars:
+                    # Newer than anything stored, so the array stays date sorted
+                    updates.append(UpdateOne({'symbol': symbol}, {'$push': {'data': {'$each': bars}}}))
+        if write:
+            db.bulk_write(updates)
+        new_symbols = [symbol for symbol in symbols if symbol not in last]
+        if new_symbols:
+            for symbol, doc in self.ingest(new_symbols, timeframe, write).items():
+                added[symbol] = len(doc['data']) if doc else None
+        return added
+'''End Ingestor Class - Usage: Ingestor(max_workers=8, rate=5).ingest(['AAPL', 'MSFT'])'''
     
 if __name__ == "__main__":
     '''NOTE: Running mongo.py requires database made by running iex.py '''
     print('This will replicate my DB...\n')
     choice = input('Want to continue? ').lower()
     if choice == 'y':
-        import pymongo
-        from tqdm import tqdm
-        from time import sleep
+        import db
         symbols = ['AAPL', 'MSFT', 'AMZN', 'INTC', 'AMD']
         print('creating: {}\n'.format(symbols))
-        list_documents = []
-        for i in tqdm(symbols):
-            list_documents.append(make_doc_from_API(i, '5y'))
-            # Always use protection...from DoS
-            sleep(10)
-        # Code to add docs to DB
-        client = pymongo.MongoClient()
-        equities = client.equities
-        stocks = equities.stocks
-        print('connected to {}\n'.format(stocks))
-        if list_documents:
-            print('inserting: {}'.format(symbols))
-            for i in tqdm(list_documents):
-                stocks.insert_one(i)
+        print('connected to {}\n'.format(db.stocks_collection()))
+        # Always use protection...from DoS. The token bucket paces every request.
+        # Symbols already stored only get their new bars appended
+        added = Ingestor(max_workers=4, rate=2).update(symbols, '5y')
+        print('bars added: {}'.format(added))
     else:
         print('abandoning...')
 
@@ -0,0 +1,211 @@
+'''
+Technical indicators as extra state_vars, computed from the cached bars instead of at ingest.
+A name is <kind>_<period>, i.e. sma_20, ema_12, rsi_14, vol_20, volz_20:
+    sma, ema    close minus its simple/exponential moving average (dollars, like close_vwap)
+    rsi         Wilder's relative strength index, 0 to 100
+    vol         rolling std of log returns
+    volz        z-score of volume against its rolling mean and std
+Windows that are not full yet use what is there (min_periods=1), so nothing is NaN.
+The whole history is computed with vectorized pandas/NumPy kernels and stored next to the
+symbol's columns in the cache (ind_<name>.npy plus indicators.json). indicators.json also keeps
+each indicator's rolling state (last window, running mean/M2, EMA values), so when the cache
+gains new bars only those are stepped, O(1) each, instead of recomputing the history.
+'''
+
+import os
+import json
+from collections import deque
+import numpy as np
+
+kinds = ['sma', 'ema', 'rsi', 'vol', 'volz']
+
+def parse(name):
+    '''Given a state_vars name, returns (kind, period), or None if it is not an indicator.'''
+    kind, _, period = name.rpartition('_')
+    if kind in kinds and period.isdigit() and int(period) > 0:
+        return kind, int(period)
+    return None
+
+def is_indicator(name):
+    return parse(name) is not None
+
+def _log_returns(close):
+    close = np.asarray(close, dtype=np.float64)
+    returns = np.zeros(len(close))
+    if len(close) > 1:
+        ok = (close[1:] > 0) & (close[:-1] > 0)
+        # iex.py zero fills bad bars, those get no return instead of -inf
+        returns[1:][ok] = np.log(close[1:][ok]/close[:-1][ok])
+    return returns
+
+'''Class RollingWindow
+Mean and M2 of the last size values, updated in O(1) per value (sliding Welford).
+'''
+class RollingWindow():
+    '''Parameters:
+        size
+            Window length, the indicator period
+        values, mean, m2
+            Saved state from to_dict(), empty by default
+    '''
+
+    def __init__(self, size, values=(), mean=0.0, m2=0.0):
+        self.size = size
+        self.values = deque(values)
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def of(cls, size, values):
+        window = cls(size)
+        for value in values[-size:]:
+            window.add(value)
+        return window
+
+    def add(self, x):
+        '''Given the newest value, drops the oldest once full.
+        Returns: mean, population variance of the window
+        '''
+        x = float(x)
+        if len(self.values) == self.size:
+            y = self.values.popleft()
+            self.values.append(x)
+            old = self.mean
+            self.mean += (x - y)/self.size
+            self.m2 += (x - y)*(x - self.mean + y - old)
+        else:
+            self.values.append(x)
+            delta = x - self.mean
+            self.mean += delta/len(self.values)
+            self.m2 += delta*(x - self.mean)
+        return self.mean, max(self.m2, 0.0)/len(self.values)
+
+    def to_dict(self):
+        return {'values': list(self.values), 'mean': self.mean, 'm2': self.m2}
+'''End RollingWindow Class'''
+
+def compute(name, close, volume):
+    '''Vectorized pass over a whole history.
+    Parameters: name (i.e. rsi_14), close, volume (arrays, time increasing)
+    Returns: values (float64, same length), state (dict for step())
+    '''
+    import pandas as pd
+    kind, n = parse(name)
+    close = np.asarray(close, dtype=np.float64)
+    series = pd.Series(close)
+    state = {'name': name}
+    if kind == 'sma':
+        values = close - series.rolling(n, min_periods=1).mean().values
+        state['window'] = RollingWindow.of(n, close).to_dict()
+    elif kind == 'ema':
+        ema = series.ewm(span=n, adjust=False).mean().values
+        values = close - ema
+        state['ema'] = float(ema[-1]) if len(ema) else None
+    elif kind == 'rsi':
+        delta = np.r_[0, np.diff(close)] if len(close) else close
+        gain = pd.Series(np.maximum(delta, 0)).ewm(alpha=1/n, adjust=False).mean().values
+        loss = pd.Series(np.maximum(-delta, 0)).ewm(alpha=1/n, adjust=False).mean().values
+        values = _rsi(gain, loss)
+        state.update({'gain': float(gain[-1]) if len(gain) else None, 'loss': float(loss[-1]) if len(loss) else None,
+                      'previous': float(close[-1]) if len(close) else None})
+    elif kind == 'vol':
+        returns = _log_returns(close)
+        values = pd.Series(returns).rolling(n, min_periods=1).std(ddof=0).fillna(0).values
+        state.update({'window': RollingWindow.of(n, returns).to_dict(), 'previous': float(close[-1]) if len(close) else None})
+    else:
+        volume = np.asarray(volume, dtype=np.float64)
+        rolling = pd.Series(volume).rolling(n, min_periods=1)
+        mean, std = rolling.mean().values, rolling.std(ddof=0).fillna(0).values
+        values = np.divide(volume - mean, std, out=np.zeros(len(volume)), where=std > 0)
+        state['window'] = RollingWindow.of(n, volume).to_dict()
+    return np.asarray(values, dtype=np.float64), state
+
+def _rsi(gain, loss):
+    total = gain + loss
+    return np.divide(100*gain, total, out=np.full(len(total), 50.0), where=total > 0)
+
+def step(state, close, volume):
+    '''Given compute()'s (or the last step()'s) state and one new bar, returns the indicator
+    value for it and updates state in place. O(1).
+    '''
+    kind, n = parse(state['name'])
+    close = float(close)
+    if kind in ('sma', 'vol', 'volz'):
+        window = RollingWindow(n, **state['window'])
+    if kind == 'sma':
+        mean, _ = window.add(close)
+        value = close - mean
+    elif kind == 'ema':
+        alpha = 2/(n + 1)
+        state['ema'] = close if state['ema'] is None else state['ema'] + alpha*(close - state['ema'])
+        value = close - state['ema']
+    elif kind == 'rsi':
+        delta = 0.0 if state['previous'] is None else close - state['previous']
+        if state['gain'] is None:
+            state['gain'], state['loss'] = max(delta, 0.0), max(-delta, 0.0)
+        else:
+            state['gain'] += (max(delta, 0.0) - state['gain'])/n
+            state['loss'] += (max(-delta, 0.0) - state['loss'])/n
+        state['previous'] = close
+        value = float(_rsi(np.array([state['gain']]), np.array([state['loss']]))[0])
+    elif kind == 'vol':
+        previous = state['previous']
+        ret = float(np.log(close/previous)) if previous is not None and previous > 0 and close > 0 else 0.0
+        state['previous'] = close
+        _, var = window.add(ret)
+        value = np.sqrt(var)
+    else:
+        mean, var = window.add(float(volume))
+        value = (float(volume) - mean)/np.sqrt(var) if var > 0 else 0.0
+    if kind in ('sma', 'vol', 'volz'):
+        state['window'] = window.to_dict()
+    return value
+
+def _read_meta(path):
+    meta_path = os.path.join(path, 'indicators.json')
+    if not os.path.isfile(meta_path):
+        return {}
+    with open(meta_path) as f:
+        return json.load(f)
+
+def _save(path, filename, values):
+    tmp = os.path.join(path, '.{}.tmp'.format(filename))
+    with open(tmp, 'wb') as f:
+        np.save(f, values)
+    os.replace(tmp, os.path.join(path, filename))
+
+def load(symbol, names, directory=None):
+    '''Given indicator names, returns their stored columns for symbol, aligned with the cached
+    bars (see cache.symbol_history). Anything missing is computed over the whole history, anything
+    behind the cache is stepped forward from its saved state over the new bars only.
+    Returns: dict of name -> read only np.memmap
+    '''
+    from cache import read_symbol, symbol_dir
+    path = symbol_dir(symbol, directory)
+    bars = read_symbol(symbol, ['date', 'close', 'volume'], directory)
+    dates = bars['date']
+    meta = _read_meta(path)
+    changed = False
+    for name in names:
+        filename = 'ind_{}.npy'.format(name)
+        entry = meta.get(name)
+        count = entry['count'] if entry else 0
+        if entry and count == len(dates) and (count == 0 or entry['last_date'] == str(dates[-1])):
+            continue
+        if entry and 0 < count < len(dates) and entry['last_date'] == str(dates[count - 1]) \
+                and os.path.isfile(os.path.join(path, filename)):
+            # Same history plus new bars, only the new ones are stepped
+            state = entry['state']
+            new = [step(state, close, volume) for close, volume in zip(bars['close'][count:], bars['volume'][count:])]
+            values = np.concatenate([np.load(os.path.join(path, filename)), np.asarray(new, dtype=np.float64)])
+        else:
+            values, state = compute(name, bars['close'], bars['volume'])
+        _save(path, filename, values)
+        meta[name] = {'count': int(len(dates)), 'last_date': str(dates[-1]) if len(dates) else None, 'state': state}
+        changed = True
+    if changed:
+        tmp = os.path.join(path, '.indicators.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(path, 'indicators.json'))
+    return {name: np.load(os.path.join(path, 'ind_{}.npy'.format(name)), mmap_mode='r') for name in names}
@@ -0,0 +1,159 @@
+'''
+Timers, counters and logging for the hot loops. Train/Test used to print() every step, which was
+a lot of stdout and still said nothing about where the time went. Phases (db_fetch, transform,
+predict, replay_sample, fit, log_append) are now timed with timer() and events go through
+log(), which is leveled and rate limited per event.
+Quiet and nearly free by default: while disabled timer() hands back one shared no-op context and
+log() only prints warnings and up. Turn it on with configure(enabled=True) or INSTRUMENT=1, and
+get the numbers with summary(), export_json() or export_prometheus().
+'''
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('trading')
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.addHandler(_handler)
+    logger.propagate = False
+logger.setLevel(os.environ.get('LOG_LEVEL', 'WARNING').upper())
+
+enabled = os.environ.get('INSTRUMENT', '') not in ('', '0')
+# Seconds between two records of the same rate limited event
+interval = 5.0
+
+_lock = threading.Lock()
+# phase -> [count, total seconds, max seconds]
+_timers = {}
+_counters = {}
+# event -> [last time logged, suppressed since]
+_last_logged = {}
+
+class _NoTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+def configure(enabled=None, level=None, interval=None):
+    '''Given any of enabled (timers/counters on), level (logging level name or number) and
+    interval (seconds between repeats of a rate limited event), changes them for the process.
+    '''
+    module = globals()
+    if enabled is not None:
+        module['enabled'] = enabled
+    if level is not None:
+        logger.setLevel(level.upper() if isinstance(level, str) else level)
+    if interval is not None:
+        module['interval'] = interval
+
+def _record(name, seconds):
+    with _lock:
+        stats = _timers.get(name)
+        if stats is None:
+            _timers[name] = [1, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+@contextmanager
+def _timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start)
+
+def timer(name):
+    '''with timer('predict'): ... adds the block's wall time to the phase (no-op while disabled).'''
+    if not enabled:
+        return _NO_TIMER
+    return _timed(name)
+
+def count(name, n=1):
+    if enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+def log(event, level=logging.DEBUG, every=None, **fields):
+    '''Structured log record, "event key=value ...".
+    Parameters: event (name, also the rate limit key), level, every (min seconds between records
+        of this event, default interval for DEBUG, none for anything higher), fields
+    '''
+    if not logger.isEnabledFor(level):
+        return
+    every = every if every is not None else (interval if level <= logging.DEBUG else 0)
+    suppressed = 0
+    if every:
+        now = time.monotonic()
+        with _lock:
+            last = _last_logged.get(event)
+            if last is not None and now - last[0] < every:
+                last[1] += 1
+                return
+            suppressed = last[1] if last is not None else 0
+            _last_logged[event] = [now, 0]
+    if suppressed:
+        fields['suppressed'] = suppressed
+    logger.log(level, ' '.join([event] + ['{}={}'.format(key, value) for key, value in fields.items()]))
+
+def summary():
+    '''Returns: {'timers': {phase: {count, total_s, mean_ms, max_ms}}, 'counters': {name: n}}'''
+    with _lock:
+        timers = {name: {'count': stats[0], 'total_s': stats[1], 'mean_ms': 1000*stats[1]/stats[0],
+                         'max_ms': 1000*stats[2]} for name, stats in _timers.items()}
+        return {'timers': timers, 'counters': dict(_counters)}
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+def export_json(path, **labels):
+    '''Writes summary() plus labels (i.e. episode=3) to path as JSON.'''
+    report = summary()
+    report['labels'] = labels
+    report['time'] = time.time()
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+def export_prometheus(path, **labels):
+    '''Writes summary() in the Prometheus text format, i.e. for the node_exporter textfile collector.'''
+    report = summary()
+    extra = ''.join(',{}="{}"'.format(key, value) for key, value in sorted(labels.items()))
+    lines = ['# TYPE trading_phase_seconds_total counter', '# TYPE trading_phase_calls_total counter',
+             '# TYPE trading_phase_max_seconds gauge']
+    for name, stats in sorted(report['timers'].items()):
+        tags = '{{phase="{}"{}}}'.format(name, extra)
+        lines.append('trading_phase_seconds_total{} {}'.format(tags, stats['total_s']))
+        lines.append('trading_phase_calls_total{} {}'.format(tags, stats['count']))
+        lines.append('trading_phase_max_seconds{} {}'.format(tags, stats['max_ms']/1000))
+    lines.append('# TYPE trading_events_total counter')
+    for name, value in sorted(report['counters'].items()):
+        lines.append('trading_events_total{{event="{}"{}}} {}'.format(name, extra, value))
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    # The textfile collector may read at any time, never show it a half written file
+    os.replace(tmp, path)
+    return report
+
+def export_episode(directory, episode, **labels):
+    '''Writes episode_<n>.json and episode_<n>.prom into directory and starts the next episode from zero.'''
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, 'episode_{:04d}'.format(episode))
+    export_json(base + '.json', episode=episode, **labels)
+    report = export_prometheus(base + '.prom', episode=episode, **labels)
+    reset()
+    return report
@@ -0,0 +1,183 @@
+'''
+Bounded producer/consumer prefetching. A PrefetchLoader runs an iterator (DB reads, decoding,
+feature building) on a worker thread or spawned process and hands its items over through a
+queue of at most depth items, so the producer works ahead of the training loop but never more
+than depth items ahead (backpressure: once the queue is full it blocks until there is room).
+Both sides keep their stall time: the producer's is time blocked on a full queue (training is
+the bottleneck, which is what we want), the consumer's is time waiting on an empty queue (I/O
+is the bottleneck). The consumer's wait is also timed as <name>_wait in instrument.py.
+'''
+
+import time
+import queue
+import threading
+import traceback
+
+# Slots of the producer stats, shared with a worker process through a multiprocessing.Array
+_PRODUCED, _PRODUCE_S, _STALL_S = range(3)
+
+class _End():
+    '''Put after the source's last item.'''
+
+class _Failure():
+    def __init__(self, error):
+        self.error = error
+
+def _put(items, item, stop, stats):
+    '''Blocks until there is room for item (or stop is set), that wait is the producer's stall.
+    Returns: False if stopped before item went in
+    '''
+    while not stop.is_set():
+        try:
+            items.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        # Only time spent blocked counts, a put that finds room is not a stall
+        start = time.perf_counter()
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+        finally:
+            stats[_STALL_S] += time.perf_counter() - start
+    return False
+
+def _produce(source, items, stop, stats, process):
+    '''Worker body, on a thread or in a spawned process.'''
+    try:
+        iterator = iter(source() if callable(source) else source)
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                stats[_PRODUCE_S] += time.perf_counter() - start
+            stats[_PRODUCED] += 1
+            if not _put(items, item, stop, stats):
+                break
+        _put(items, _End(), stop, stats)
+    except Exception as error:
+        if process:
+            # The original may not pickle, its traceback always does
+            error = RuntimeError('Loader worker failed:\n' + traceback.format_exc())
+        _put(items, _Failure(error), stop, stats)
+    if process and stop.is_set():
+        # Do not hang on exit flushing items nobody will read
+        items.cancel_join_thread()
+
+'''Class PrefetchLoader
+Iterates a source ahead of its consumer on a worker thread (or process), depth items at most.
+'''
+class PrefetchLoader():
+    '''Parameters:
+        source
+            Iterable, or a callable returning one. With process=True it has to pickle (i.e. a
+            module level function, a functools.partial or a bound method of a picklable object)
+        depth
+            Queue size, how many items the producer may be ahead
+        process
+            Produce in a spawned process instead of a thread, for producers that hold the GIL
+            (decoding, pure Python feature building). Items are pickled across
+        name
+            Label of the instrument.py timer and of the worker
+    Methods:
+        stats()
+            Items, produce time and stall times of both sides so far
+        close()
+            Stops the worker, anything still queued is dropped
+    Errors in the source are raised on the consumer's side, on the next item.
+    '''
+
+    def __init__(self, source, depth=2, process=False, name='loader'):
+        if depth < 1:
+            raise ValueError('depth has to be at least 1.')
+        self.depth = depth
+        self.process = process
+        self.name = name
+        self.consumed = 0
+        self.consumer_stall = 0.0
+        self._done = False
+        if process:
+            import multiprocessing
+            context = multiprocessing.get_context('spawn')
+            self._items = context.Queue(maxsize=depth)
+            self._stop = context.Event()
+            self._stats = context.Array('d', 3, lock=False)
+            self._worker = context.Process(target=_produce, name=name, daemon=True,
+                                           args=(source, self._items, self._stop, self._stats, True))
+        else:
+            self._items = queue.Queue(maxsize=depth)
+            self._stop = threading.Event()
+            self._stats = [0.0]*3
+            self._worker = threading.Thread(target=_produce, name=name, daemon=True,
+                                            args=(source, self._items, self._stop, self._stats, False))
+        self._worker.start()
+
+    def _get(self):
+        if not self.process:
+            return self._items.get()
+        while True:
+            try:
+                return self._items.get(timeout=0.5)
+            except queue.Empty:
+                if not self._worker.is_alive() and self._items.empty():
+                    raise RuntimeError('Loader worker {} died (exit code {}).'.format(self.name, self._worker.exitcode))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        from instrument import timer
+        start = time.perf_counter()
+        with timer(self.name + '_wait'):
+            item = self._get()
+        self.consumer_stall += time.perf_counter() - start
+        if isinstance(item, _End):
+            self._finish()
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self._finish()
+            raise item.error
+        self.consumed += 1
+        return item
+
+    def stats(self):
+        '''Returns: dict of produced and consumed item counts, produce_s (time in the source),
+        producer_stall_s (blocked on a full queue) and consumer_stall_s (waiting on an empty one)
+        '''
+        return {'produced': int(self._stats[_PRODUCED]), 'consumed': self.consumed,
+                'produce_s': round(self._stats[_PRODUCE_S], 6), 'producer_stall_s': round(self._stats[_STALL_S], 6),
+                'consumer_stall_s': round(self.consumer_stall, 6)}
+
+    def _finish(self):
+        self._done = True
+        self._worker.join()
+
+    def close(self):
+        if self._done:
+            return
+        self._done = True
+        self._stop.set()
+        # Room for a producer blocked on a full queue to notice the stop
+        try:
+            while True:
+                self._items.get_nowait()
+        except (queue.Empty, OSError, ValueError):
+            pass
+        self._worker.join(timeout=5)
+        if self.process and self._worker.is_alive():
+            self._worker.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+'''End PrefetchLoader Class - Usage: with PrefetchLoader(batches, depth=4) as loader: for batch in loader: ...'''
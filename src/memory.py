@@ -0,0 +1,384 @@
+'''
+Replay memory for the bots. The old deque(maxlen=1000) held (state, action, reward, new_state, done)
+tuples, so every bar was stored about 2*window times (and Train's reused state aliased them).
+This stores each bar's feature row once in preallocated arrays and rebuilds the windows by index
+when sampling. Several streams (i.e. symbols stepped side by side) can share one memory.
+'''
+
+import numpy as np
+
+'''Class ReplayMemory
+Ring buffer of frames (one row of state per bar) plus the transition that ended on each frame.
+The transition on slot s goes from the window ending at s-1 to the window ending at s.
+'''
+class ReplayMemory():
+    '''Parameters:
+        window
+            Length of timesteps for bot, bot.NN_input_shape[0]
+        features
+            Width of a state row, len(state_vars) + 3 for the portfolio columns
+        capacity
+            Number of bars kept per stream. Millions are fine, it's all flat arrays
+        streams
+            Number of side by side streams pushed together (1 for plain Train)
+        dtype
+            dtype of the stored frames, float32 halves memory against the old float64 states
+    Methods:
+        push_frame()
+            Store the newest row of state for every stream. Call every bar, even before the window is full.
+        remember()
+            Record action, reward, done for the transition that ends on the last pushed frame
+        reset()
+            New episode on some/all streams, so windows never reach back into the previous one
+        sample()
+            Random batch as stacked arrays, ready for bot.fit_batch(*batch)
+        state_dict(), load_state_dict()
+            Copy of the filled part of the memory and back, for checkpoint.py
+        delta_state(), apply_delta()
+            Only the slots changed since the last delta_state() and back, for checkpoint.py's journal
+    '''
+
+    def __init__(self, window, features, capacity=1000000, streams=1, dtype=np.float32):
+        self.window = window
+        self.features = features
+        self.capacity = capacity
+        self.streams = streams
+        self.dtype = dtype
+        self.frames = np.zeros((capacity, streams, features), dtype=dtype)
+        self.actions = np.zeros((capacity, streams), dtype=np.int8)
+        self.rewards = np.zeros((capacity, streams), dtype=np.float32)
+        self.dones = np.zeros((capacity, streams), dtype=bool)
+        self.valid = np.zeros((capacity, streams), dtype=bool)
+        # Frames pushed since the last reset, per stream
+        self.runs = np.zeros(streams, dtype=np.int64)
+        self.slot = -1
+        self.filled = 0
+        self.n_valid = 0
+        # Frames pushed ever, and where that count and the slot stood at the last delta_state()
+        self.pushes = 0
+        self._mark_pushes = None
+        self._mark_slot = -1
+        if capacity <= window:
+            raise ValueError('Capacity must be larger than the window.')
+
+    def __len__(self):
+        return self.n_valid
+
+    def reset(self, streams=None):
+        '''Given stream indices (default all), starts a new episode on them.'''
+        if streams is None:
+            self.runs[:] = 0
+        else:
+            self.runs[streams] = 0
+
+    def push_frame(self, rows):
+        '''Given the newest state row, (features,) for one stream or (streams, features),
+        writes it once into the next slot.
+        Returns: slot written
+        '''
+        self.slot = (self.slot + 1) % self.capacity
+        self.filled = min(self.filled + 1, self.capacity)
+        # Transitions whose windows reach back into this slot are about to lose a frame
+        self._invalidate((self.slot + np.arange(self.window + 1)) % self.capacity)
+        self.frames[self.slot] = np.reshape(rows, (self.streams, self.features))
+        self.runs += 1
+        self.pushes += 1
+        return self.slot
+
+    def remember(self, action, reward, done, mask=None):
+        '''Records the transition ending on the last pushed frame. Scalars for one stream,
+        arrays of len(streams) otherwise. Streams without a full previous window in this
+        episode (or masked out) are not stored.
+        '''
+        ok = self.runs > self.window
+        if mask is not None:
+            ok = ok & np.asarray(mask, dtype=bool)
+        self.actions[self.slot] = action
+        self.rewards[self.slot] = reward
+        self.dones[self.slot] = done
+        self.valid[self.slot] = ok
+        self.n_valid += int(ok.sum())
+
+    def _invalidate(self, slots):
+        self.n_valid -= int(self.valid[slots].sum())
+        self.valid[slots] = False
+
+    def sample_indices(self, batch_size, rng=None):
+        '''Uniform (with replacement) over stored transitions.
+        Returns: Flat indices, slot*streams + stream
+        '''
+        if self.n_valid == 0:
+            raise ValueError('Replay memory is empty.')
+        rng = rng if rng is not None else np.random
+        flat_valid = self.valid.reshape(-1)
+        total = self.filled*self.streams
+        # Almost every slot is valid, so rejection sampling beats scanning millions of flags
+        if self.n_valid*4 >= total:
+            picked = np.empty(0, dtype=np.int64)
+            for _ in range(8):
+                draw = rng.randint(0, total, size=2*batch_size)
+                picked = np.concatenate([picked, draw[flat_valid[draw]]])
+                if len(picked) >= batch_size:
+                    return picked[:batch_size]
+        return rng.choice(np.flatnonzero(flat_valid), size=batch_size)
+
+    def gather(self, indices):
+        '''Rebuilds the transitions at the given flat indices.
+        Returns: states, actions, rewards, new_states, dones (states are (batch, window, features))
+        '''
+        slots, streams = np.divmod(indices, self.streams)
+        return (self._windows(slots - 1, streams),
+                self.actions[slots, streams].astype(np.int64),
+                self.rewards[slots, streams].astype(np.float64),
+                self._windows(slots, streams),
+                self.dones[slots, streams])
+
+    def sample(self, batch_size, rng=None):
+        '''Given a batch_size, returns a random batch of stacked transitions.
+        Returns: states, actions, rewards, new_states, dones
+        '''
+        return self.gather(self.sample_indices(batch_size, rng))
+
+    def _windows(self, slots, streams):
+        # Newest first, same row order as features.FeatureWindows.state()
+        rows = (slots[:, np.newaxis] - np.arange(self.window)) % self.capacity
+        return self.frames[rows, streams[:, np.newaxis]]
+
+    def state_dict(self):
+        '''Copies of everything needed to rebuild this memory. Slots fill from 0 up, so only the
+        first filled slots of each array are taken.
+        Returns: dict of name -> array or number
+        '''
+        n = self.filled
+        return {'frames': self.frames[:n].copy(), 'actions': self.actions[:n].copy(),
+                'rewards': self.rewards[:n].copy(), 'dones': self.dones[:n].copy(),
+                'valid': self.valid[:n].copy(), 'runs': self.runs.copy(),
+                'slot': int(self.slot), 'filled': int(self.filled), 'n_valid': int(self.n_valid),
+                'capacity': int(self.capacity)}
+
+    def load_state_dict(self, state):
+        '''Given the output of state_dict() (arrays may be memory-mapped), copies it into this
+        memory, which needs the same window, features and streams and a capacity at least as big.
+        '''
+        n = state['filled']
+        if state['frames'].shape[1:] != self.frames.shape[1:] or n > self.capacity:
+            raise ValueError('Memory of shape {} does not fit in {}.'.format(state['frames'].shape, self.frames.shape))
+        if n == state['capacity'] and state['capacity'] != self.capacity:
+            # Windows of a wrapped ring reach around the end, that only lines up with the same capacity
+            raise ValueError('A wrapped memory can only be restored with the same capacity.')
+        self.valid[:] = False
+        for name in ['frames', 'actions', 'rewards', 'dones', 'valid']:
+            getattr(self, name)[:n] = state[name]
+        self.runs[:] = state['runs']
+        self.slot = state['slot']
+        self.filled = n
+        self.n_valid = state['n_valid']
+        self._mark()
+
+    def _mark(self):
+        self._mark_pushes = self.pushes
+        self._mark_slot = self.slot
+
+    def _dirty_slots(self, full):
+        if full or self._mark_pushes is None:
+            return np.arange(self.filled)
+        # Pushes only write their own slot and invalidate the window + 1 slots ahead of it, the
+        # marked slot itself may still get its transition from remember()
+        span = self.pushes - self._mark_pushes + self.window + 2
+        if span >= self.capacity:
+            return np.arange(self.filled)
+        return (self._mark_slot + np.arange(span)) % self.capacity
+
+    def delta_state(self, full=False):
+        '''Copies of the slots changed since the last delta_state() (everything on the first call,
+        or with full, which also leaves the mark alone), so a checkpoint only writes what is new.
+        Returns: dict like state_dict() with the rows of 'slots' instead of the filled prefix
+        '''
+        slots = self._dirty_slots(full)
+        delta = {'slots': slots, 'frames': self.frames[slots], 'actions': self.actions[slots],
+                 'rewards': self.rewards[slots], 'dones': self.dones[slots], 'valid': self.valid[slots],
+                 'runs': self.runs.copy(), 'slot': int(self.slot), 'filled': int(self.filled),
+                 'n_valid': int(self.n_valid), 'capacity': int(self.capacity)}
+        if not full:
+            self._mark()
+        return delta
+
+    def apply_delta(self, delta):
+        '''Given a delta_state() (arrays may be memory-mapped), writes its slots back.'''
+        slots = np.asarray(delta['slots'], dtype=np.int64)
+        capacity, filled = int(delta['capacity']), int(delta['filled'])
+        if (len(slots) and slots.max() >= self.capacity) or np.shape(delta['frames'])[1:] != self.frames.shape[1:]:
+            raise ValueError('Memory delta does not fit in {}.'.format(self.frames.shape))
+        if filled == capacity and capacity != self.capacity:
+            raise ValueError('A wrapped memory can only be restored with the same capacity.')
+        for name in ['frames', 'actions', 'rewards', 'dones', 'valid']:
+            getattr(self, name)[slots] = delta[name]
+        self.runs[:] = delta['runs']
+        self.slot = int(delta['slot'])
+        self.filled = filled
+        self.n_valid = int(delta['n_valid'])
+        self._mark()
+'''End ReplayMemory Class - Usage: bot = Bot_LSTM((14, 7), memory=ReplayMemory(14, 7))'''
+
+
+
+'''Class SumTree
+Array backed binary tree where every node is the sum of its children, so proportional sampling
+and priority updates are O(log n). Both work on whole batches of indices at once.
+'''
+class SumTree():
+    '''Parameters:
+        size
+            Number of leaves needed, rounded up to a power of two
+    '''
+
+    def __init__(self, size):
+        self.leaves = 1 << max(0, (size - 1).bit_length())
+        self.tree = np.zeros(2*self.leaves)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[indices + self.leaves]
+
+    def update(self, indices, priorities):
+        '''Given leaf indices and their new priorities, sets them and fixes every parent level by level.'''
+        nodes = np.asarray(indices) + self.leaves
+        if len(nodes) == 0:
+            return
+        self.tree[nodes] = priorities
+        # Leaves all sit at the same depth, so each pass is exactly one level up
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2*nodes] + self.tree[2*nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        '''Given values in (0, total], walks down to the leaf whose cumulative range holds each.
+        A zero subtree is never entered: rounding at the right edge (a value a hair above the sum
+        of the left side with nothing on the right) stays on the last positive leaf instead of
+        picking padding or an invalidated transition.
+        Returns: Leaf indices
+        '''
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while self.leaves > 1 and nodes[0] < self.leaves:
+            left = 2*nodes
+            left_sum, right_sum = self.tree[left], self.tree[left + 1]
+            go_right = ((values > left_sum) & (right_sum > 0)) | (left_sum <= 0)
+            values = np.where(go_right, values - left_sum, np.minimum(values, left_sum))
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - self.leaves
+'''End SumTree Class'''
+
+
+
+'''Class PrioritizedReplayMemory
+ReplayMemory that samples proportionally to TD error (Schaul et al. 2015). New transitions get
+the max priority seen so far, so everything is replayed at least once.
+'''
+class PrioritizedReplayMemory(ReplayMemory):
+    '''See help(ReplayMemory).
+    Parameters:
+        alpha
+            How much prioritization is used, 0 is uniform
+        beta
+            Importance sampling correction, annealed towards 1 by beta_increment per
+            importance_weights() call (one per replayed batch)
+        epsilon
+            Added to |TD error| so nothing is starved
+    Extra Methods:
+        importance_weights()
+            Given sampled indices, returns normalized weights for fit(sample_weight=...)
+        update_priorities()
+            Given sampled indices and their TD errors (from bot.fit_batch), reprioritizes them
+    '''
+
+    def __init__(self, window, features, capacity=1000000, streams=1, dtype=np.float32,
+                 alpha=0.6, beta=0.4, beta_increment=0.0001, epsilon=0.001):
+        super().__init__(window, features, capacity, streams, dtype)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon
+        self.max_priority = 1.0
+        self.tree = SumTree(capacity*streams)
+        # Indices reprioritized since the last delta_state(), None until a journal asks for deltas
+        self._touched = None
+
+    def remember(self, action, reward, done, mask=None):
+        super().remember(action, reward, done, mask)
+        indices = self.slot*self.streams + np.arange(self.streams)
+        self.tree.update(indices, np.where(self.valid[self.slot], self.max_priority**self.alpha, 0))
+
+    def _invalidate(self, slots):
+        stale = slots[:, np.newaxis]*self.streams + np.arange(self.streams)
+        stale = stale[self.valid[slots]]
+        super()._invalidate(slots)
+        self.tree.update(stale, 0)
+
+    def sample_indices(self, batch_size, rng=None):
+        '''Proportional to priority, one draw per equal slice of the total (stratified).
+        Returns: Flat indices, slot*streams + stream
+        '''
+        if self.n_valid == 0:
+            raise ValueError('Replay memory is empty.')
+        rng = rng if rng is not None else np.random
+        total = self.tree.total()
+        values = (np.arange(batch_size) + rng.random_sample(batch_size))*(total/batch_size)
+        return self.tree.find(np.clip(values, total*1e-12, total))
+
+    def importance_weights(self, indices):
+        '''Given sampled indices, returns (N*P(i))^-beta normalized by the max, and anneals beta.'''
+        probs = self.tree.get(indices)/self.tree.total()
+        weights = (self.n_valid*probs)**(-self.beta)
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        return weights/weights.max()
+
+    def update_priorities(self, indices, td_errors):
+        '''Given sampled indices and their TD errors, sets priority (|TD error| + epsilon)^alpha.
+        Anything overwritten since it was sampled stays at zero.
+        '''
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        still_valid = self.valid.reshape(-1)[indices]
+        self.tree.update(indices, np.where(still_valid, priorities**self.alpha, 0))
+        if self._touched is not None:
+            self._touched.append(np.asarray(indices, dtype=np.int64))
+
+    def state_dict(self):
+        state = super().state_dict()
+        state['priorities'] = self.tree.get(np.arange(self.filled*self.streams))
+        state.update({'beta': float(self.beta), 'max_priority': float(self.max_priority)})
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.tree = SumTree(self.capacity*self.streams)
+        self.tree.update(np.arange(len(state['priorities'])), np.asarray(state['priorities']))
+        self.beta = state['beta']
+        self.max_priority = state['max_priority']
+        self._touched = []
+
+    def delta_state(self, full=False):
+        '''See ReplayMemory.delta_state(), plus the priorities of the changed slots and of every
+        index reprioritized since.
+        '''
+        delta = super().delta_state(full)
+        indices = (delta['slots'][:, np.newaxis]*self.streams + np.arange(self.streams)).reshape(-1)
+        if not full:
+            if self._touched:
+                indices = np.union1d(indices, np.concatenate(self._touched))
+            self._touched = []
+        delta.update({'priority_indices': indices, 'priorities': self.tree.get(indices),
+                      'beta': float(self.beta), 'max_priority': float(self.max_priority)})
+        return delta
+
+    def apply_delta(self, delta):
+        super().apply_delta(delta)
+        self.tree.update(np.asarray(delta['priority_indices'], dtype=np.int64), np.asarray(delta['priorities']))
+        self.beta = float(delta['beta'])
+        self.max_priority = float(delta['max_priority'])
+        self._touched = []
+'''End PrioritizedReplayMemory Class - Usage: bot = Bot_LSTM((14, 7), memory=PrioritizedReplayMemory(14, 7))'''
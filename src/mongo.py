@@ -1,70 +1,119 @@
 
-import pymongo
+# Shared, pooled client (see db.py)
+import db
 
 '''Query Single Stock Train Test'''
-def sstt_cursors(symbol, test_fraction = 0.40):
+# (symbol, test_fraction, fields, source) -> (train, test), so repeated episodes don't query again
+_SSTT_MEMO = {}
+
+def history_pipeline(symbol, fields = None):
+    '''Aggregation for one symbol's whole history in one pass, unwound and sorted by date.
+    Parameters: symbol, fields (names inside "data" to keep, date and close are always kept. None keeps all)
+    Returns: pipeline list
+    '''
+    pipeline = [{"$match":{"symbol":symbol}}]
+    if fields is not None:
+        keep = sorted(set(fields) | {'date', 'close'})
+        projection = {"_id": 0, "symbol": 1}
+        projection.update({"data.{}".format(name): 1 for name in keep})
+        pipeline.append({"$project": projection})
+    pipeline += [{"$unwind": "$data"}, {"$sort":{"data.date":1}}]
+    return pipeline
+
+def sstt_arrays(symbol, test_fraction = 0.40, columns = None):
+    '''Single Stock Train Test Arrays. Same split as sstt_cursors, but as slices of the local
+    column cache (see cache.py), which only goes back to Mongo when it is stale.
+    Parameters: Symbol, Test Fraction, columns (default all)
+    Returns: dicts of column -> array, Time Increasing, For both train and test on symbol
+    '''
+    key = (symbol, test_fraction, tuple(columns) if columns is not None else None, 'cache')
+    if key not in _SSTT_MEMO:
+        from cache import symbol_history
+        history = symbol_history(symbol, columns)
+        timesteps = len(next(iter(history.values())))
+        train_index = round(timesteps*(1-test_fraction))
+        train_data = {name: values[:train_index] for name, values in history.items()}
+        test_data = {name: values[train_index:] for name, values in history.items()}
+        _SSTT_MEMO[key] = (train_data, test_data)
+    return _SSTT_MEMO[key]
+
+def sstt_cursors(symbol, test_fraction = 0.40, use_cache = True, state_vars = None):
     '''Single Stock Train Test Cursors. Generates cursors for train [i.e. 2006-2010] and test [i.e. 2011]
-    Parameters: Symbol, Test Fraction (Test is last test_fraction portion in time increasing data.)
-    Returns: Cursors, Time Increasing, For both train and test on symbol
+    Parameters: Symbol, Test Fraction (Test is last test_fraction portion in time increasing data.),
+        use_cache (iterate the local column cache instead of querying Mongo),
+        state_vars (only these plus date and close are pulled, None pulls every stored field.
+            Indicators like rsi_14 need use_cache)
+    Returns: Cursors, Time Increasing, For both train and test on symbol. Re-iterable, and memoized
+        per process on (symbol, test_fraction, state_vars)
     Important: Assumes same nested "data" document structure from my earlier creation
         Assumes that nested data was create_index on date, and sorted by pymongo.ASCENDING on creation
     '''
-    client = pymongo.MongoClient()
-    equities = client.equities
-    stocks = equities.stocks
-    size = stocks.aggregate([{"$match":{"symbol":symbol}},{"$project": {"_id": 1, "count": {"$size": "$data"}}}])
-    timesteps = size.next()['count']
-    train_index = round(timesteps*(1-test_fraction))
-    test_data = stocks.aggregate([{"$match":{"symbol":symbol}}, 
-                                        {"$unwind": "$data"}, 
-                                        {"$sort":{"data.date":1}},
-                                        {"$skip":train_index}])
-    train_data = stocks.aggregate([{"$match":{"symbol":symbol}}, 
-                                            {"$unwind": "$data"}, 
-                                            {"$sort":{"data.date":1}},
-                                            {"$limit":train_index}])
-    return train_data, test_data
+    if use_cache:
+        from cache import ColumnCursor
+        # Indicator state_vars (see indicators.py) only exist when asked for by name
+        columns = None if state_vars is None else sorted(set(state_vars) | {'date', 'close'})
+        train_data, test_data = sstt_arrays(symbol, test_fraction, columns)
+        return ColumnCursor(train_data, symbol), ColumnCursor(test_data, symbol)
+    key = (symbol, test_fraction, tuple(state_vars) if state_vars is not None else None, 'mongo')
+    if key not in _SSTT_MEMO:
+        stocks = db.stocks_collection()
+        # One projected aggregation, the train/test split is just a cut of the list
+        items = list(stocks.aggregate(history_pipeline(symbol, state_vars)))
+        train_index = round(len(items)*(1-test_fraction))
+        _SSTT_MEMO[key] = (items[:train_index], items[train_index:])
+    return _SSTT_MEMO[key]
+
+def clear_sstt_memo():
+    '''Forget every memoized split, i.e. after new bars were ingested.'''
+    _SSTT_MEMO.clear()
 '''/Query Single Stock Train Test'''
 
-def stock_cursor(symbols, randomize=True):
+def stock_cursor(symbols, randomize=True, test_fraction = 0.40, use_cache = True, state_vars = None):
     '''General Stock Cursor. Generates cursor on a stock in "symbols", can be random if "randomize". 
     Notes: Idealized usage is to pass list of valid symbol names, it will pick a stock and return a
         cursor to it. For TTS, I imagine you pass in a list excluding one for train and in a separate
-        call, you include the single test run. 
-    Parameters: Symbols, INT or LIST_LIKE, if List, returns random/ordered cursor over symbols entered. 
+        call, you include the single test run. For episodes over many symbols (weighted, stratified,
+        contiguous slices, prefetched) see sampler.EpisodeSampler.
+    Parameters: Symbols, STR or LIST_LIKE, if List, returns cursors on a random (or the first) of them.
+        test_fraction, use_cache, state_vars like sstt_cursors
     Returns: Cursors, Time Increasing, For both train and test on symbol
     Important: Assumes same nested "data" document structure from my earlier creation
         Assumes that nested data was create_index on date, and sorted by pymongo.ASCENDING on creation
     '''
     import random
-    client = pymongo.MongoClient()
-    equities = client.equities
-    stocks = equities.stocks
-    if randomize:
-        # TODO: Implement random finding of stock. 
-        pass 
-    data = stocks.aggregate([{"$match":{"symbol":symbol}}, 
-                                        {"$unwind": "$data"}, 
-                                        {"$sort":{"data.date":1}},
-                                        {"$skip":train_index}])
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    symbols = list(symbols)
+    if not symbols:
+        raise ValueError('No symbols to pick from.')
+    symbol = random.choice(symbols) if randomize else symbols[0]
+    return sstt_cursors(symbol, test_fraction, use_cache, state_vars)
 
-    return train_data, test_data
-'''Query All on Some Stock'''
-# TODO: Make General Stock Finder. Useful for episodes spanning numerous stocks. 
-'''/Query All on Some Stock'''
-
-def db_to_ubiquitous_df(symbols, selection_vars, limit = 200, offset = 100):
+def db_to_ubiquitous_df(symbols, selection_vars, limit = 200, offset = 100, use_cache = True):
     '''In need of a way to fit a general scaler, this creates an array of
     raw values for selection_vars of interest across all stocks in the DB.
     NOTE: It starts halfway through the data minus offset then takes "limit" 
     number of items. This was done to not leak into the test data, and get general numbers.  
+    With use_cache the same newest-first slice is cut out of the local column cache.
+    NOTE: For fitting the scaler fit_scaler_db does it in one $group without pulling any bars.
     '''
     import pandas as pd
-    import pymongo
     from tqdm import tqdm
-    client = pymongo.MongoClient()
-    equities = client.equities
-    stocks = equities.stocks
+    if use_cache:
+        from cache import symbol_history
+        frames = []
+        for symbol in tqdm(symbols):
+            history = symbol_history(symbol, list(selection_vars) + ['date'])
+            size = len(history['date'])
+            target = round(size/2) - offset
+            # Newest first like the $sort -1 below, then $skip target and $limit limit
+            stop = size - target
+            start = max(stop - limit, 0)
+            frames.append(pd.DataFrame({name: history[name][start:stop][::-1] for name in selection_vars}))
+        df = pd.concat(frames, ignore_index=True)
+        print('Success. Counts... \n{}'.format({i:len(df) for i in selection_vars}))
+        return df
+    stocks = db.stocks_collection()
     to_add = {i:[] for i in selection_vars}
     for symbol in tqdm(symbols):
         size_curr = stocks.aggregate([{"$match":{"symbol":symbol}},{"$project": {"_id": 1, "count": {"$size": "$data"}}}])
@@ -82,6 +131,74 @@ def db_to_ubiquitous_df(symbols, selection_vars, limit = 200, offset = 100):
     print('Success. Counts... \n{}'.format(item_lengths))
     return pd.DataFrame(to_add)
 
+def moments_pipeline(symbols, fields, test_fraction = 0.40, since = None):
+    '''One aggregation for the count, mean and population std of every field across symbols,
+    computed by Mongo in a single $group (nothing but one small document comes back).
+    Parameters: symbols, fields (names inside "data"), test_fraction (the newest test_fraction of
+        each symbol is left out, like the sstt_* train split. 0 keeps everything), since (only
+        bars with data.date after this, i.e. the ones an Ingestor.update() just added)
+    Returns: pipeline list
+    Important: Assumes "data" is stored date sorted, like iex.py writes it
+    '''
+    projection = {"_id": 0}
+    if test_fraction:
+        # Train split per document, the first round(size*(1 - test_fraction)) bars
+        keep = {"$toInt": {"$round": [{"$multiply": [{"$size": "$data"}, 1 - test_fraction]}, 0]}}
+        projection["data"] = {"$slice": ["$data", keep]}
+    else:
+        projection.update({"data.{}".format(name): 1 for name in sorted(set(fields) | {'date'})})
+    pipeline = [{"$match": {"symbol": {"$in": list(symbols)}}}, {"$project": projection}, {"$unwind": "$data"}]
+    if since is not None:
+        pipeline.append({"$match": {"data.date": {"$gt": since}}})
+    group = {"_id": None}
+    for name in fields:
+        path = "$data.{}".format(name)
+        group[name + "_count"] = {"$sum": {"$cond": [{"$isNumber": path}, 1, 0]}}
+        group[name + "_mean"] = {"$avg": path}
+        group[name + "_std"] = {"$stdDevPop": path}
+    pipeline.append({"$group": group})
+    return pipeline
+
+def db_moments(symbols, fields, test_fraction = 0.40, since = None):
+    '''Runs moments_pipeline, one round trip however many symbols and bars.
+    Returns: scaler.RunningMoments over fields in the given order
+    '''
+    from scaler import RunningMoments
+    moments = RunningMoments(len(fields))
+    for item in db.aggregate(moments_pipeline(symbols, fields, test_fraction, since)):
+        count = [item[name + "_count"] for name in fields]
+        mean = [item[name + "_mean"] or 0 for name in fields]
+        m2 = [(item[name + "_std"] or 0)**2*n for name, n in zip(fields, count)]
+        moments.merge(count, mean, m2)
+    return moments
+
+def fit_scaler_db(symbols, state_vars, test_fraction = 0.40, save = True, filename = "resources/tech_scaler.pkl"):
+    '''Fits the general standard scaler server side, see db_moments. Same result as
+    make_standard_scaler on every train split bar of symbols, without pulling any of them.
+    Parameters: symbols, state_vars, test_fraction, save, filename
+    Returns: scaler, list_of_column_name_order
+    '''
+    from scaler import save_scaler
+    columns = sorted(state_vars)
+    scaler = db_moments(symbols, columns, test_fraction).to_scaler()
+    if save:
+        print('saving scaler at {}\n'.format(filename))
+        save_scaler(scaler, filename)
+    return scaler, columns
+
+def update_scaler_db(symbols, state_vars, since, filename = "resources/tech_scaler.pkl", save = True):
+    '''Folds the bars newer than since (i.e. what the last ingest added) into a saved scaler.
+    Only the moments of the new bars come back from Mongo, the old ones come from the scaler.
+    Parameters: symbols, state_vars (the ones the scaler was fit on), since (datetime), filename, save
+    Returns: scaler
+    '''
+    from scaler import RunningMoments, save_scaler, _joblib
+    moments = RunningMoments.from_scaler(_joblib().load(filename))
+    scaler = moments.merge(db_moments(symbols, sorted(state_vars), 0, since)).to_scaler()
+    if save:
+        save_scaler(scaler, filename)
+    return scaler
+
 def make_standard_scaler(df, save=True):
     '''Makes general standard scaler, for me this is on the big tech companies.
     Min-Max is in Z score, or std. MUST INCLUDE SOME ACTIVATION into ANN (tanh, sigmoid).
@@ -127,13 +244,12 @@ if __name__ == "__main__":
     print('This will replicate my scaler...\n')
     choice = input('Want to continue? ').lower()
     if choice == 'y':
-        from tqdm import tqdm
         symbols = ['AAPL', 'MSFT', 'AMZN', 'INTC', 'AMD']
         state_vars = ['change', 'close_vwap', 'high_low', 'open_close'] #, 'volume']
         print('retrieving: {}\n'.format(symbols))
-        df = db_to_ubiquitous_df(symbols, state_vars)
-        scaler, column_order = make_general_scaler(df)
-        print('Vars: df, scaler, column_order now in memory.\n')
+        # One $group over every train split bar, nothing is pulled into a DataFrame
+        scaler, column_order = fit_scaler_db(symbols, state_vars)
+        print('Vars: scaler, column_order now in memory.\n')
     else:
         print('abandoning...\n')
     
\ No newline at end of file
@@ -0,0 +1,445 @@
+'''
+NumPy forward pass for the small bots in Bots.py. A predict on the 64-32-8 Dense Bot or the two
+8 unit LSTMs of Bot_LSTM is microseconds of math behind milliseconds of Keras/TensorFlow dispatch.
+NumpyBot holds the same weights and runs the same layers with plain NumPy, and it has the
+predict() and NN_input_shape that main.Test, backtest.py and runner.py use, so it drops in for
+the Keras bot when scoring. Weights come from a live model or straight from my_save() h5 files,
+and the h5 route never imports TensorFlow (only h5py).
+'''
+
+import numpy as np
+
+def hard_sigmoid(x):
+    # Keras 2 definition, the LSTM recurrent_activation default before Keras 2.3
+    return np.clip(0.2*x + 0.5, 0, 1)
+
+def sigmoid(x):
+    return 1/(1+np.exp(-x))
+
+def relu(x):
+    return np.maximum(x, 0)
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e/e.sum(axis=-1, keepdims=True)
+
+def linear(x):
+    return x
+
+activations = {'tanh': np.tanh, 'relu': relu, 'sigmoid': sigmoid, 'hard_sigmoid': hard_sigmoid,
+               'softmax': softmax, 'linear': linear}
+
+# Layers of each Bots.py make(), in order, for weight files that carry no architecture
+architectures = {
+    'Bot': [('dense', {'activation': 'relu'}), ('dense', {'activation': 'relu'}),
+            ('dense', {'activation': 'relu'}), ('dense', {'activation': 'linear'})],
+    'Bot_LSTM': [('activation', {'activation': 'tanh'}),
+                 ('lstm', {'activation': 'tanh', 'return_sequences': True}),
+                 ('lstm', {'activation': 'tanh', 'return_sequences': False}),
+                 ('dense', {'activation': 'linear'})]}
+
+def _activation_name(activation):
+    # Keras 2 configs hold the name, newer ones may hold a serialized dict
+    if isinstance(activation, dict):
+        activation = activation.get('config', {}).get('name', activation.get('class_name'))
+    return activation
+
+def dense(x, kernel, bias, activation):
+    return activations[activation](x @ kernel + bias)
+
+def lstm_cell(z, c, act, rec):
+    '''One LSTM step from the summed projections z = x@kernel + h@recurrent_kernel + bias.
+    Returns: h, c
+    '''
+    units = c.shape[1]
+    # One call for all gates, the cell slice of it is simply not used
+    gates = rec(z)
+    c = gates[:, units:2*units]*c + gates[:, :units]*act(z[:, 2*units:3*units])
+    return gates[:, 3*units:]*act(c), c
+
+def lstm(x, kernel, recurrent_kernel, bias, activation='tanh', recurrent_activation='sigmoid', return_sequences=False):
+    '''Keras LSTM forward pass, gates in Keras order (input, forget, cell, output).
+    Parameters: x (batch, timesteps, features), the layer's three weights, activations by name
+    Returns: (batch, units) or (batch, timesteps, units) with return_sequences
+    '''
+    # Input projections for every timestep in one matmul, only the recurrence loops
+    return lstm_projected(x @ kernel + bias, recurrent_kernel, activation, recurrent_activation, return_sequences)
+
+def lstm_projected(projected, recurrent_kernel, activation='tanh', recurrent_activation='sigmoid', return_sequences=False):
+    '''The recurrence of lstm() given its input projections x@kernel + bias (batch, timesteps, 4*units).'''
+    units = recurrent_kernel.shape[0]
+    act = activations[activation]
+    rec = activations[recurrent_activation]
+    h = np.zeros((len(projected), units), dtype=projected.dtype)
+    c = np.zeros((len(projected), units), dtype=projected.dtype)
+    if return_sequences:
+        outputs = np.empty((len(projected), projected.shape[1], units), dtype=projected.dtype)
+    for t in range(projected.shape[1]):
+        h, c = lstm_cell(projected[:, t] + h @ recurrent_kernel, c, act, rec)
+        if return_sequences:
+            outputs[:, t] = h
+    return outputs if return_sequences else h
+
+def apply_layer(layer, x):
+    '''Given a (kind, weights, config) layer of a NumpyBot and its input, returns its output.'''
+    kind, weights, config = layer
+    if kind == 'dense':
+        return dense(x, weights[0], weights[1], config['activation'])
+    if kind == 'lstm':
+        return lstm(x, *weights, activation=config['activation'],
+                    recurrent_activation=config['recurrent_activation'],
+                    return_sequences=config['return_sequences'])
+    if kind == 'activation':
+        return activations[config['activation']](x)
+    if kind == 'flatten':
+        return x.reshape(len(x), -1)
+    raise ValueError('Unknown layer kind {}.'.format(kind))
+
+'''Class NumpyBot
+Inference only copy of a Bots.py bot. Layers are (kind, weights, config) tuples run in order.
+'''
+class NumpyBot():
+    '''Parameters:
+        layers
+            List of (kind, weights, config), kind is 'dense', 'lstm', 'activation' or 'flatten'
+        NN_input_shape
+            Same as the bot's, (window, features)
+        dtype
+            Compute dtype, float32 like Keras
+    Methods:
+        predict()
+            (batch, window, features) or one (window, features) state, same output as the Keras bot
+        from_model()
+            Copy the layers and weights of a built Keras model
+        from_h5()
+            Read a save_weights/my_save() file for one of the architectures above
+    '''
+
+    def __init__(self, layers, NN_input_shape, dtype=np.float32):
+        self.NN_input_shape = tuple(NN_input_shape)
+        self.dtype = dtype
+        self.layers = [(kind, [np.asarray(w, dtype=dtype) for w in weights], config)
+                       for kind, weights, config in layers]
+
+    def predict(self, states):
+        x = np.asarray(states, dtype=self.dtype)
+        if x.ndim == len(self.NN_input_shape):
+            x = x[np.newaxis]
+        for layer in self.layers:
+            x = apply_layer(layer, x)
+        return x
+
+    @classmethod
+    def from_model(cls, model, dtype=np.float32):
+        '''Given a built Keras model (i.e. a trained Bot or Bot_LSTM), copies it layer by layer.
+        Dropout and input layers are skipped (inference), anything else unknown raises ValueError.
+        '''
+        layers = []
+        for layer in model.layers:
+            kind = type(layer).__name__
+            config = layer.get_config()
+            if kind == 'Dense':
+                layers.append(('dense', layer.get_weights(), {'activation': _activation_name(config['activation'])}))
+            elif kind == 'LSTM':
+                layers.append(('lstm', layer.get_weights(),
+                               {'activation': _activation_name(config['activation']),
+                                'recurrent_activation': _activation_name(config['recurrent_activation']),
+                                'return_sequences': config['return_sequences']}))
+            elif kind == 'Activation':
+                layers.append(('activation', [], {'activation': _activation_name(config['activation'])}))
+            elif kind == 'Flatten':
+                layers.append(('flatten', [], {}))
+            elif kind not in ('Dropout', 'InputLayer'):
+                raise ValueError('No NumPy version of layer {}.'.format(kind))
+        shape = getattr(model, 'NN_input_shape', None) or tuple(model.input_shape[1:])
+        return cls(layers, shape, dtype)
+
+    @classmethod
+    def from_h5(cls, filename, architecture, NN_input_shape, recurrent_activation=None, dtype=np.float32):
+        '''Given a Keras 2 weights file (save_weights, i.e. from my_save) and the bot it came from,
+        rebuilds it without TensorFlow.
+        Parameters: filename, architecture ('Bot' or 'Bot_LSTM'), NN_input_shape,
+            recurrent_activation (default from the file's keras_version, hard_sigmoid before 2.3)
+        '''
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            # Model files keep the weights one level down
+            group = f['model_weights'] if 'model_weights' in f else f
+            version = group.attrs.get('keras_version', f.attrs.get('keras_version', b'2.2.4'))
+            version = version.decode() if isinstance(version, bytes) else str(version)
+            weights = []
+            for name in group.attrs['layer_names']:
+                layer = group[name.decode() if isinstance(name, bytes) else name]
+                names = [n.decode() if isinstance(n, bytes) else n for n in layer.attrs['weight_names']]
+                if names:
+                    weights.append([layer[n][()] for n in names])
+        if recurrent_activation is None:
+            major, minor = (int(part) for part in version.split('.')[:2])
+            recurrent_activation = 'hard_sigmoid' if (major, minor) < (2, 3) else 'sigmoid'
+        layers = []
+        for kind, config in architectures[architecture]:
+            config = dict(config)
+            if kind == 'activation':
+                layers.append((kind, [], config))
+                continue
+            if not weights:
+                raise ValueError('{} has fewer layers than {}.'.format(filename, architecture))
+            if kind == 'lstm':
+                config['recurrent_activation'] = recurrent_activation
+            layers.append((kind, weights.pop(0), config))
+        if weights:
+            raise ValueError('{} has more layers than {}.'.format(filename, architecture))
+        return cls(layers, NN_input_shape, dtype)
+'''End NumpyBot Class - Usage: fast = NumpyBot.from_h5('output/bot_LSTM_<time>.h5', 'Bot_LSTM', (14, 7))'''
+
+
+
+'''Class BarScorer
+Bot_LSTM scored one bar at a time per symbol, on exactly the newest first windows it is trained
+and tested on (features.FeatureWindows.state). The first LSTM's input projection of a bar is
+the same in every window that bar is part of, so each symbol keeps the projections of its last
+window in a ring and a step projects only the newest row.
+NOTE: The recurrences still run over the whole window every bar. A newest first window starts at
+the newest bar, so no hidden/cell state carries over from the previous bar's window, and an
+oldest first stream would remember past the window and score a different function than the one
+trained. check_bar_scorer() confirms the outputs equal bot.predict(windows.state(t)). StreamingLSTM
+is the window-fold cheaper approximation, streaming_drift() measures how far off it is.
+'''
+class BarScorer():
+    '''Parameters:
+        bot
+            NumpyBot or a Keras Bot_LSTM (converted with NumpyBot.from_model). Only elementwise
+            layers may come before the first LSTM
+        symbols
+            Stream names, i.e. ['AAPL', 'MSFT']. One ring of projections per symbol
+    Methods:
+        step()
+            Newest feature row of each symbol in, outputs and ready mask (a full window seen) out
+        reset()
+            Forget the bars of some/all symbols, i.e. after a gap in the data or a new episode
+    '''
+
+    def __init__(self, bot, symbols=('default',)):
+        if not isinstance(bot, NumpyBot):
+            bot = NumpyBot.from_model(bot)
+        kinds = [layer[0] for layer in bot.layers]
+        if 'lstm' not in kinds:
+            raise ValueError('BarScorer needs an LSTM layer.')
+        first = kinds.index('lstm')
+        self.pre = bot.layers[:first]
+        self.lstm = bot.layers[first]
+        self.post = bot.layers[first + 1:]
+        if any(kind != 'activation' for kind, _, _ in self.pre):
+            raise ValueError('Only activation layers can come before the first LSTM.')
+        self.bot = bot
+        self.window, self.features = bot.NN_input_shape
+        self.symbols = list(symbols)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        # Projection of an all zero row, what the zero padding of a short window projects to
+        self.blank = self._project(np.zeros((1, self.features), dtype=bot.dtype))[0]
+        self.projected = np.empty((len(self.symbols), self.window, len(self.blank)), dtype=bot.dtype)
+        self.projected[:] = self.blank
+        self.seen = np.zeros(len(self.symbols), dtype=np.int64)
+
+    def _project(self, rows):
+        x = rows
+        for layer in self.pre:
+            x = apply_layer(layer, x)
+        kernel, _, bias = self.lstm[1]
+        return x @ kernel + bias
+
+    def _rows(self, symbols):
+        if symbols is None:
+            return np.arange(len(self.symbols))
+        return np.array([self.index[symbol] for symbol in symbols], dtype=np.int64)
+
+    def reset(self, symbols=None):
+        '''Given symbols (default all), forgets their bars, outputs are ready again a window later.'''
+        rows = self._rows(symbols)
+        self.projected[rows] = self.blank
+        self.seen[rows] = 0
+
+    def step(self, rows, symbols=None):
+        '''Given the newest feature row per symbol ((len(symbols), features), symbols default all,
+        portfolio columns filled in like FeatureWindows.set_portfolio), scores the window ending there.
+        Returns: outputs (len(symbols), actions), ready mask (len(symbols),)
+        '''
+        index = self._rows(symbols)
+        rows = np.asarray(rows, dtype=self.bot.dtype).reshape(len(index), self.features)
+        self.projected[index, self.seen[index] % self.window] = self._project(rows)
+        self.seen[index] += 1
+        # Newest first, slots of never seen bars still hold the blank projection
+        order = (self.seen[index, np.newaxis] - 1 - np.arange(self.window)) % self.window
+        _, (_, recurrent_kernel, _), config = self.lstm
+        x = lstm_projected(self.projected[index[:, np.newaxis], order], recurrent_kernel, config['activation'],
+                           config['recurrent_activation'], config['return_sequences'])
+        for layer in self.post:
+            x = apply_layer(layer, x)
+        return x, self.seen[index] >= self.window
+'''End BarScorer Class - Usage: scorer = BarScorer(NumpyBot.from_h5(path, 'Bot_LSTM', (14, 7)), ['AAPL', 'MSFT'])'''
+
+def check_bar_scorer(bot, windows, atol=1e-5):
+    '''Scores every bar of one episode with BarScorer and with bot.predict(windows.state(t)).
+    Parameters: bot (NumpyBot or Keras Bot_LSTM), windows (features.FeatureWindows with its
+        portfolio columns filled in, i.e. after a Test run), atol
+    Returns: dict with the max absolute difference, argmax agreement and whether they are equal
+        within atol
+    '''
+    scorer = BarScorer(bot)
+    scored = np.concatenate([scorer.step(windows.buffer[t][np.newaxis])[0] for t in range(len(windows))])
+    predicted = np.concatenate([bot.predict(windows.state(t)) for t in range(len(windows))])
+    difference = np.abs(predicted - scored)
+    return {'max_abs': float(difference.max()) if difference.size else 0.0,
+            'agreement': float(np.mean(predicted.argmax(axis=1) == scored.argmax(axis=1))) if len(scored) else 1.0,
+            'equal': bool(np.allclose(predicted, scored, atol=atol))}
+
+'''Class StreamingLSTM
+Opt-in streaming mode of Bot_LSTM scoring, for when per-bar cost matters more than matching the
+trained windows exactly (BarScorer does that). Every symbol keeps the hidden and cell state of each
+LSTM layer and a bar only advances them by one step, instead of re-running both layers over the
+whole window, so a bar costs about a window-th of a windowed predict.
+NOTE: A stream can only go oldest to newest, while the windows from features.FeatureWindows are
+newest bar first, and a stream remembers further back than one window. So the outputs are not the
+windowed predictions, see streaming_drift() for how far apart they are. Resyncing rebuilds the
+state from the last window - 1 bars (oldest first), so the next bar's output is exactly the
+prediction on the oldest first window ending there, and how far back a stream remembers is bounded.
+'''
+class StreamingLSTM():
+    '''Parameters:
+        bot
+            NumpyBot or a Keras Bot_LSTM (converted with NumpyBot.from_model). Only elementwise
+            layers may come before the LSTMs, and only the last LSTM may drop its sequence
+        symbols
+            Stream names, i.e. ['AAPL', 'MSFT']. One state per symbol
+        warmup
+            Bars since the last reset before outputs count as ready, default the window
+        resync_every
+            Bars between rebuilding a symbol's state from its last bars (see above). None never resyncs
+    Methods:
+        step()
+            Newest feature row of each symbol in, outputs and ready mask out
+        reset()
+            Forget the state of some/all symbols, i.e. after a gap in the data or a new episode
+    '''
+
+    def __init__(self, bot, symbols=('default',), warmup=None, resync_every=None):
+        if not isinstance(bot, NumpyBot):
+            bot = NumpyBot.from_model(bot)
+        kinds = [layer[0] for layer in bot.layers]
+        if 'lstm' not in kinds:
+            raise ValueError('Streaming needs at least one LSTM layer.')
+        first = kinds.index('lstm')
+        last = len(kinds) - 1 - kinds[::-1].index('lstm')
+        self.pre = bot.layers[:first]
+        self.recurrent = bot.layers[first:last + 1]
+        self.post = bot.layers[last + 1:]
+        if any(kind != 'activation' for kind, _, _ in self.pre) or \
+                any(kind != 'lstm' for kind, _, _ in self.recurrent) or \
+                any(not config['return_sequences'] for _, _, config in self.recurrent[:-1]):
+            raise ValueError('Only activation layers before the LSTMs and stacked LSTMs can be streamed.')
+        self.bot = bot
+        self.window, self.features = bot.NN_input_shape
+        self.warmup = warmup if warmup is not None else self.window
+        self.resync_every = resync_every
+        self.symbols = list(symbols)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        n = len(self.symbols)
+        self.h = [np.zeros((n, weights[1].shape[0]), dtype=bot.dtype) for _, weights, _ in self.recurrent]
+        self.c = [np.zeros_like(h) for h in self.h]
+        # Last window of raw rows per symbol, row seen % window is the newest
+        self.history = np.zeros((n, self.window, self.features), dtype=bot.dtype)
+        self.seen = np.zeros(n, dtype=np.int64)
+        self.since_sync = np.zeros(n, dtype=np.int64)
+
+    def _rows(self, symbols):
+        if symbols is None:
+            return np.arange(len(self.symbols))
+        return np.array([self.index[symbol] for symbol in symbols], dtype=np.int64)
+
+    def reset(self, symbols=None):
+        '''Given symbols (default all), zeroes their state, outputs are not ready until warmup bars later.'''
+        rows = self._rows(symbols)
+        for h, c in zip(self.h, self.c):
+            h[rows] = 0
+            c[rows] = 0
+        self.seen[rows] = 0
+        self.since_sync[rows] = 0
+
+    def step(self, rows, symbols=None):
+        '''Given the newest feature row per symbol ((len(symbols), features), symbols default all),
+        advances every LSTM layer by one step.
+        Returns: outputs (len(symbols), actions), ready mask (len(symbols),)
+        '''
+        index = self._rows(symbols)
+        rows = np.asarray(rows, dtype=self.bot.dtype).reshape(len(index), self.features)
+        self.history[index, self.seen[index] % self.window] = rows
+        x = rows
+        for layer in self.pre:
+            x = apply_layer(layer, x)
+        for l, (_, (kernel, recurrent_kernel, bias), config) in enumerate(self.recurrent):
+            z = x @ kernel + self.h[l][index] @ recurrent_kernel + bias
+            h, c = lstm_cell(z, self.c[l][index], activations[config['activation']],
+                             activations[config['recurrent_activation']])
+            self.h[l][index] = h
+            self.c[l][index] = c
+            x = h
+        for layer in self.post:
+            x = apply_layer(layer, x)
+        self.seen[index] += 1
+        self.since_sync[index] += 1
+        if self.resync_every is not None:
+            due = index[(self.since_sync[index] >= self.resync_every) & (self.seen[index] >= self.window)]
+            if len(due):
+                self.resync(due)
+        return x, self.seen[index] >= self.warmup
+
+    def resync(self, rows):
+        '''Given symbol rows (indices), rebuilds their state from their last window - 1 bars, oldest first.'''
+        steps = self.window - 1
+        # The newest row is at (seen - 1) % window, so the oldest of the last window - 1 is at seen + 1
+        order = (self.seen[rows, np.newaxis] + 1 + np.arange(steps)) % self.window
+        x = self.history[rows[:, np.newaxis], order]
+        for layer in self.pre:
+            x = apply_layer(layer, x)
+        for l, (_, (kernel, recurrent_kernel, bias), config) in enumerate(self.recurrent):
+            act = activations[config['activation']]
+            rec = activations[config['recurrent_activation']]
+            projected = x @ kernel + bias
+            h = np.zeros((len(rows), recurrent_kernel.shape[0]), dtype=projected.dtype)
+            c = np.zeros_like(h)
+            outputs = np.empty((len(rows), steps, h.shape[1]), dtype=projected.dtype)
+            for t in range(steps):
+                h, c = lstm_cell(projected[:, t] + h @ recurrent_kernel, c, act, rec)
+                outputs[:, t] = h
+            self.h[l][rows] = h
+            self.c[l][rows] = c
+            x = outputs
+        self.since_sync[rows] = 0
+'''End StreamingLSTM Class - Usage: stream = StreamingLSTM(NumpyBot.from_h5(path, 'Bot_LSTM', (14, 7)), ['AAPL', 'MSFT'])'''
+
+def streaming_drift(bot, buffer, resync_every=None, warmup=None):
+    '''How far StreamingLSTM is from the windowed predictions over one series of rows.
+    Parameters: bot (NumpyBot or Keras Bot_LSTM), buffer ((bars, features) rows, i.e. FeatureWindows.buffer),
+        resync_every, warmup (see StreamingLSTM)
+    Returns: dict with max/mean absolute difference and argmax agreement against the newest first
+        windows the bots are trained and tested on ('windowed_*') and against the same windows
+        oldest first ('chronological_*', only the longer memory of the stream differs there)
+    '''
+    from numpy.lib.stride_tricks import sliding_window_view
+    if not isinstance(bot, NumpyBot):
+        bot = NumpyBot.from_model(bot)
+    stream = StreamingLSTM(bot, warmup=warmup, resync_every=resync_every)
+    buffer = np.asarray(buffer, dtype=bot.dtype)
+    streamed = np.concatenate([stream.step(row[np.newaxis])[0] for row in buffer])
+    # Window i ends at bar i + window - 1, compare from the first full window on
+    chronological = sliding_window_view(buffer, stream.window, axis=0).swapaxes(1, 2)
+    start = max(stream.window, stream.warmup) - 1
+    streamed = streamed[start:]
+    report = {}
+    for name, windows in [('windowed', chronological[:, ::-1]), ('chronological', chronological)]:
+        predicted = bot.predict(windows)[start - stream.window + 1:]
+        difference = np.abs(predicted - streamed)
+        report[name + '_max_abs'] = float(difference.max()) if difference.size else 0.0
+        report[name + '_mean_abs'] = float(difference.mean()) if difference.size else 0.0
+        report[name + '_agreement'] = float(np.mean(predicted.argmax(axis=1) == streamed.argmax(axis=1))) if len(streamed) else 1.0
+    return report
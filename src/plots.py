@@ -0,0 +1,106 @@
+'''
+The plots main.py used to draw at the end of every run, split out so that training never
+imports matplotlib/seaborn and plotting never imports Keras. Each function takes the logs as
+DataFrames (or the CSVs cli.py train writes) and saves a timestamped png into directory.
+'''
+
+import os
+from time import localtime, strftime
+
+def _stamp():
+    return strftime("%Y-%m-%d{%H:%M}", localtime())
+
+def _setup(directory):
+    import matplotlib
+    if not os.environ.get('DISPLAY') and os.name != 'nt':
+        # Batch nodes have no display
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    os.makedirs(directory, exist_ok=True)
+    return plt, sns
+
+def plot_training(train_log, directory='plots'):
+    '''Given the training log from main.Train, plots Reward, Loss, Epsilon and Shares.
+    Returns: Path of the saved png
+    '''
+    plt, sns = _setup(directory)
+    plt.rcParams.update({'font.size': 12, 'figure.subplot.hspace':0.1})
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize = (11, 7), sharex=True)
+    sns.lineplot(data = train_log[['Reward', 'Loss', 'Epsilon']].astype('float'), ax=ax1, style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=3))
+    sns.lineplot(data = train_log['Shares'].astype('float'), ax=ax2, style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=3))
+    ax1.set_title('Training Model', fontsize=15)
+    ax2.set_xlabel('Timesteps', fontsize=15)
+    ax2.text(700, 9, 'Shares',
+        verticalalignment='top', horizontalalignment='right',
+        bbox={'facecolor':'blue', 'alpha':0.2, 'pad':10}, fontsize=15)
+    filename = os.path.join(directory, 'training_log_mse_c{}.png'.format(_stamp()))
+    plt.savefig(filename)
+    return filename
+
+def plot_actions(action_df, directory='plots'):
+    '''Given a DataFrame of Q values with buy, sell, hold columns (main.Train's action_log).
+    NOTE: Softmax in title. If Activ. changed, change that
+    Returns: Path of the saved png
+    '''
+    plt, sns = _setup(directory)
+    plt.rcParams.update({'font.size': 12, 'figure.subplot.hspace':0.3})
+    fig, ax1 = plt.subplots(1, 1, figsize = (6, 6))
+    sns.lineplot(data = action_df.astype('float'), ax=ax1, style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=3))
+    ax1.set_title('Training Model', fontsize=15)
+    ax1.set_xlabel('Timesteps', fontsize=15)
+    fig.suptitle('Action Probabilities Through Time (Linear)', fontsize=22)
+    filename = os.path.join(directory, 'action_log_mse_c{}.png'.format(_stamp()))
+    plt.savefig(filename, bbox_inches = 'tight')
+    return filename
+
+def plot_backtest(portfolio_log, random_log, directory='plots', label=None):
+    '''Given the logs of main.Test and main.Test_random on the same data, plots Shares/Profits
+    and Cash/Value of the trained model against random choice. label (i.e. the symbol) goes in
+    the titles and filenames, so several backtests of a run do not overwrite each other.
+    Returns: Paths of the saved pngs
+    '''
+    plt, sns = _setup(directory)
+    plt.rcParams.update({'font.size': 12, 'figure.subplot.hspace':0.8})
+    filenames = []
+    for columns, name in [(['Shares', 'Profits'], 'shares_profits'), (['Cash', 'Value'], 'cash_value')]:
+        fig, ax = plt.subplots(2, 1, figsize = (11, 8))
+        sns.lineplot(data = portfolio_log[columns].astype('float'), ax=ax[0], style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=2))
+        sns.lineplot(data = random_log[columns].astype('float'), ax=ax[1], style='choice', palette=sns.cubehelix_palette(light=.8, n_colors=2))
+        suffix = ' ({})'.format(label) if label else ''
+        ax[0].set_title('Trained Model' + suffix, fontsize=15)
+        ax[1].set_title('Random Choice' + suffix, fontsize=15)
+        ax[1].set_xlabel('Timesteps', fontsize=13)
+        name = '{}_{}'.format(name, label) if label else name
+        filenames.append(os.path.join(directory, '{}_mse_c{}.png'.format(name, _stamp())))
+        plt.savefig(filenames[-1])
+    return filenames
+
+def plot_run(run_directory, directory='plots', show=False):
+    '''Plots whatever a cli.py train run left in run_directory (train_log.csv, actions.csv,
+    test_log.csv and random_log.csv, or one test_log_<symbol>.csv and random_log_<symbol>.csv
+    pair per symbol of a --symbols run).
+    Returns: Paths of the saved pngs
+    '''
+    import pandas as pd
+    def read(name):
+        path = os.path.join(run_directory, name)
+        return pd.read_csv(path) if os.path.exists(path) else None
+    train_log, action_df = read('train_log.csv'), read('actions.csv')
+    filenames = []
+    if train_log is not None:
+        filenames.append(plot_training(train_log, directory))
+    if action_df is not None:
+        filenames.append(plot_actions(action_df, directory))
+    for name in sorted(os.listdir(run_directory)):
+        if not (name.startswith('test_log') and name.endswith('.csv')):
+            continue
+        # '' for test_log.csv, '_<symbol>' for test_log_<symbol>.csv
+        suffix = name[len('test_log'):-len('.csv')]
+        portfolio_log, random_log = read(name), read('random_log{}.csv'.format(suffix))
+        if random_log is not None:
+            filenames.extend(plot_backtest(portfolio_log, random_log, directory, label=suffix[1:] or None))
+    if show:
+        import matplotlib.pyplot as plt
+        plt.show()
+    return filenames
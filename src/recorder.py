@@ -0,0 +1,167 @@
+'''
+Append-only log recorder for Train/Test. DataFrame.append copied the whole frame on every row
+(and is gone in pandas 2), so logs now go into preallocated NumPy column buffers. With a path,
+full chunks are flushed to .npy segments on disk, keeping memory bounded on long runs, and
+those segments are the saved log (a recorder on a directory that has some continues after them).
+A DataFrame is only built when asked for with to_frame().
+'''
+
+import os
+import json
+import numpy as np
+
+'''Class LogRecorder
+Columnar log with O(1) appends. Column i of the log is row i of the buffer, so every column is
+contiguous. Without a path the buffer doubles when full, with a path it is flushed instead.
+'''
+class LogRecorder():
+    '''Parameters:
+        columns
+            Column names, i.e. ['Loss', 'Reward', 'Epsilon', 'Cash', 'Shares']
+        path
+            Optional directory for append-only segment_<n>.npy files. Rows already there count
+            as recorded, new segments are numbered after them
+        chunk_size
+            Rows held in memory before growing (no path) or flushing (path)
+    Methods:
+        append()
+            One row as a dict of column -> value
+        append_many()
+            Many rows at once, column -> array (scalars are broadcast)
+        flush()
+            Write the buffered rows out as the next segment
+        rows()
+            Rows from a given one on, reading only the segments that hold them
+        truncate()
+            Drops the rows after a given count, on disk too (i.e. what a checkpoint did not see)
+        to_frame()
+            Everything recorded so far (segments + buffer) as a pandas DataFrame
+    '''
+
+    def __init__(self, columns, path=None, chunk_size=4096):
+        self.columns = list(columns)
+        self.path = path
+        self.buffer = np.empty((len(self.columns), chunk_size))
+        self.n = 0
+        self.segments = []
+        self.segment_rows = []
+        self.flushed = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            columns_file = os.path.join(path, 'columns.json')
+            if os.path.exists(columns_file):
+                with open(columns_file) as f:
+                    if json.load(f) != self.columns:
+                        raise ValueError('{} holds a log with other columns.'.format(path))
+            with open(columns_file, 'w') as f:
+                json.dump(self.columns, f)
+            for name in self._segment_names(path):
+                self.segments.append(os.path.join(path, name))
+                self.segment_rows.append(np.load(self.segments[-1], mmap_mode='r').shape[1])
+            self.flushed = sum(self.segment_rows)
+
+    @staticmethod
+    def _segment_names(path):
+        return sorted(name for name in os.listdir(path) if name.startswith('segment_') and name.endswith('.npy'))
+
+    def __len__(self):
+        return self.flushed + self.n
+
+    def _make_room(self, rows):
+        while self.n + rows > self.buffer.shape[1]:
+            if self.path is not None and self.n:
+                self.flush()
+            else:
+                grown = np.empty((len(self.columns), max(2*self.buffer.shape[1], self.n + rows)))
+                grown[:, :self.n] = self.buffer[:, :self.n]
+                self.buffer = grown
+
+    def append(self, row):
+        self._make_room(1)
+        self.buffer[:, self.n] = [row[name] for name in self.columns]
+        self.n += 1
+
+    def append_many(self, rows):
+        size = max([np.size(rows[name]) for name in self.columns])
+        self._make_room(size)
+        for i, name in enumerate(self.columns):
+            self.buffer[i, self.n:self.n + size] = rows[name]
+        self.n += size
+
+    def flush(self):
+        '''Writes the buffered rows as the next segment (no-op without a path).'''
+        if self.path is None or self.n == 0:
+            return
+        number = int(os.path.basename(self.segments[-1])[8:-4]) + 1 if self.segments else 0
+        filename = os.path.join(self.path, 'segment_{:06d}.npy'.format(number))
+        self._write(filename, self.buffer[:, :self.n])
+        self.segments.append(filename)
+        self.segment_rows.append(self.n)
+        self.flushed += self.n
+        self.n = 0
+
+    @staticmethod
+    def _write(filename, rows):
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, rows)
+        os.replace(tmp, filename)
+
+    def truncate(self, rows):
+        '''Given a row count, drops every row after it. Segments past it are removed, the one it
+        falls in is rewritten shorter.
+        '''
+        if rows >= len(self):
+            return
+        if rows >= self.flushed:
+            self.n = rows - self.flushed
+            return
+        self.n = 0
+        segments, segment_rows = [], []
+        offset = 0
+        for segment, size in zip(self.segments, self.segment_rows):
+            if offset >= rows:
+                os.remove(segment)
+            else:
+                if offset + size > rows:
+                    self._write(segment, np.load(segment)[:, :rows - offset])
+                    size = rows - offset
+                segments.append(segment)
+                segment_rows.append(size)
+            offset += size
+        self.segments, self.segment_rows = segments, segment_rows
+        self.flushed = rows
+
+    def rows(self, start=0):
+        '''Given a row number, copies the rows from there on (what a checkpoint has not saved yet).
+        Returns: (columns, rows) array
+        '''
+        parts = []
+        offset = 0
+        for segment, size in zip(self.segments, self.segment_rows):
+            if offset + size > start:
+                parts.append(np.load(segment, mmap_mode='r')[:, max(start - offset, 0):])
+            offset += size
+        parts.append(self.buffer[:, max(start - self.flushed, 0):self.n])
+        return np.concatenate(parts, axis=1)
+
+    def to_array(self):
+        '''Returns: (columns, rows) array of everything recorded'''
+        return self.rows(0)
+
+    def to_frame(self):
+        import pandas as pd
+        return pd.DataFrame(dict(zip(self.columns, self.to_array())), columns=self.columns)
+
+    @classmethod
+    def load(cls, path):
+        '''Given a directory written by a recorder, reads every segment back.
+        Returns: pandas DataFrame
+        '''
+        import pandas as pd
+        with open(os.path.join(path, 'columns.json')) as f:
+            columns = json.load(f)
+        parts = [np.load(os.path.join(path, name)) for name in cls._segment_names(path)]
+        data = np.concatenate(parts, axis=1) if parts else np.empty((len(columns), 0))
+        return pd.DataFrame(dict(zip(columns, data)), columns=columns)
+'''End LogRecorder Class - Usage: log = LogRecorder(['Loss', 'Reward']); log.append({'Loss': 0.1, 'Reward': 1})'''
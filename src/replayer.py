@@ -0,0 +1,58 @@
+'''
+Batched replay for the bots. Only needs NumPy, so anything with predict() and a Keras style
+fit() can mix it in without importing Keras (i.e. bench.BenchBot).
+'''
+
+import numpy as np
+
+'''Class Replayer
+Mixin for the Sequential bots in Bots.py (and bench.BenchBot). Batched hindsight experience replay: the sampled states
+and new states are stacked so Q(s) and Q(s') take one predict each, the Bellman update is done
+on the whole batch in NumPy and there is a single fit call.
+'''
+class Replayer():
+    '''Extra Methods:
+        replay_batch()
+            Given a list of memories from remember()/replay(), stacks them and calls fit_batch()
+        fit_batch()
+            Given stacked states, actions, rewards, new_states, dones, fits once on the batch
+        to_numpy()
+            Inference only NumPy copy of the bot (see np_inference.py)
+    '''
+
+    def replay_batch(self, batch, discount=0.01, use_reward=True):
+        '''Given a list of memories in the form (state, action, reward, new_state, done)
+        with (1, #, #) states, this stacks them and fits on the whole batch once.
+        Parameters: batch, discount, use_reward (same meaning as in main.Train)
+        Returns: History object, TD errors
+        '''
+        states = np.concatenate([memory[0] for memory in batch])
+        actions = np.array([memory[1] for memory in batch])
+        rewards = np.array([memory[2] for memory in batch], dtype=np.float64)
+        new_states = np.concatenate([memory[3] for memory in batch])
+        dones = np.array([memory[4] for memory in batch], dtype=bool)
+        return self.fit_batch(states, actions, rewards, new_states, dones, discount, use_reward)
+
+    def fit_batch(self, states, actions, rewards, new_states, dones, discount=0.01, use_reward=True, sample_weight=None, target=None):
+        '''Vectorized version of the per memory replay in main.Train. Same update, targets
+        for the taken action are += reward + discount*max(Q(s')) unless done.
+        Parameters: states (batch, #, #), actions, rewards, new_states, dones, discount, use_reward,
+            sample_weight (i.e. importance weights from memory.PrioritizedReplayMemory),
+            target (frozen network for Q(s'), see async_train.py. Default is this bot)
+        Returns: History object, TD errors (what was added to each target, for reprioritizing)
+        '''
+        # Current buy, sell, hold predictions, Q(s, a)
+        targets = self.predict(states)
+        td_errors = np.zeros(len(states))
+        if use_reward:
+            # Expected buy, sell, hold predictions
+            action_values = (target if target is not None else self).predict(new_states)
+            td_errors = rewards + np.where(dones, 0, discount*np.max(action_values, axis=1))
+            targets[np.arange(len(states)), actions] += td_errors
+        history = self.fit(states, targets, batch_size=len(states), epochs=1, shuffle=False, sample_weight=sample_weight)
+        return history, td_errors
+
+    def to_numpy(self):
+        from np_inference import NumpyBot
+        return NumpyBot.from_model(self)
+'''End Replayer Class'''
@@ -0,0 +1,141 @@
+'''
+Batch backtests over the symbol universe. Every (symbol, weights file) pair gets a backtest.backtest()
+run and every symbol gets one vectorized random choice run over all seeds. The work is fanned
+out over a process pool sized to the machine. Each worker builds its bot, scaler and test features
+once and keeps them for every task it is handed, so a weights file or a symbol is only loaded once
+per worker. Everything comes back as one summary table.
+NOTE: Workers are spawned, not forked. Keras/TensorFlow and pymongo are not fork safe once loaded.
+'''
+
+import os
+
+symbols = ['AAPL', 'MSFT', 'AMZN', 'INTC', 'AMD']
+result_columns = ['symbol', 'weights', 'policy', 'seed', 'bars', 'trades', 'final_value', 'profits', 'return', 'survived']
+
+# Per worker state, filled by _init_worker(). Bots are keyed on weights file, features on symbol
+_WORKER = {}
+
+def _init_worker(bot_class, NN_input_shape, scaler, state_vars, test_fraction, start_cash, numpy_inference=False):
+    _WORKER.clear()
+    _WORKER.update({'bot_class': bot_class, 'NN_input_shape': tuple(NN_input_shape),
+                    'scaler': scaler, 'state_vars': list(state_vars), 'test_fraction': test_fraction,
+                    'start_cash': start_cash, 'numpy_inference': numpy_inference,
+                    'bot': None, 'loaded': None, 'weights': {}})
+
+def _scaler():
+    '''Given a path (i.e. resources/tech_scaler.pkl) the scaler is loaded on first use, see features.load_scaler.'''
+    if isinstance(_WORKER['scaler'], str):
+        from features import load_scaler
+        _WORKER['scaler'] = load_scaler(_WORKER['scaler'])
+    return _WORKER['scaler']
+
+def _bot(weights_filename):
+    '''One model per worker. Weights files are read once, switching between them is set_weights.
+    With numpy_inference every weights file is its own np_inference.NumpyBot and Keras is never loaded.
+    '''
+    if _WORKER['numpy_inference']:
+        if weights_filename not in _WORKER['weights']:
+            from np_inference import NumpyBot
+            bot_class = _WORKER['bot_class']
+            name = bot_class if isinstance(bot_class, str) else bot_class.__name__
+            _WORKER['weights'][weights_filename] = NumpyBot.from_h5(weights_filename, name, _WORKER['NN_input_shape'])
+        return _WORKER['weights'][weights_filename]
+    if _WORKER['bot'] is None:
+        import Bots
+        bot_class = _WORKER['bot_class']
+        if isinstance(bot_class, str):
+            bot_class = getattr(Bots, bot_class)
+        _WORKER['bot'] = bot_class(_WORKER['NN_input_shape'], verbose=False)
+    bot = _WORKER['bot']
+    if _WORKER['loaded'] != weights_filename:
+        if weights_filename not in _WORKER['weights']:
+            bot.load_weights(weights_filename)
+            _WORKER['weights'][weights_filename] = bot.get_weights()
+        else:
+            bot.set_weights(_WORKER['weights'][weights_filename])
+        _WORKER['loaded'] = weights_filename
+    return bot
+
+def _features(symbol):
+    from features import market_features
+    # market_features caches both splits for the life of the worker
+    return market_features(symbol, _scaler(), _WORKER['state_vars'], split='test',
+                           test_fraction=_WORKER['test_fraction'])
+
+def run_bot(symbol, weights_filename):
+    '''Given a symbol and a weights file, backtests the worker's bot on the test split.
+    Returns: list with one summary dict (see result_columns)
+    '''
+    from backtest import backtest, summarize
+    features, closes = _features(symbol)
+    result = backtest(_bot(weights_filename), features, closes, start_cash=_WORKER['start_cash'])
+    row = {'symbol': symbol, 'weights': weights_filename, 'policy': 'bot', 'seed': None}
+    row.update(summarize(result, closes, _WORKER['start_cash']))
+    return [row]
+
+def run_random(symbol, seeds, match_reference=False):
+    '''Given a symbol and seeds, one random_backtest over all of them.
+    Returns: list of summary dicts, one per seed
+    '''
+    from backtest import random_backtest, summarize_random
+    _, closes = _features(symbol)
+    result = random_backtest(closes, _WORKER['NN_input_shape'][0], seeds, start_cash=_WORKER['start_cash'],
+                             match_reference=match_reference)
+    rows = []
+    for i, seed in enumerate(seeds):
+        row = {'symbol': symbol, 'weights': None, 'policy': 'random', 'seed': seed}
+        row.update(summarize_random(result, i, _WORKER['start_cash']))
+        rows.append(row)
+    return rows
+
+def _run_task(task):
+    kind, symbol, arg, match_reference = task
+    if kind == 'bot':
+        return run_bot(symbol, arg)
+    return run_random(symbol, arg, match_reference)
+
+def run_batch(symbols, weights_files, seeds=(0,), bot_class='Bot_LSTM', NN_input_shape=None,
+              scaler='resources/tech_scaler.pkl', state_vars=None, test_fraction=0.40, start_cash=20000,
+              processes=None, match_reference=False, numpy_inference=False):
+    '''Backtests every weights file on every symbol, plus random choice runs for every seed.
+    Parameters:
+        symbols, weights_files (from my_save), seeds (random choice seeds, empty to skip)
+        bot_class: Class or name in Bots.py the weights were saved from
+        NN_input_shape: default (14, len(state_vars) + 3) like main.py
+        scaler: Fitted scaler or a path to one, unpickled once per worker
+        state_vars: default ['change', 'close_vwap', 'high_low', 'open_close']
+        processes: Pool size, default os.cpu_count(). 1 runs everything in this process
+        match_reference: Random runs draw like random.seed(seed) + main.Test_random (slower)
+        numpy_inference: Score with np_inference.NumpyBot read straight from the h5 files, no TensorFlow
+    Returns: pandas DataFrame, one row per (symbol, weights) and per (symbol, seed)
+    '''
+    import pandas as pd
+    if state_vars is None:
+        state_vars = ['change', 'close_vwap', 'high_low', 'open_close']
+    if NN_input_shape is None:
+        NN_input_shape = (14, len(state_vars) + 3)
+    seeds = list(seeds)
+    # Symbol major, so neighbouring tasks share a symbol's features in the same worker
+    tasks = []
+    for symbol in symbols:
+        tasks += [('bot', symbol, weights, match_reference) for weights in weights_files]
+        if seeds:
+            tasks.append(('random', symbol, seeds, match_reference))
+    init_args = (bot_class, NN_input_shape, scaler, state_vars, test_fraction, start_cash, numpy_inference)
+    processes = min(processes or os.cpu_count() or 1, max(len(tasks), 1))
+    if processes == 1:
+        _init_worker(*init_args)
+        results = [_run_task(task) for task in tasks]
+    else:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=init_args) as executor:
+            results = list(executor.map(_run_task, tasks))
+    return pd.DataFrame([row for rows in results for row in rows], columns=result_columns)
+
+if __name__ == "__main__":
+    '''NOTE: Backtests every weights file in ./output on the iex.py universe'''
+    weights_files = sorted(os.path.join('output', name) for name in os.listdir('output') if name.endswith('.h5'))
+    table = run_batch(symbols, weights_files, seeds=range(100))
+    print(table.groupby(['symbol', 'policy'])[['final_value', 'profits', 'return']].describe())
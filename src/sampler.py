@@ -0,0 +1,205 @@
+'''
+Multi-symbol episodes for Train. Instead of every episode being the whole train split of one
+hard coded symbol, an EpisodeSampler draws a symbol (uniform, weighted, or stratified over
+groups like sectors) and a contiguous slice of its train bars, and builds the scaled features
+of the next episodes on a background thread (or process, see loader.py) while the current one
+trains. Features come from features.market_features, so each symbol only goes to the cache/DB
+once per process.
+'''
+
+from functools import partial
+from collections import namedtuple
+import numpy as np
+
+# One episode: symbol, first bar in the split, scaled features and closes of the slice
+Episode = namedtuple('Episode', ['symbol', 'start', 'features', 'closes'])
+
+'''Class EpisodeSampler
+Random episodes over a universe, prefetched. Iterating (or next_episode()) hands them out in
+the order they were drawn.
+'''
+class EpisodeSampler():
+    '''Parameters:
+        symbols
+            Universe to draw from
+        scaler, state_vars
+            Same as for main.Train
+        episode_length
+            Bars per episode, a random contiguous slice. None is the whole split
+        weights
+            None (uniform), 'bars' (proportional to each symbol's bar count) or dict symbol -> weight
+        strata
+            Optional dict symbol -> group (i.e. sector). Groups take turns in a shuffled order,
+            within a group weights apply
+        split, test_fraction
+            Which part of each symbol's history episodes come from
+        seed
+            Seed of the symbol/slice draws. Train checkpoints keep the interrupted episode's
+            symbol and start and get_state(), so a resumed run draws the episodes it would have
+        prefetch
+            Episodes built ahead of the one training (the loader.PrefetchLoader depth). 0 builds
+            them on demand
+        process
+            Build them in a spawned process instead of a thread. Its feature cache is its own
+    Methods:
+        next_episode()
+            The next drawn Episode, waits if the background worker is behind
+        episode()
+            A given (symbol, start) Episode, i.e. to resume one from a checkpoint
+        get_state(), set_state()
+            Where the draws stand after the last handed out Episode (prefetched ones do not
+            count), as JSON friendly lists, and back
+        stats()
+            Stall times of the prefetching (see PrefetchLoader.stats())
+        close()
+            Stops the background worker
+    '''
+
+    def __init__(self, symbols, scaler, state_vars, episode_length=None, weights=None, strata=None,
+                 split='train', test_fraction=0.40, seed=None, prefetch=2, process=False):
+        self.symbols = list(symbols)
+        self.scaler = scaler
+        self.state_vars = list(state_vars)
+        self.episode_length = episode_length
+        self.split = split
+        self.test_fraction = test_fraction
+        self.rng = np.random.RandomState(seed)
+        self.name = ','.join(self.symbols)
+        if weights == 'bars':
+            weights = self.bar_counts()
+        weights = np.array([1.0 if weights is None else float(weights.get(symbol, 0)) for symbol in self.symbols])
+        if not (weights > 0).any():
+            raise ValueError('No symbol has a positive weight.')
+        self.weights = weights
+        self.strata = None
+        if strata is not None:
+            groups = sorted({strata[symbol] for symbol in self.symbols})
+            self.strata = [[i for i, symbol in enumerate(self.symbols) if strata[symbol] == group and weights[i] > 0]
+                           for group in groups]
+            self.strata = [members for members in self.strata if members]
+        self._turns = []
+        self.prefetch = prefetch
+        self.process = process
+        # The workers draw ahead, so every draw comes with the state after it and this is the one
+        # of the last episode handed out
+        self._state = self._draw_state(self.rng, self._turns)
+        self._loader = None
+        self._start()
+
+    def _start(self):
+        if self.prefetch:
+            from loader import PrefetchLoader
+            # Each loader draws on its own copy of the state, a worker close() could not stop (i.e.
+            # stuck in a cold feature load) never touches the one set_state() restores
+            source = partial(self._draws, self._draw_state(self.rng, self._turns))
+            self._loader = PrefetchLoader(source, depth=self.prefetch, process=self.process, name='episode')
+
+    def __getstate__(self):
+        # What a spawned worker gets, everything but the loader feeding from it plus the
+        # connection/cache settings it would otherwise start over from
+        import db
+        import cache
+        state = dict(self.__dict__)
+        state['_loader'] = None
+        # Symbols this process already found fresh skip the worker's DB check
+        state['_worker_settings'] = {'db': dict(db.settings), 'cache_dir': cache.cache_dir,
+                                     'checked': sorted(cache._CHECKED)}
+        return state
+
+    def __setstate__(self, state):
+        import db
+        import cache
+        settings = state.pop('_worker_settings')
+        if settings['db'] != db.settings:
+            db.configure(**settings['db'])
+        cache.cache_dir = settings['cache_dir']
+        cache._CHECKED.update(tuple(key) for key in settings['checked'])
+        self.__dict__.update(state)
+
+    def bar_counts(self):
+        '''Bars per symbol from the column cache (stale symbols are exported in one fetch first).'''
+        from cache import warm_cache, read_meta
+        warm_cache(self.symbols)
+        return {symbol: read_meta(symbol)['count'] for symbol in self.symbols}
+
+    def _draw_symbol(self, rng, turns):
+        if self.strata is None:
+            return self.symbols[rng.choice(len(self.symbols), p=self.weights/self.weights.sum())]
+        if not turns:
+            # Every group once per round, in a new order each round
+            turns.extend(rng.permutation(len(self.strata)))
+        members = self.strata[turns.pop()]
+        p = self.weights[members]/self.weights[members].sum()
+        return self.symbols[members[rng.choice(len(members), p=p)]]
+
+    def _features(self, symbol):
+        from features import market_features
+        return market_features(symbol, self.scaler, self.state_vars, self.split, self.test_fraction)
+
+    def _slice(self, symbol, start, features, closes):
+        stop = len(closes) if self.episode_length is None else start + self.episode_length
+        return Episode(symbol, start, features[start:stop], closes[start:stop])
+
+    def episode(self, symbol, start=0):
+        '''Given a symbol and first bar, builds that Episode (episode_length bars from start).'''
+        return self._slice(symbol, start, *self._features(symbol))
+
+    def _draw(self, rng, turns):
+        symbol = self._draw_symbol(rng, turns)
+        features, closes = self._features(symbol)
+        start = 0
+        if self.episode_length is not None and len(closes) > self.episode_length:
+            start = int(rng.randint(len(closes) - self.episode_length + 1))
+        return self._slice(symbol, start, features, closes)
+
+    @staticmethod
+    def _draw_state(rng, turns):
+        name, keys, pos, has_gauss, cached = rng.get_state()
+        return {'rng': [name, keys.tolist(), int(pos), int(has_gauss), float(cached)],
+                'turns': [int(turn) for turn in turns]}
+
+    @staticmethod
+    def _set_draw_state(rng, state):
+        name, keys, pos, has_gauss, cached = state['rng']
+        rng.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached))
+        return list(state['turns'])
+
+    def _draws(self, state):
+        rng = np.random.RandomState()
+        turns = self._set_draw_state(rng, state)
+        while True:
+            episode = self._draw(rng, turns)
+            yield episode, self._draw_state(rng, turns)
+
+    def next_episode(self):
+        if self._loader is None:
+            # Same timer the loader keeps, built on demand all of it is waiting
+            from instrument import timer
+            with timer('episode_wait'):
+                episode = self._draw(self.rng, self._turns)
+            self._state = self._draw_state(self.rng, self._turns)
+            return episode
+        episode, self._state = next(self._loader)
+        return episode
+
+    def get_state(self):
+        return self._state
+
+    def set_state(self, state):
+        '''Given a get_state(), drops anything prefetched and draws on from there.'''
+        self.close()
+        self._turns = self._set_draw_state(self.rng, state)
+        self._state = state
+        self._start()
+
+    def __iter__(self):
+        while True:
+            yield self.next_episode()
+
+    def stats(self):
+        return self._loader.stats() if self._loader is not None else {}
+
+    def close(self):
+        if self._loader is not None:
+            self._loader.close()
+'''End EpisodeSampler Class - Usage: Train(bot, scaler, EpisodeSampler(['AAPL', 'MSFT'], scaler, state_vars, 250), state_vars)'''
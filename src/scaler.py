@@ -0,0 +1,136 @@
+'''
+Online fitting for the StandardScaler in tech_scaler.pkl. RunningMoments keeps a per feature
+count, mean and M2 (sum of squared deviations) and merges new data into them with Chan et al.'s
+parallel form of Welford's update, so batches of bars, other accumulators or moments computed
+by Mongo (see mongo.db_moments) can all be folded in without the raw history. Memory is
+O(features) no matter how many bars go through.
+'''
+
+import os
+import numpy as np
+
+def _joblib():
+    try:
+        from sklearn.externals import joblib
+    except ImportError:
+        # Newer sklearn dropped its joblib copy
+        import joblib
+    return joblib
+
+'''Class RunningMoments
+Count, mean and M2 per feature. NaN entries are skipped, so each feature keeps its own count.
+'''
+class RunningMoments():
+    '''Parameters:
+        n_features
+            Number of columns, i.e. len(state_vars)
+        count, mean, m2
+            Optional starting moments, i.e. from a fitted scaler
+    Methods:
+        update()
+            Fold in a (rows, features) batch
+        merge()
+            Fold in another RunningMoments or (count, mean, m2) of some other data
+        to_scaler()
+            sklearn StandardScaler with these moments, what make_standard_scaler would have fit
+    '''
+
+    def __init__(self, n_features, count=None, mean=None, m2=None):
+        self.n_features = n_features
+        self.count = np.zeros(n_features) if count is None else np.broadcast_to(np.asarray(count, dtype=np.float64), (n_features,)).copy()
+        self.mean = np.zeros(n_features) if mean is None else np.array(mean, dtype=np.float64)
+        self.m2 = np.zeros(n_features) if m2 is None else np.array(m2, dtype=np.float64)
+
+    @property
+    def var(self):
+        return np.divide(self.m2, self.count, out=np.zeros(self.n_features), where=self.count > 0)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def merge(self, count, mean=None, m2=None):
+        '''Chan et al.: given count, mean and M2 of some other data (or a RunningMoments), combines
+        them with these so the result is as if both had been seen at once.
+        '''
+        if isinstance(count, RunningMoments):
+            count, mean, m2 = count.count, count.mean, count.m2
+        count = np.asarray(count, dtype=np.float64)
+        total = self.count + count
+        delta = np.asarray(mean, dtype=np.float64) - self.mean
+        share = np.divide(count, total, out=np.zeros(self.n_features), where=total > 0)
+        self.mean = self.mean + np.where(count > 0, delta*share, 0)
+        self.m2 = self.m2 + np.where(count > 0, np.asarray(m2, dtype=np.float64) + delta**2*self.count*share, 0)
+        self.count = total
+        return self
+
+    def update(self, batch):
+        '''Given raw rows (rows, features) in the scaler's column order, folds them in.'''
+        batch = np.asarray(batch, dtype=np.float64).reshape(-1, self.n_features)
+        finite = np.isfinite(batch)
+        count = finite.sum(axis=0)
+        values = np.where(finite, batch, 0)
+        mean = np.divide(values.sum(axis=0), count, out=np.zeros(self.n_features), where=count > 0)
+        m2 = (np.where(finite, batch - mean, 0)**2).sum(axis=0)
+        return self.merge(count, mean, m2)
+
+    @classmethod
+    def from_scaler(cls, scaler):
+        '''Given a fitted StandardScaler, its n_samples_seen_, mean_ and var_ as moments.'''
+        mean = np.asarray(scaler.mean_, dtype=np.float64)
+        return cls(len(mean), scaler.n_samples_seen_, mean, np.asarray(scaler.var_)*scaler.n_samples_seen_)
+
+    def to_scaler(self):
+        '''Returns: sklearn StandardScaler fitted to everything merged so far'''
+        from sklearn.preprocessing import StandardScaler
+        scaler = StandardScaler()
+        scaler.mean_ = self.mean.copy()
+        scaler.var_ = self.var
+        # Same as sklearn, a constant feature is left unscaled
+        scaler.scale_ = np.where(self.var > 0, np.sqrt(self.var), 1.0)
+        counts = self.count.astype(np.int64)
+        scaler.n_samples_seen_ = int(counts[0]) if (counts == counts[0]).all() else counts
+        scaler.n_features_in_ = self.n_features
+        return scaler
+'''End RunningMoments Class - Usage: moments = RunningMoments(4).update(raw); scaler = moments.to_scaler()'''
+
+def save_scaler(scaler, filename):
+    '''Writes the scaler with joblib through a temporary file, readers never see half a pickle.
+    The features.load_scaler .npz sidecar is dropped, the next load rebuilds it.
+    '''
+    tmp = filename + '.tmp'
+    _joblib().dump(scaler, tmp)
+    os.replace(tmp, filename)
+    if os.path.exists(filename + '.npz'):
+        os.remove(filename + '.npz')
+    from features import _SCALERS
+    _SCALERS.pop(filename, None)
+    return filename
+
+def update_scaler(filename, batch, save=True):
+    '''Given tech_scaler.pkl (or another fitted StandardScaler file) and new raw bars in its
+    column order (alphabetical state_vars), updates mean and variance without the old data.
+    Returns: updated scaler
+    '''
+    moments = RunningMoments.from_scaler(_joblib().load(filename))
+    scaler = moments.update(batch).to_scaler()
+    if save:
+        save_scaler(scaler, filename)
+    return scaler
+
+def fit_scaler_cache(symbols, state_vars, test_fraction=0.40, save=True, filename='resources/tech_scaler.pkl'):
+    '''Like mongo.fit_scaler_db but over the local column cache, so indicator state_vars (see
+    indicators.py, which Mongo does not have) can be scaled too. One symbol is in memory at a time.
+    Returns: scaler, list_of_column_name_order
+    '''
+    from mongo import sstt_arrays
+    columns = sorted(state_vars)
+    moments = RunningMoments(len(columns))
+    for symbol in symbols:
+        train_data, _ = sstt_arrays(symbol, test_fraction, columns)
+        moments.update(np.column_stack([np.asarray(train_data[name], dtype=np.float64) for name in columns]))
+    scaler = moments.to_scaler()
+    if save:
+        print('saving scaler at {}\n'.format(filename))
+        save_scaler(scaler, filename)
+    return scaler, columns
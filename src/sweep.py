@@ -0,0 +1,273 @@
+'''
+Hyperparameter sweeps over main.Train. A search space is expanded into trials (a full grid or
+random draws), the trials run in a process pool with their own seeds, and every finished trial
+goes into a SQLite results store. Re-running the same sweep against the same store skips what
+is already there, so an interrupted sweep picks up where it stopped. With successive halving
+every trial first trains for a few episodes and only the best 1/eta (by backtest value on the
+test split) go on to eta times the episodes. They continue from the Train checkpoint their last
+rung left (weights, replay memory, epsilon, RNG, see checkpoint.py) instead of starting over.
+Knobs: episode_count, replay_size, window, epsilon_decay, discount, lr, use_reward, bot
+NOTE: Workers are spawned like in runner.py, Keras and pymongo are not fork safe.
+'''
+
+import os
+import json
+import time
+import logging
+import shutil
+import hashlib
+import sqlite3
+import itertools
+import numpy as np
+
+# What a trial gets for any knob the space leaves out, same as main.py
+defaults = {'bot': 'Bot_LSTM', 'episode_count': 3, 'replay_size': 32, 'window': 14,
+            'epsilon_decay': 0.0005, 'discount': 0.01, 'lr': None, 'use_reward': True}
+
+def expand_grid(space):
+    '''Given a dict of knob -> list of values, returns every combination as a list of dicts.'''
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+
+def sample_random(space, n_trials, seed=0):
+    '''Given a dict of knob -> list (pick one), (low, high) tuple (uniform, log uniform if both
+    are positive and differ by 100x or more) or callable(rng), draws n_trials dicts.
+    '''
+    rng = np.random.RandomState(seed)
+    trials = []
+    for _ in range(n_trials):
+        params = {}
+        for name in sorted(space):
+            values = space[name]
+            if callable(values):
+                params[name] = values(rng)
+            elif isinstance(values, tuple):
+                low, high = values
+                if isinstance(low, int) and isinstance(high, int):
+                    params[name] = int(rng.randint(low, high + 1))
+                elif low > 0 and high/low >= 100:
+                    params[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+                else:
+                    params[name] = float(rng.uniform(low, high))
+            else:
+                params[name] = values[rng.randint(len(values))]
+        trials.append(params)
+    return trials
+
+def trial_id(params, seed):
+    '''Stable id of a trial, the same params and seed always give the same id.'''
+    key = json.dumps({'params': params, 'seed': seed}, sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+'''Class ResultsStore
+SQLite table of finished trials, one row per (trial, rung). Only the parent process writes.
+'''
+class ResultsStore():
+    '''Parameters:
+        path
+            SQLite file, i.e. output/sweep.sqlite. Created if missing
+    Methods:
+        get()
+            Stored row of a (trial, rung) as a dict, or None
+        record()
+            Insert or replace a (trial, rung) row
+        to_frame()
+            Every row as a pandas DataFrame, params and metrics expanded into columns
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS trials (
+            trial_id TEXT, rung INTEGER, params TEXT, seed INTEGER, episodes INTEGER, status TEXT,
+            value REAL, metrics TEXT, error TEXT, seconds REAL, finished REAL,
+            PRIMARY KEY (trial_id, rung))''')
+        self.connection.commit()
+
+    def get(self, trial, rung):
+        cursor = self.connection.execute('SELECT status, value, metrics FROM trials WHERE trial_id = ? AND rung = ?', (trial, rung))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return {'status': row[0], 'value': row[1], 'metrics': json.loads(row[2]) if row[2] else {}}
+
+    def record(self, trial, rung, params, seed, episodes, status, value=None, metrics=None, error=None, seconds=None):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (trial, rung, json.dumps(params, sort_keys=True, default=str), seed, episodes,
+                                     status, value, json.dumps(metrics or {}), error, seconds, time.time()))
+
+    def to_frame(self):
+        import pandas as pd
+        df = pd.read_sql_query('SELECT * FROM trials ORDER BY rung, value DESC', self.connection)
+        if len(df):
+            params = pd.DataFrame([json.loads(p) for p in df['params']], index=df.index)
+            metrics = pd.DataFrame([json.loads(m) for m in df['metrics']], index=df.index)
+            df = pd.concat([df.drop(columns=['params', 'metrics']), params, metrics.drop(columns=['value'], errors='ignore')], axis=1)
+        return df
+
+    def close(self):
+        self.connection.close()
+'''End ResultsStore Class'''
+
+def _load_scaler(scaler):
+    '''Paths are read once per worker, see features.load_scaler.'''
+    if not isinstance(scaler, str):
+        return scaler
+    from features import load_scaler
+    return load_scaler(scaler)
+
+def seed_everything(seed):
+    '''Seeds random, numpy and the Keras backend for one trial.'''
+    import random
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        import tensorflow as tf
+        if hasattr(tf, 'set_random_seed'):
+            tf.set_random_seed(seed)
+        else:
+            tf.random.set_seed(seed)
+    except ImportError:
+        pass
+
+def run_trial(params, seed, episodes, symbol, scaler, state_vars, start_cash=20000, checkpoint_path=None):
+    '''Given full params (see defaults), trains a bot on symbol's train split up to episodes and
+    backtests it on the test split.
+    Parameters: params, seed, episodes, symbol, scaler, state_vars, start_cash (of training and
+        the backtest), checkpoint_path (Train checkpoint directory, a trial that already trained
+        some episodes there continues from them instead of a fresh bot)
+    Returns: metrics dict, 'value' is the final portfolio value of the backtest
+    '''
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import Bots
+    from main import Train
+    from backtest import backtest, summarize
+    from features import market_features
+    seed_everything(seed)
+    scaler = _load_scaler(scaler)
+    bot = getattr(Bots, params['bot'])((params['window'], len(state_vars) + 3), verbose=False)
+    if params['lr'] is not None:
+        import keras
+        keras.backend.set_value(bot.optimizer.lr, params['lr'])
+    start = time.time()
+    bot, train_log, _ = Train(bot, scaler, symbol, state_vars, episode_count=episodes, start_cash=start_cash,
+                              replay_size=params['replay_size'], use_reward=params['use_reward'],
+                              discount=params['discount'], epsilon_decay=params['epsilon_decay'],
+                              checkpoint_path=checkpoint_path)
+    features, closes = market_features(symbol, scaler, state_vars, split='test')
+    summary = summarize(backtest(bot, features, closes, start_cash=start_cash), closes, start_cash)
+    return {'value': summary['final_value'], 'profits': summary['profits'], 'trades': summary['trades'],
+            'survived': summary['survived'],
+            'final_loss': float(train_log['Loss'].iloc[-1]) if len(train_log) else None,
+            'train_seconds': time.time() - start}
+
+def _run_trial(task):
+    trial, rung, params, seed, episodes, symbol, scaler, state_vars, start_cash, checkpoint_path = task
+    start = time.time()
+    try:
+        metrics = run_trial(params, seed, episodes, symbol, scaler, state_vars, start_cash, checkpoint_path)
+        return trial, rung, 'done', metrics, None, time.time() - start
+    except Exception as error:
+        return trial, rung, 'failed', {}, repr(error), time.time() - start
+
+def run_sweep(space, symbol, store='output/sweep.sqlite', search='grid', n_trials=20, seed=0,
+              halving=True, min_episodes=1, max_episodes=9, eta=3, scaler='resources/tech_scaler.pkl',
+              state_vars=None, processes=None, retry_failed=False, start_cash=20000, checkpoint_dir=None):
+    '''Runs (or resumes) a sweep.
+    Parameters:
+        space: knob -> values, see expand_grid() (search='grid') or sample_random() (search='random')
+        symbol: Trained on its train split, scored on its test split
+        store: SQLite path or a ResultsStore
+        n_trials, seed: Random search size and the seed of both the draws and the trial seeds
+        halving: Successive halving, rung r trains min_episodes*eta**r episodes up to max_episodes
+            in total, continuing from the trial's checkpoint of the rung before. episode_count in
+            the space is ignored then
+        scaler: Fitted scaler or path, unpickled once per worker
+        processes: Pool size, default os.cpu_count(). 1 runs trials in this process
+        retry_failed: Run trials again that failed before
+        start_cash: Of every training run and backtest
+        checkpoint_dir: Where halving keeps each trial's checkpoints (<checkpoint_dir>/<symbol>/<trial>),
+            default next to the store. Those of trials that are cut are removed
+    Returns: pandas DataFrame of the whole store
+    '''
+    from instrument import log
+    if state_vars is None:
+        state_vars = ['change', 'close_vwap', 'high_low', 'open_close']
+    if not isinstance(store, ResultsStore):
+        store = ResultsStore(store)
+    if halving and checkpoint_dir is None:
+        checkpoint_dir = os.path.splitext(store.path)[0] + '_checkpoints'
+    drawn = expand_grid(space) if search == 'grid' else sample_random(space, n_trials, seed)
+    rng = np.random.RandomState(seed)
+    trials = []
+    for params in drawn:
+        full = dict(defaults)
+        full.update(params)
+        # Per trial seed, derived from the sweep seed so a resume sees the same trials
+        trial_seed = int(rng.randint(2**31 - 1))
+        trials.append((trial_id(full, trial_seed), full, trial_seed))
+    if halving:
+        rungs = []
+        episodes = min_episodes
+        while True:
+            rungs.append(min(episodes, max_episodes))
+            if episodes >= max_episodes:
+                break
+            episodes *= eta
+    else:
+        rungs = [None]
+    alive = trials
+    for rung, episodes in enumerate(rungs):
+        tasks = []
+        for trial, params, trial_seed in alive:
+            count = episodes if episodes is not None else params['episode_count']
+            stored = store.get(trial, rung)
+            if stored is None or (retry_failed and stored['status'] == 'failed'):
+                checkpoint_path = os.path.join(checkpoint_dir, symbol, trial) if halving else None
+                tasks.append((trial, rung, params, trial_seed, count, symbol, scaler, state_vars,
+                              start_cash, checkpoint_path))
+        log('rung', logging.INFO, rung=rung, trials=len(alive), to_run=len(tasks))
+        pending = {task[0]: task for task in tasks}
+        for trial, trial_rung, status, metrics, error, seconds in _map(tasks, processes):
+            _, _, params, trial_seed, count = pending[trial][:5]
+            store.record(trial, trial_rung, params, trial_seed, count, status,
+                         metrics.get('value'), metrics, error, seconds)
+        if rung == len(rungs) - 1:
+            break
+        # Keep the best 1/eta, failed trials rank last
+        scored = []
+        for trial, params, trial_seed in alive:
+            stored = store.get(trial, rung)
+            value = stored['value'] if stored is not None and stored['value'] is not None else -np.inf
+            scored.append((value, trial, params, trial_seed))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        keep = max(1, len(scored)//eta)
+        alive = [(trial, params, trial_seed) for value, trial, params, trial_seed in scored[:keep]]
+        for _, trial, _, _ in scored[keep:]:
+            # Cut trials never train again
+            shutil.rmtree(os.path.join(checkpoint_dir, symbol, trial), ignore_errors=True)
+    return store.to_frame()
+
+def _map(tasks, processes):
+    '''Runs trials, in a spawn pool unless processes is 1, yielding as they finish.'''
+    processes = min(processes or os.cpu_count() or 1, max(len(tasks), 1))
+    if processes == 1:
+        for task in tasks:
+            yield _run_trial(task)
+        return
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for future in as_completed([executor.submit(_run_trial, task) for task in tasks]):
+            yield future.result()
+
+if __name__ == "__main__":
+    '''NOTE: Needs the DB from iex.py and resources/tech_scaler.pkl'''
+    space = {'replay_size': [16, 32, 64], 'discount': [0.01, 0.5, 0.95],
+             'epsilon_decay': [0.0005, 0.002], 'lr': [1e-4, 1e-3], 'use_reward': [True]}
+    print(run_sweep(space, 'MSFT').head(20))
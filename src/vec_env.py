@@ -0,0 +1,185 @@
+'''
+Vectorized trading environment. main.Train steps one portfolio over one symbol and calls
+bot.predict on a batch of one every bar. Here N portfolios (different symbols, start offsets, or
+copies of one series) are stepped side by side. Cash, the FIFO cost basis and the reward state
+are arrays over environments, and the states come out as one (N, window, features) tensor, so the
+policy is a single predict per bar whatever N is. With a memory.ReplayMemory(streams=N) attached,
+every environment's frames and transitions go into that one memory.
+NOTE: Trading and reward rules are the ones in main.Train (use_reward=False trades nothing, like Train).
+'''
+
+import numpy as np
+from features import portfolio_vars
+
+def sigmoid(x):
+    return 1/(1+np.exp(-x))
+
+'''Class VecTradingEnv
+N independent portfolios stepped in lockstep, bar t of every environment at once. Environments
+shorter than the longest one (or that died) are masked out until reset().
+'''
+class VecTradingEnv():
+    '''Parameters:
+        features
+            List of N scaled (bars_i, len(state_vars)) matrices, i.e. from features.market_features()
+        closes
+            List of N close price arrays, same lengths as features
+        window
+            Length of timesteps for bot, bot.NN_input_shape[0]
+        shares, start_cash
+            Starting portfolio of every environment
+        use_reward
+            Same switch as in main.Train, without it nothing is traded and every reward is 0
+        memory
+            Optional memory.ReplayMemory with streams=N, fed with every frame and transition
+    Methods:
+        reset()
+            New episode on every environment, steps through the first window of bars
+        states()
+            (N, window, features) states for the decision at the current bar, newest bar first
+        step()
+            Applies N actions at the current bar, returns rewards, dones and the stepped mask
+    '''
+
+    def __init__(self, features, closes, window, shares=0, start_cash=20000, use_reward=True, memory=None):
+        if len(features) != len(closes) or len(features) == 0:
+            raise ValueError('Need one close series per feature matrix.')
+        self.n = len(features)
+        self.window = window
+        self.start_cash = start_cash
+        self.start_shares = shares
+        self.use_reward = use_reward
+        self.memory = memory
+        self.lengths = np.array([len(c) for c in closes], dtype=np.int64)
+        if self.lengths.min() <= window:
+            raise ValueError('Every environment needs more bars than the window.')
+        self.n_market = features[0].shape[1]
+        bars = self.lengths.max()
+        # Bar t of environment i is buffer[i, t], padded past each environment's end
+        self.buffer = np.zeros((self.n, bars, self.n_market + len(portfolio_vars)))
+        self.closes = np.zeros((self.n, bars))
+        for i, (f, c) in enumerate(zip(features, closes)):
+            self.buffer[i, :len(f), :self.n_market] = f
+            self.closes[i, :len(c)] = c
+        if memory is not None and (memory.streams != self.n or memory.features != self.buffer.shape[2]):
+            raise ValueError('Memory needs streams={} and features={}.'.format(self.n, self.buffer.shape[2]))
+        self._rows = np.arange(self.n)
+        self.reset()
+
+    @classmethod
+    def from_symbols(cls, symbols, scaler, state_vars, window, offsets=(0,), split='train', **kwargs):
+        '''One environment per (symbol, offset), the offset skips that many bars of the split.
+        Parameters: symbols, scaler, state_vars, window, offsets, split ('train' or 'test'),
+            any VecTradingEnv keyword
+        '''
+        from features import market_features
+        features, closes = [], []
+        for symbol in symbols:
+            symbol_features, symbol_closes = market_features(symbol, scaler, state_vars, split=split)
+            for offset in offsets:
+                features.append(symbol_features[offset:])
+                closes.append(symbol_closes[offset:])
+        return cls(features, closes, window, **kwargs)
+
+    def __len__(self):
+        return self.n
+
+    def reset(self):
+        '''Fresh portfolios, then the first window of bars is pushed without acting (like Train).
+        Returns: states for the first decision
+        '''
+        self.t = 0
+        self.cash = np.full(self.n, float(self.start_cash))
+        self.shares = np.full(self.n, float(self.start_shares))
+        # FIFO of buy prices per environment: buys go in at n_bought, sells pop at n_sold
+        self.buy_prices = np.zeros(self.closes.shape)
+        self.n_bought = np.zeros(self.n, dtype=np.int64)
+        self.n_sold = np.zeros(self.n, dtype=np.int64)
+        self.profits = np.zeros(self.n)
+        self.hold_penalty = np.zeros(self.n)
+        self.previous = np.full(self.n, -1, dtype=np.int64)
+        self.done = np.zeros(self.n, dtype=bool)
+        self.active = np.ones(self.n, dtype=bool)
+        self.buffer[:, :, self.n_market:] = 0
+        if self.memory is not None:
+            self.memory.reset()
+        self._open_bar()
+        while self.t < self.window:
+            self.t += 1
+            self._open_bar()
+        return self.states()
+
+    def held(self):
+        '''Shares in the FIFO per environment.'''
+        return self.n_bought - self.n_sold
+
+    def value(self):
+        '''Portfolio values at the current bar, before its trade.'''
+        return self.held()*self.closes[:, self.t] + self.cash
+
+    def _open_bar(self):
+        # End conditions and portfolio columns of bar t, from the portfolio before its trade
+        t = self.t
+        price = self.closes[:, t]
+        held = self.held()
+        self.done |= self.active & (self.cash < price) & (held == 0)
+        active = self.active
+        self.buffer[active, t, self.n_market] = self.cash[active] > price[active]
+        self.buffer[active, t, self.n_market + 1] = held[active] >= 1
+        self.buffer[active, t, self.n_market + 2] = sigmoid(self.cash[active]/self.start_cash)
+        if self.memory is not None:
+            self.memory.push_frame(self.buffer[:, t])
+
+    def states(self):
+        '''Given the current bar t, the windows ending at t - 1 for every environment.
+        Returns: (N, window, features) array, newest bar first
+        '''
+        rows = (self.t - 1) - np.arange(self.window)
+        return self.buffer[:, rows]
+
+    def step(self, actions):
+        '''Given one action per environment (0 buy, 1 sell, 2 hold), trades at the current bar,
+        records the transitions and opens the next bar.
+        Returns: rewards (N,), dones (N,), stepped mask (N,) (only these transitions are real)
+        '''
+        actions = np.asarray(actions, dtype=np.int64).reshape(self.n)
+        stepped = self.active.copy()
+        t = self.t
+        price = self.closes[:, t]
+        rewards = np.zeros(self.n)
+        if self.use_reward:
+            # Buy if can buy
+            buy = stepped & (actions == 0)
+            bought = buy & (self.cash > price)
+            self.cash[bought] -= price[bought]
+            self.shares[bought] += 1
+            self.buy_prices[self._rows[bought], self.n_bought[bought]] = price[bought]
+            self.n_bought[bought] += 1
+            rewards[buy & ~bought] = -0.5
+            # Sell if owns shares, rewarded on the FIFO profit
+            sell = stepped & (actions == 1)
+            sold = sell & (self.held() > 0)
+            profit = price[sold] - self.buy_prices[self._rows[sold], self.n_sold[sold]]
+            self.cash[sold] += price[sold]
+            self.shares[sold] -= 1
+            self.n_sold[sold] += 1
+            self.profits[sold] += profit
+            rewards[sold] = np.select([profit > 10, profit > 5, profit >= 0], [2, 1, 0.5], 0)
+            rewards[sell & ~sold] = -0.5
+            # Hold, penalty grows while holds repeat
+            if t > self.window:
+                hold = stepped & (actions == 2)
+                repeat = hold & (self.previous == 2)
+                self.hold_penalty[repeat] -= 0.1
+                rewards[repeat] = self.hold_penalty[repeat]
+                self.hold_penalty[hold & ~repeat] = 0
+        self.previous[stepped] = actions[stepped]
+        dones = self.done & stepped
+        if self.memory is not None:
+            self.memory.remember(actions, rewards, dones, mask=stepped)
+        self.active = stepped & ~self.done & (t + 1 < self.lengths)
+        if self.active.any():
+            self.t += 1
+            self._open_bar()
+        return rewards, dones, stepped
+'''End VecTradingEnv Class - Usage: env = VecTradingEnv.from_symbols(['MSFT', 'AAPL'], scaler, state_vars, 14)'''